@@ -0,0 +1,164 @@
+import os
+import copy
+import time
+import asyncio
+import argparse
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from cuefile import Cuefile
+from tagging import Tagging
+from codec import Codec
+from manifest import Manifest
+from toolchain import check_tools
+from errors import AlbumError, ConfigError, ToolchainError, ConversionError
+
+# the options that may change from one album to the next, every other one is the converter's
+album_options = ('path', 'cuefile', 'cover', 'year', 'genre', 'album', 'performer', 'comment', 'disc', 'discs')
+
+
+def make_config(**options):
+    # options are named after the long options of the command line (jobs, targets, keep_going...) and
+    # default to the same values
+    from lossless2lossy import ConvertConfig, parser
+    args = vars(parser([]))
+    unknown = [option for option in options if option not in args]
+    if len(unknown) > 0:
+        raise ConfigError('unknown option(s) {}'.format(', '.join(unknown)))
+    args.update(options)
+    return ConvertConfig(argparse.Namespace(**args))
+
+
+class AlbumResult:
+    def __init__(self, album_dir, outfiles, n_tracks, n_up_to_date_tracks, temp_bytes, elapsed):
+        self.album_dir = album_dir
+        # target name -> output files of the album, converted or already up to date
+        self.outfiles = outfiles
+        self.n_tracks = n_tracks
+        self.n_up_to_date_tracks = n_up_to_date_tracks
+        self.temp_bytes = temp_bytes
+        self.elapsed = elapsed
+
+    def as_dict(self):
+        return { 'album_dir': self.album_dir, 'outfiles': self.outfiles, 'tracks': self.n_tracks,
+                 'up_to_date_tracks': self.n_up_to_date_tracks, 'temp_bytes': self.temp_bytes,
+                 'elapsed': round(self.elapsed, 6) }
+
+    def __repr__(self):
+        return 'AlbumResult({}, {} track(s))'.format(self.album_dir, self.n_tracks)
+
+
+class Converter:
+    """
+    Converts albums in a long lived process: the tools are checked once, then every album is
+    converted with the options of the converter, overridden per album by album_options. Up to
+    n_albums albums are converted at once, each with schedulers and pools of its own.
+    convert_album returns a future of the AlbumResult; its exception is a ConversionError when
+    the album cannot be converted, TracksFailedError when some of its tracks failed.
+        with Converter(targets='aac,opus', jobs=4) as converter:
+            result = converter.convert_album('~/rips/album', path='~/music').result()
+    """
+    def __init__(self, config=None, n_albums=1, **options):
+        # a converter that made its config writes its report, otherwise the owner of the config does
+        self.owns_config = config is None
+        if config is None:
+            config = make_config(**options)
+        elif len(options) > 0:
+            raise ConfigError('options are given either with a config or on their own')
+        if config.dry_run:
+            raise ConfigError('a converter converts, a dry run only plans a run of the command line')
+        self.config = config
+        if config.toolchain is None and not check_tools(config):
+            raise ToolchainError('the required tools are missing')
+        self.closed = False
+        self._executor = ThreadPoolExecutor(max_workers=max(1, n_albums), thread_name_prefix='album')
+        self._lock = threading.Lock()
+        # schedulers of the albums being converted, cancelled when the converter closes
+        self._schedulers = set()
+        # one manifest per output root, shared by the albums that go there
+        self._manifests = dict()
+
+    def convert_album(self, album_dir, **options):
+        unknown = [option for option in options if option not in album_options]
+        if len(unknown) > 0:
+            raise ConfigError('option(s) {} cannot be set per album, the album options are {}'.format(
+                ', '.join(unknown), ', '.join(album_options)))
+        # the cuefile and tagging steps write to the args and config, every album has its own copies
+        album_config = copy.copy(self.config)
+        album_config.args = argparse.Namespace(**dict(vars(self.config.args), **options))
+        with self._lock:
+            if self.closed:
+                raise ConversionError('the converter is closed')
+            return self._executor.submit(self._convert, album_config, os.path.realpath(os.path.expanduser(album_dir)))
+
+    async def convert_album_async(self, album_dir, **options):
+        return await asyncio.wrap_future(self.convert_album(album_dir, **options))
+
+    def _manifest(self, out_root):
+        with self._lock:
+            if out_root not in self._manifests:
+                os.makedirs(out_root, exist_ok=True)
+                self._manifests[out_root] = Manifest(out_root)
+            return self._manifests[out_root]
+
+    def _convert(self, config, album_dir):
+        start_time = time.monotonic()
+        args = config.args
+        if not os.path.isdir(album_dir):
+            raise AlbumError('no album directory {}'.format(album_dir))
+        cuefile = Cuefile(config=config)
+        tagging = Tagging(config=config)
+        cuefile.select_cuefile(album_dir)
+        if cuefile.mode == 1:
+            album_tags = tagging.get_album_tags_from_dir(album_dir)
+        else:
+            album_tags = tagging.get_album_tags_from_cuefile(cuefile)
+            cuefile.extract_single_lossless_file()
+            cuefile.extract_track_indexes()
+
+        manifest = None
+        if args.incremental:
+            if args.path is not None and os.path.isdir(os.path.expanduser(args.path)):
+                out_root = os.path.expanduser(args.path)
+            else:
+                out_root = os.getcwd()
+            manifest = self._manifest(os.path.realpath(config.targets[0].root(out_root)))
+
+        scheduler = config.scheduler()
+        with self._lock:
+            if self.closed:
+                raise ConversionError('the converter is closed')
+            self._schedulers.add(scheduler)
+        try:
+            codec = Codec(config=config, scheduler=scheduler, manifest=manifest)
+            codec.decode_input_files(album_tags, cuefile)
+            codec.convert_files(album_tags)
+            codec.run()
+        finally:
+            with self._lock:
+                self._schedulers.discard(scheduler)
+
+        return AlbumResult(album_dir, { target.name: outfiles for target, outfiles in codec.outfiles().items() },
+                           sum(len(tracktags) for tracktags in album_tags.values()), len(codec.up_to_date_tracks),
+                           codec.temp_bytes(), time.monotonic() - start_time)
+
+    def close(self, cancel=False):
+        # waits for the albums submitted so far, with cancel the queued ones are dropped and the running ones stopped
+        with self._lock:
+            self.closed = True
+            schedulers = list(self._schedulers)
+        if cancel:
+            for scheduler in schedulers:
+                scheduler.cancel()
+        self._executor.shutdown(wait=True, cancel_futures=cancel)
+        for manifest in self._manifests.values():
+            manifest.close()
+        self.config.scratch.cleanup()
+        if self.owns_config:
+            self.config.report.write(self.config)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(cancel=exc_type is not None)
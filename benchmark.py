@@ -0,0 +1,505 @@
+#!/usr/bin/python3
+
+import argparse
+import contextlib
+import json
+import math
+import os
+import random
+import re
+import shutil
+import statistics
+import struct
+import subprocess
+import sys
+import time
+import literals
+
+from utility import search_path
+
+# synthetic albums are cd audio
+sample_rate = 44100
+n_channels = 2
+sample_bytes = 2
+bytes_per_second = sample_rate * n_channels * sample_bytes
+
+formats = ('flac', 'wv', 'ape')
+# image: cue + one lossless file, files: cue + one file per track, tagged: tagged files without cue
+layouts = ('image', 'files', 'tagged')
+stub_tools = (literals.ffmpeg, literals.atomicparsley)
+
+temp_bytes_pattern = re.compile(r'^([0-9]+) byte\(s\) written to temp files$', re.MULTILINE)
+
+
+def pcm_second(signal, seed):
+    # one second of 16 bit stereo, tiled to the wanted length: 441 Hz fits exactly 100 samples
+    if signal == 'sine':
+        frequency = 441 * (1 + seed % 4)
+        samples = [int(12000 * math.sin(2 * math.pi * frequency * (n // n_channels) / sample_rate))
+                   for n in range(sample_rate * n_channels)]
+    else:
+        rng = random.Random(seed)
+        samples = [rng.randint(-12000, 12000) for _ in range(sample_rate * n_channels)]
+    return struct.pack('<{}h'.format(len(samples)), *samples)
+
+
+def wav_header(data_size):
+    return (b'RIFF' + struct.pack('<I', 36 + data_size) + b'WAVE' +
+            b'fmt ' + struct.pack('<IHHIIHH', 16, 1, n_channels, sample_rate, bytes_per_second,
+                                  n_channels * sample_bytes, sample_bytes * 8) +
+            b'data' + struct.pack('<I', data_size))
+
+
+def ape_tag(tags):
+    # APEv2 tag with header and footer, as appended to WavPack and Monkey's Audio files
+    items = b''
+    for key, value in tags.items():
+        value = value.encode('utf-8')
+        items += struct.pack('<II', len(value), 0) + key.encode('ascii') + b'\0' + value
+    size = len(items) + 32
+
+    def block(flags):
+        return b'APETAGEX' + struct.pack('<IIII', 2000, size, len(tags), flags) + b'\0' * 8
+
+    return block(0xa0000000) + items + block(0x80000000)
+
+
+class AlbumGenerator:
+    """
+    Writes reproducible synthetic albums: the same parameters always give the same bytes. With real
+    tools the lossless files are encoded by ffmpeg (flac, wavpack) or mac (ape); in stub mode they
+    are written in process, with valid headers and tags around raw PCM, which is all the stub tools
+    and the metadata reader need.
+    """
+    def __init__(self, root, n_tracks, seconds, signal, stub):
+        self.root = root
+        self.n_tracks = n_tracks
+        self.seconds = seconds
+        self.signal = signal
+        self.stub = stub
+
+    def album_dir(self, layout, file_format):
+        return os.path.join(self.root, '{}-{}'.format(layout, file_format))
+
+    def generate(self, layout, file_format):
+        album_dir = self.album_dir(layout, file_format)
+        parameters = { 'layout': layout, 'format': file_format, 'tracks': self.n_tracks, 'seconds': self.seconds,
+                       'signal': self.signal, 'stub': self.stub }
+        parameters_file = os.path.join(album_dir, 'benchmark.json')
+        try:
+            with open(parameters_file) as parameters_fd:
+                if json.load(parameters_fd) == parameters:
+                    return album_dir
+        except (OSError, ValueError):
+            pass
+
+        shutil.rmtree(album_dir, ignore_errors=True)
+        os.makedirs(album_dir)
+        album = 'Bench {} {}'.format(layout.title(), file_format.upper())
+        tracks = [pcm_second(self.signal, n_track) * self.seconds for n_track in range(1, self.n_tracks + 1)]
+
+        if layout == 'image':
+            self._write_lossless(os.path.join(album_dir, 'image.' + file_format), b''.join(tracks), None)
+            self._write_cuefile(album_dir, album, ['image.' + file_format])
+        else:
+            filenames = ['{:02d} track.{}'.format(n_track, file_format) for n_track in range(1, self.n_tracks + 1)]
+            for n_track, (filename, pcm) in enumerate(zip(filenames, tracks), 1):
+                tags = None
+                if layout == 'tagged':
+                    tags = { 'TITLE': 'Track {:02d}'.format(n_track), 'ARTIST': 'Synthetic Artist',
+                             'ALBUM': album, 'DATE': '2000', 'GENRE': 'Benchmark',
+                             'TRACKNUMBER': '{}/{}'.format(n_track, self.n_tracks), 'DISCNUMBER': '1' }
+                self._write_lossless(os.path.join(album_dir, filename), pcm, tags)
+            if layout == 'files':
+                self._write_cuefile(album_dir, album, filenames)
+
+        with open(parameters_file, 'w') as parameters_fd:
+            json.dump(parameters, parameters_fd)
+        return album_dir
+
+    def _write_cuefile(self, album_dir, album, filenames):
+        lines = ['REM GENRE "Benchmark"', 'REM DATE 2000', 'PERFORMER "Synthetic Artist"', 'TITLE "{}"'.format(album)]
+        for n_track in range(1, self.n_tracks + 1):
+            if len(filenames) > 1 or n_track == 1:
+                lines.append('FILE "{}" WAVE'.format(filenames[n_track - 1 if len(filenames) > 1 else 0]))
+            frames = 0 if len(filenames) > 1 else (n_track - 1) * self.seconds * 75
+            lines.append('  TRACK {:02d} AUDIO'.format(n_track))
+            lines.append('    TITLE "Track {:02d}"'.format(n_track))
+            lines.append('    PERFORMER "Synthetic Artist"')
+            lines.append('    INDEX 01 {:02d}:{:02d}:{:02d}'.format(frames // 75 // 60, frames // 75 % 60, frames % 75))
+        with open(os.path.join(album_dir, 'album.cue'), 'w') as cue_fd:
+            cue_fd.write('\n'.join(lines) + '\n')
+
+    def _write_lossless(self, path, pcm, tags):
+        file_format = os.path.splitext(path)[1][1:]
+        if self.stub:
+            with open(path, 'wb') as lossless_fd:
+                if file_format == 'flac':
+                    lossless_fd.write(self._stub_flac_header(len(pcm), tags))
+                elif file_format == 'wv':
+                    lossless_fd.write(self._stub_wavpack_header(len(pcm)))
+                else:
+                    lossless_fd.write(self._stub_ape_header(len(pcm)))
+                lossless_fd.write(pcm)
+                if file_format != 'flac' and tags is not None:
+                    lossless_fd.write(ape_tag(tags))
+            return
+
+        wav_file = path + '.wav'
+        with open(wav_file, 'wb') as wav_fd:
+            wav_fd.write(wav_header(len(pcm)))
+            wav_fd.write(pcm)
+        if file_format == 'ape':
+            cmd = [literals.mac, wav_file, path, '-c2000']
+        else:
+            cmd = [literals.ffmpeg, '-v', 'error', '-i', wav_file, '-map_metadata', '-1',
+                   '-c:a', 'flac' if file_format == 'flac' else 'wavpack']
+            if file_format == 'flac' and tags is not None:
+                for key, value in tags.items():
+                    cmd.extend(('-metadata', '{}={}'.format(key, value)))
+            cmd.extend(('-y', path))
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+        os.remove(wav_file)
+        if file_format != 'flac' and tags is not None:
+            with open(path, 'ab') as lossless_fd:
+                lossless_fd.write(ape_tag(tags))
+
+    def _stub_flac_header(self, pcm_size, tags):
+        total_samples = pcm_size // (n_channels * sample_bytes)
+        packed = (sample_rate << 44) | ((n_channels - 1) << 41) | ((sample_bytes * 8 - 1) << 36) | total_samples
+        streaminfo = struct.pack('>HH', 4096, 4096) + b'\0' * 6 + packed.to_bytes(8, 'big') + b'\0' * 16
+        vendor = b'lossless2lossy benchmark'
+        comments = [('{}={}'.format(key, value)).encode('utf-8') for key, value in (tags or dict()).items()]
+        vorbis_comment = struct.pack('<I', len(vendor)) + vendor + struct.pack('<I', len(comments))
+        for comment in comments:
+            vorbis_comment += struct.pack('<I', len(comment)) + comment
+        return (b'fLaC' + bytes([0]) + len(streaminfo).to_bytes(3, 'big') + streaminfo +
+                bytes([0x84]) + len(vorbis_comment).to_bytes(3, 'big') + vorbis_comment)
+
+    def _stub_wavpack_header(self, pcm_size):
+        total_samples = pcm_size // (n_channels * sample_bytes)
+        flags = (sample_bytes - 1) | (9 << 23)
+        return b'wvpk' + struct.pack('<IHBBIIIII', 24 + pcm_size, 0x410, 0, 0, total_samples, 0, total_samples,
+                                     flags, 0)
+
+    def _stub_ape_header(self, pcm_size):
+        total_samples = pcm_size // (n_channels * sample_bytes)
+        descriptor = b'MAC ' + struct.pack('<HHIIIIIII', 3990, 0, 52, 24, 0, 0, pcm_size, 0, 0) + b'\0' * 16
+        header = struct.pack('<HHIIIHHI', 2000, 0, total_samples, total_samples, 1, sample_bytes * 8, n_channels,
+                             sample_rate)
+        return descriptor + header
+
+
+def stub_ffmpeg(args):
+    # answers the toolchain probes, copies its first audio input to its output and reports progress
+    if '-encoders' in args:
+        print(' ------\n A....D libfdk_aac           Fraunhofer FDK AAC\n A....D aac                  AAC\n'
+              ' A....D libopus              libopus Opus')
+        return 0
+    if '-decoders' in args:
+        print(' ------\n A....D flac                 FLAC\n A....D ape                  APE\n'
+              ' A....D wavpack              WavPack\n A....D alac                 ALAC')
+        return 0
+    if '-version' in args:
+        print('ffmpeg version benchmark-stub')
+        return 0
+
+    progress = None
+    if '-progress' in args:
+        idx = args.index('-progress')
+        progress = open(int(args[idx + 1].split(':')[1]), 'w')
+        del args[idx:idx + 2]
+    inputs = [args[idx + 1] for idx, arg in enumerate(args) if arg == '-i']
+    if len(inputs) == 0:
+        return 1
+    if inputs[0] == '-':
+        data = sys.stdin.buffer.read()
+    else:
+        with open(inputs[0], 'rb') as input_fd:
+            data = input_fd.read()
+
+    for arg in args:
+        if arg.startswith('atrim='):
+            trim = dict(option.split('=') for option in arg.split(',')[0][len('atrim='):].split(':'))
+            start = int(float(trim['start']) * bytes_per_second)
+            end = int(float(trim['end']) * bytes_per_second) if 'end' in trim else len(data)
+            data = data[start:end]
+
+    duration_us = len(data) * 1000000 // bytes_per_second
+    if progress is not None:
+        progress.write('out_time_us={}\nspeed=100x\nprogress=end\n'.format(duration_us))
+        progress.close()
+    # every output file follows a -y, one per target
+    outputs = [args[idx + 1] for idx, arg in enumerate(args) if arg == '-y'] or [args[-1]]
+    for output in outputs:
+        if output == '-':
+            sys.stdout.buffer.write(data)
+        else:
+            with open(output, 'wb') as output_fd:
+                output_fd.write(data)
+    return 0
+
+
+def stub_main():
+    tool = os.path.basename(sys.argv[0])
+    if tool == literals.ffmpeg:
+        return stub_ffmpeg(sys.argv[1:])
+    # atomicparsley: tagging is not simulated
+    return 0
+
+
+class Benchmark:
+    """
+    Measures lossless2lossy on synthetic albums, end to end (the script run as a child process)
+    and stage by stage (metadata probe, cue parse, decode, encode, tag run in process on the
+    scheduler). Each measurement is repeated and the median wall time is reported, with tracks/s,
+    the realtime factor, the peak RSS of the children and the bytes written to temp files.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.workdir = os.path.realpath(os.path.expanduser(args.workdir))
+        self.generator = AlbumGenerator(os.path.join(self.workdir, 'albums'), args.tracks, args.seconds, args.signal,
+                                        args.stub)
+        self.out_root = os.path.join(self.workdir, 'out')
+        self.results = list()
+        self.env = dict(os.environ)
+        # the toolchain cache of the benchmark never mixes with the user's one
+        self.env['XDG_CACHE_HOME'] = os.path.join(self.workdir, 'cache')
+        if args.stub:
+            stub_dir = os.path.join(self.workdir, 'bin')
+            os.makedirs(stub_dir, exist_ok=True)
+            for tool in stub_tools:
+                stub = os.path.join(stub_dir, tool)
+                if not os.path.islink(stub):
+                    os.symlink(os.path.realpath(__file__), stub)
+            self.env['PATH'] = stub_dir + os.pathsep + search_path()
+
+    def run(self):
+        for file_format in self.args.formats.split(','):
+            if not self.args.stub and file_format == 'ape' and shutil.which(literals.mac, path=self.env['PATH']) is None:
+                print('{} is missing, skipping ape albums'.format(literals.mac))
+                continue
+            for layout in self.args.layouts.split(','):
+                album_dir = self.generator.generate(layout, file_format)
+                self.bench_end_to_end(layout, file_format, album_dir)
+                self.bench_stages(layout, file_format, album_dir)
+        if self.args.json is not None:
+            with open(self.args.json, 'w') as json_fd:
+                json.dump(self.results, json_fd, indent=2)
+        if not self.args.keep:
+            shutil.rmtree(self.out_root, ignore_errors=True)
+
+    def _report(self, layout, file_format, stage, walls, n_tracks, audio_seconds, peak_rss, temp_bytes):
+        wall = statistics.median(walls)
+        result = { 'layout': layout, 'format': file_format, 'stage': stage, 'wall': wall,
+                   'tracks_per_second': n_tracks / wall if wall > 0 else None,
+                   'realtime_factor': audio_seconds / wall if audio_seconds and wall > 0 else None,
+                   'peak_rss_kb': peak_rss, 'temp_bytes': temp_bytes }
+        self.results.append(result)
+        print('{:<7} {:<5} {:<11} {:>9.4f}s {:>10} {:>10} {:>10} {:>12}'.format(
+            layout, file_format, stage, wall,
+            '-' if result['tracks_per_second'] is None else '{:.1f}'.format(result['tracks_per_second']),
+            '-' if result['realtime_factor'] is None else '{:.1f}x'.format(result['realtime_factor']),
+            '-' if peak_rss is None else '{}k'.format(peak_rss), '-' if temp_bytes is None else temp_bytes))
+
+    def _maxrss_kb(self, rusage):
+        # bytes on macOS, kilobytes elsewhere
+        return rusage.ru_maxrss // 1024 if sys.platform == 'darwin' else rusage.ru_maxrss
+
+    def bench_end_to_end(self, layout, file_format, album_dir):
+        script = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'lossless2lossy.py')
+        out_dir = os.path.join(self.out_root, 'end-to-end')
+        cmd = [sys.executable, script, '-d', out_dir, '-j', str(self.args.jobs), '--no-progress'] + self.args.extra
+        walls = list()
+        peak_rss = 0
+        temp_bytes = 0
+        for _ in range(self.args.repeat):
+            shutil.rmtree(out_dir, ignore_errors=True)
+            os.makedirs(out_dir)
+            start_time = time.monotonic()
+            process = subprocess.Popen(cmd, cwd=album_dir, env=self.env, stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+            output = process.stdout.read()
+            pid, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            walls.append(time.monotonic() - start_time)
+            if process.returncode != 0:
+                print(output.decode('utf-8', errors='replace'))
+                print('lossless2lossy failed on {}'.format(album_dir))
+                exit(-1)
+            # wait4 reports the peak of the process and of the children it reaped
+            peak_rss = max(peak_rss, self._maxrss_kb(rusage))
+            temp_match = temp_bytes_pattern.search(output.decode('utf-8', errors='replace'))
+            temp_bytes = int(temp_match.group(1)) if temp_match is not None else 0
+        self._report(layout, file_format, 'end-to-end', walls, self.args.tracks,
+                     self.args.tracks * self.args.seconds, peak_rss, temp_bytes)
+
+    def bench_stages(self, layout, file_format, album_dir):
+        # imported here and not at the top: the stub tools run from this file too and must start fast
+        from lossless2lossy import ConvertConfig, parser
+        from toolchain import check_tools
+        from cuefile import CueSheet
+        from metadata import MetadataReader
+
+        sources = sorted(os.path.join(album_dir, f) for f in os.listdir(album_dir)
+                         if f.endswith('.' + file_format))
+        cue_files = [os.path.join(album_dir, f) for f in os.listdir(album_dir) if f.endswith('.cue')]
+        n_tracks = self.args.tracks
+        audio_seconds = n_tracks * self.args.seconds
+
+        walls = list()
+        for _ in range(self.args.repeat):
+            start_time = time.monotonic()
+            for source in sources:
+                MetadataReader(source).read_tags()
+                MetadataReader(source).read_stream_info()
+            walls.append(time.monotonic() - start_time)
+        self._report(layout, file_format, 'probe', walls, len(sources), None, None, None)
+
+        if len(cue_files) > 0:
+            walls = list()
+            for _ in range(self.args.repeat):
+                start_time = time.monotonic()
+                CueSheet().read(cue_files[0])
+                walls.append(time.monotonic() - start_time)
+            self._report(layout, file_format, 'cue', walls, n_tracks, None, None, None)
+
+        # the child stages run with the same config as the end to end run, forced to intermediate wav files
+        out_dir = os.path.join(self.out_root, 'stages')
+        saved_environ = dict(os.environ)
+        os.environ.update(self.env)
+        config = None
+        try:
+            config = ConvertConfig(parser(self.args.extra + ['-d', out_dir, '-s', literals.stream_wav,
+                                                             '-j', str(self.args.jobs), '--no-progress']))
+            if not check_tools(config):
+                exit(-1)
+            walls = { stage: list() for stage in ('decode', 'encode', 'tag') }
+            peak_rss = { stage: 0 for stage in walls }
+            temp_bytes = 0
+            for _ in range(self.args.repeat):
+                shutil.rmtree(out_dir, ignore_errors=True)
+                os.makedirs(out_dir)
+                # the planning is as verbose as a real run
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    album_tags, codec = self._plan_album(config, album_dir)
+                tracks = [(disc, track, tags) for disc, tracktags in album_tags.items()
+                          for track, tags in tracktags.items()]
+                positions = { (disc, track): (track, len(album_tags[disc]), disc, len(album_tags))
+                              for disc, track, tags in tracks }
+
+                # one encode per track for all the targets, one tag per track and target
+                outputs = [(target, target.root(out_dir)) for target in config.targets]
+                for target, dir_name in outputs:
+                    os.makedirs(dir_name, exist_ok=True)
+                stage_cmds = dict()
+                stage_cmds['decode'] = [codec.decode_cmds[(disc, track)] for disc, track, tags in tracks]
+                stage_cmds['encode'] = [codec._compose_converter_cmd(tags, outputs) for disc, track, tags in tracks]
+                stage_cmds['tag'] = list()
+                for target, dir_name in outputs:
+                    for disc, track, tags in tracks:
+                        if target.tagger == literals.ffmpeg:
+                            outfile = codec._outfile(tags, dir_name, target)
+                            stage_cmds['tag'].append(codec._compose_retag_cmd(
+                                tags, outfile, outfile + '.retag' + target.extension, positions[(disc, track)], target))
+                        else:
+                            stage_cmds['tag'].append(codec._compose_tagger_cmd(*positions[(disc, track)], tags, dir_name,
+                                                                               target))
+
+                for stage in ('decode', 'encode', 'tag'):
+                    wall, rss = self._run_stage(stage, stage_cmds[stage])
+                    walls[stage].append(wall)
+                    peak_rss[stage] = max(peak_rss[stage], rss)
+                    if stage == 'decode':
+                        temp_bytes = sum(os.path.getsize(tags[literals.infile]) for disc, track, tags in tracks)
+                for disc, track, tags in tracks:
+                    os.remove(tags[literals.infile])
+            for stage in ('decode', 'encode', 'tag'):
+                self._report(layout, file_format, stage, walls[stage], n_tracks,
+                             audio_seconds if stage != 'tag' else None, peak_rss[stage],
+                             temp_bytes if stage == 'decode' else None)
+        finally:
+            if config is not None:
+                config.scratch.cleanup()
+            os.environ.clear()
+            os.environ.update(saved_environ)
+
+    def _plan_album(self, config, album_dir):
+        from cuefile import Cuefile
+        from tagging import Tagging
+        from codec import Codec
+
+        cuefile = Cuefile(config=config)
+        tagging = Tagging(config=config)
+        cuefile.select_cuefile(album_dir)
+        if cuefile.mode == 1:
+            album_tags = tagging.get_album_tags_from_dir(album_dir)
+        else:
+            album_tags = tagging.get_album_tags_from_cuefile(cuefile)
+            cuefile.extract_single_lossless_file()
+            cuefile.extract_track_indexes()
+        codec = Codec(config=config)
+        codec.decode_input_files(album_tags, cuefile)
+        return album_tags, codec
+
+    def _run_stage(self, stage, cmds):
+        from scheduler import Scheduler
+        scheduler = Scheduler(self.args.jobs, show_progress=False)
+        jobs = [scheduler.submit('{} {}'.format(stage, n_cmd), cmd) for n_cmd, cmd in enumerate(cmds, 1)]
+        start_time = time.monotonic()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            failed_jobs = scheduler.run()
+        wall = time.monotonic() - start_time
+        if len(failed_jobs) > 0:
+            for job in failed_jobs:
+                print('{} failed with exit code {}'.format(job.name, job.returncode))
+                print(job.stderr.decode('utf-8', errors='replace'), end='')
+            exit(-1)
+        peak_rss = max((self._maxrss_kb(rusage) for job in jobs for rusage in job.rusages), default=0)
+        return wall, peak_rss
+
+
+def parser():
+    parser = argparse.ArgumentParser(description='benchmarks lossless2lossy on synthetic albums')
+    parser.add_argument('-w', '--workdir', type=str, default='bench-work',
+                        help='where albums, outputs and the toolchain cache go (default: bench-work)')
+    parser.add_argument('--stub', action='store_true',
+                        help='runs fake ffmpeg/atomicparsley that only copy data, to measure the overhead alone')
+    parser.add_argument('-f', '--formats', type=str, default=','.join(formats),
+                        help='comma separated lossless formats among {}'.format(', '.join(formats)))
+    parser.add_argument('-l', '--layouts', type=str, default=','.join(layouts),
+                        help='comma separated album layouts among {}'.format(', '.join(layouts)))
+    parser.add_argument('-t', '--tracks', type=int, default=8, help='tracks per album (default: 8)')
+    parser.add_argument('-s', '--seconds', type=int, default=30, help='length of each track (default: 30)')
+    parser.add_argument('--signal', type=str, choices=['sine', 'noise'], default='noise',
+                        help='content of the tracks, noise being the worst case of lossless codecs (default: noise)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='concurrent jobs (default: core count)')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='runs of each measurement (default: 3)')
+    parser.add_argument('--json', type=str, help='also writes the results to the given json file')
+    parser.add_argument('--keep', action='store_true', help='keeps the converted files')
+    parser.add_argument('extra', nargs=argparse.REMAINDER,
+                        help='options passed on to lossless2lossy.py, after --')
+    args = parser.parse_args()
+    args.extra = [arg for arg in args.extra if arg != '--']
+    for file_format in args.formats.split(','):
+        if file_format not in formats:
+            parser.error('unknown format {}'.format(file_format))
+    for layout in args.layouts.split(','):
+        if layout not in layouts:
+            parser.error('unknown layout {}'.format(layout))
+    return args
+
+
+def main():
+    args = parser()
+    print('{:<7} {:<5} {:<11} {:>10} {:>10} {:>10} {:>10} {:>12}'.format(
+        'layout', 'fmt', 'stage', 'wall', 'tracks/s', 'realtime', 'peak rss', 'temp bytes'))
+    Benchmark(args).run()
+    return 0
+
+
+if __name__ == '__main__':
+    if os.path.basename(sys.argv[0]) in stub_tools:
+        exit(stub_main())
+    exit(main())
@@ -1,192 +1,1006 @@
 import os
+import struct
+import threading
+import subprocess
 import literals
+import manifest
+import metadata
+import loudness
+import mp4tags
+import planner
+
+from utility import subprocess_env
+from errors import AlbumError, ConfigError, CuefileError, TracksFailedError
+
+partial_suffix = '.partial'
+# the pcm analysed for the loudness is resampled to this rate when the one of the source is not known
+analysis_sample_rate = 48000
+# the encoders that only take 16 bit samples, a deeper source is dithered down for them
+s16_encoders = ('libfdk_aac',)
+# the tags an ffmpeg tagger writes, by their ffmpeg metadata key
+metadata_tags = (('title', literals.title), ('artist', literals.artist), ('album', literals.album),
+                 ('genre', literals.genre), ('date', literals.year), ('comment', literals.comment))
 
-from utility import subprocess_popen
 
 class Codec:
-    def __init__(self, config):
+    def __init__(self, config, scheduler=None, manifest=None, job_queue=None, journal=None):
         self.config = config
-        pass
+        # finished tracks are recorded in the journal, so that a resumed run skips them
+        self.journal = journal
+        # with a job queue the tracks are queued for the workers instead of being submitted
+        self.job_queue = job_queue
+        self.n_queued_tracks = 0
+        # several albums can share one scheduler, and so one worker budget
+        if scheduler is None:
+            scheduler = config.scheduler()
+        self.scheduler = scheduler
+        self.manifest = manifest
+        self.failed_tracks = set()
+        self.up_to_date_tracks = set()
+        # sizes of the temp files removed so far, appended from the cleanup jobs
+        self.temp_file_sizes = list()
+        self.album_tags = dict()
+        # last submitted jobs of each track: the conversion shared by its targets, then one per retagged target
+        self.track_jobs = dict()
+        # output directory of the album for each target
+        self.dir_names = dict()
+        # decode steps are only submitted for the tracks that actually need converting
+        self.decode_cmds = dict()
+        self.split_cmd = None
+        self.split_source = None
+        self.split_job = None
+        # the source directory of the album, it labels the jobs of the album in the run report
+        self.album_dir = None
+        # with --loudness: the meter and the encode of each converted track, and the tracks whose gains are
+        # written once every encode of the album is over
+        self.meters = dict()
+        self.encode_jobs = dict()
+        self.pending_gains = dict()
+        self.loudness_lock = threading.Lock()
+        # the album gain needs every track of the album, a worker only converts some of them
+        self.album_gain = True
+        # estimated cost of each converted track, it decides the order the tracks start in
+        self.estimates = dict()
+        # the cover of the album, read once for the mp4 files retagged in process
+        self.cover_data = None
 
     def decode_input_files(self, tag_dict, cuefile_object):
         config = self.config
 
-        if config.single_lossless_file and cuefile_object.cuefile is not None:
+        if cuefile_object.cuefile is not None:
+            self.album_dir = os.path.dirname(os.path.abspath(cuefile_object.cuefile))
+        elif 1 in tag_dict and len(tag_dict[1]) > 0:
+            self.album_dir = os.path.dirname(next(iter(tag_dict[1].values()))[literals.losslessfile])
+
+        if config.single_lossless_file and cuefile_object.cuefile is not None and config.splitter is not None:
             print('A single lossless file was found! Splitting it...')
 
             cuefile = cuefile_object.cuefile
             decode_cmd = config.decode_tools[config.splitter].copy()
+            self.split_source = os.path.join(os.path.dirname(os.path.abspath(cuefile)),
+                                             config.single_lossless_file_name)
+            split_dir = self._move_temp_files_to_scratch(tag_dict, rename=False)
 
             if config.splitter == literals.shntool:
                 decode_cmd.append('-f')
                 decode_cmd.append(cuefile)
                 decode_cmd.append('-d')
-                decode_cmd.append('.')
-                decode_cmd.append(config.single_lossless_file_name)
-
-            piped_subprocess = subprocess_popen(decode_cmd)
-            stdout_data, stderr_data = piped_subprocess.communicate()
-            if piped_subprocess.returncode != 0:
-                print('splitting failed with exit code {}'.format(piped_subprocess.returncode))
-                if stderr_data:
-                    print(stderr_data.decode('utf-8', errors='replace'), end='')
-                if stdout_data and not (stderr_data and stderr_data.strip()):
-                    print(stdout_data.decode('utf-8', errors='replace'), end='')
-                exit(-1)
-        elif 1 not in tag_dict:
-            print('No files containing tags found! Leaving decode function...')
-            exit(-1)
-        else:
-            print('The referenced cuefile contains multiple files. Converting one by one...')
+                decode_cmd.append(split_dir)
+                decode_cmd.append(self.split_source)
 
-            piped_subprocess = list()
-
-            for disc in tag_dict:
-                for n_track, track in tag_dict[disc].items():
-                    try:
-                        losslessfile = track[literals.losslessfile]
-                    except KeyError as key_error:
-                        print('the tag dict does not contain a losslessfile field in each track...')
-                        raise key_error
-
-                    infile = track[literals.infile]
-                    print('converting {} to {}'.format(os.path.basename(losslessfile), os.path.basename(infile)))
-
-                    decode_cmd = config.decode_tools[config.decoder].copy()
-                    if config.decoder == literals.ffmpeg:
-                        decode_cmd.append('-i')
-                        decode_cmd.append(losslessfile)
-                        decode_cmd.append('-y')
-                        decode_cmd.append(infile)
-
-                    piped_subprocess.append(subprocess_popen(decode_cmd))
+            self.split_cmd = decode_cmd
+            return
+        elif 1 not in tag_dict:
+            raise AlbumError('No files containing tags found! Leaving decode function...')
 
-            for process in piped_subprocess:
-                process.wait()
+        if config.single_lossless_file and cuefile_object.cuefile is not None:
+            print('A single lossless file was found! Every track is read from its own range...')
+            self._assign_track_ranges(tag_dict, cuefile_object)
 
-    def convert_files(self, album_tags):
+        if config.stream != literals.stream_wav:
+            print('Streaming every file straight into the encoder, no intermediate wav files...')
+        else:
+            print('Decoding every track to a temp wav file...')
+            self._plan_decodes(tag_dict)
+
+    def _plan_decodes(self, tag_dict):
+        self._move_temp_files_to_scratch(tag_dict)
+
+        for disc in tag_dict:
+            for n_track, track in tag_dict[disc].items():
+                try:
+                    losslessfile = track[literals.losslessfile]
+                except KeyError as key_error:
+                    print('the tag dict does not contain a losslessfile field in each track...')
+                    raise key_error
+
+                infile = track[literals.infile]
+                print('converting {} to {}'.format(os.path.basename(losslessfile), os.path.basename(infile)))
+
+                self.decode_cmds[(disc, n_track)] = self._compose_decoder_cmd(losslessfile, infile, track)
+
+    def _move_temp_files_to_scratch(self, tag_dict, rename=True):
+        # the intermediate wav files go to the scratch directory, never next to the sources; the splitter
+        # chooses its own names, otherwise the tracks of different discs may share one
+        scratch = self.config.scratch
+        album_scratch = scratch.album_dir([self._estimate_pcm_bytes(tags) for disc in tag_dict
+                                           for tags in tag_dict[disc].values()], create=not self.config.dry_run)
+        self.scheduler.space_budget = scratch.budget
+        for disc in tag_dict:
+            for tags in tag_dict[disc].values():
+                name = os.path.basename(tags[literals.infile])
+                if rename and len(tag_dict) > 1:
+                    name = 'disc{:02d}-{}'.format(disc, name)
+                tags[literals.infile] = os.path.join(album_scratch, name)
+        return album_scratch
+
+    def _estimate_pcm_bytes(self, tags):
+        # size of the wav file a track decodes to, 0 when it cannot be told
+        stream_info = tags.get(literals.stream_info)
+        duration = tags.get(literals.duration)
+        if stream_info is None or duration is None:
+            return 0
+        sample_rate = stream_info[metadata.sample_rate]
+        sample_bytes = (stream_info[metadata.bits] + 7) // 8
+        if literals.losslessfile in tags:
+            # written by the decoder, at the rate and the bits of the decode stage
+            sample_rate = self._decode_rate(tags) or sample_rate
+            sample_bytes = self._decode_bits(tags) // 8
+        return int(duration * sample_rate * stream_info[metadata.channels] * sample_bytes) + 44
+
+    def _assign_track_ranges(self, tag_dict, cuefile_object):
+        track_indexes = cuefile_object.track_indexes
+        for n_track, tags in tag_dict[1].items():
+            if n_track not in track_indexes:
+                raise CuefileError('malformed cuefile: track {} has no INDEX 01'.format(n_track))
+            tags[literals.losslessfile] = cuefile_object.lossless_file
+            tags[literals.start] = track_indexes[n_track]
+            tags[literals.end] = track_indexes.get(n_track + 1)
+
+    def convert_files(self, album_tags, album_subdir=None, out_root=None):
+        # every target gets the album in album_subdir of its own root, which derives from out_root
         config = self.config
 
         if 1 not in album_tags:
-            print('No files containing tags found! Leaving convert function...')
-            exit(-1)
-
-        if config.args.path is not None and os.path.isdir(os.path.expanduser(config.args.path)):
-            dir_name = os.path.expanduser(config.args.path)
-        else:
-            dir_name = os.getcwd()
-
-        global_album = album_tags[1][1][literals.album]
-        dir_name = os.path.join(dir_name, global_album)
-        try:
-            os.stat(dir_name)
-        except:
-            os.mkdir(dir_name)
+            raise AlbumError('No files containing tags found! Leaving convert function...')
+
+        if out_root is None:
+            if config.args.path is not None and os.path.isdir(os.path.expanduser(config.args.path)):
+                # absolute, the queued tracks are converted by workers in other directories
+                out_root = os.path.realpath(os.path.expanduser(config.args.path))
+            else:
+                out_root = os.getcwd()
+        if album_subdir is None:
+            album_subdir = album_tags[1][1][literals.album]
+        for target in config.targets:
+            self.dir_names[target] = os.path.join(target.root(out_root), album_subdir)
+            if config.dry_run:
+                continue
+            os.makedirs(self.dir_names[target], exist_ok=True)
+            if self.job_queue is None:
+                self._remove_partial_files(self.dir_names[target])
+        self.album_tags = album_tags
+
+        # the cover is prepared once, every track is tagged with the same file; a dry run leaves the cache alone
+        lossless_files = [tags.get(literals.losslessfile, self.split_source) for tracktags in album_tags.values()
+                          for tags in tracktags.values()]
+        cover = ''
+        if not config.dry_run:
+            cover = config.cover_art.album_cover(self.album_dir, [source for source in lossless_files if source],
+                                                 config.args.cover)
+        if self.job_queue is not None and cover != '':
+            self.job_queue.add_cover(cover)
+        for tracktags in album_tags.values():
+            for tags in tracktags.values():
+                tags[literals.cover] = cover
 
         n_discs = len(album_tags)
-        tagging_subprocess = list()
-        converting_subprocess = list()
         print()
         for disc, tracktags in album_tags.items():
             n_tracks = len(tracktags)
             for track, tags in tracktags.items():
-                print('converting track {}/{} of disc {}/{}...cmd line is'.format(track, n_tracks, disc, n_discs))
-
-                converter_cmd = self._compose_converter_cmd(tags, dir_name)
-                output_cmd = ''
-                for param in converter_cmd:
-                    output_cmd += param + ' '
-                print(output_cmd)
-
-                converting_subprocess.append(subprocess_popen(converter_cmd))
+                position = (track, n_tracks, disc, n_discs)
+                statuses = dict()
+                for target in config.targets:
+                    statuses[target] = manifest.convert
+                    if self.journal is not None and self.journal.finished(
+                            self._outfile(tags, self.dir_names[target], target)):
+                        statuses[target] = manifest.up_to_date
+                    elif self.manifest is not None:
+                        statuses[target] = self.manifest.status(*self._manifest_entry(tags, position, target))
+                    if config.retag_only:
+                        statuses[target] = self._retag_only_status(tags, position, target, statuses[target])
+                    if statuses[target] == manifest.retag:
+                        statuses[target] = self._retag_status(tags, target)
+
+                # the targets that need converting share one decode, the others are at most retagged
+                converted_targets = [target for target in config.targets if statuses[target] == manifest.convert]
+                retagged_targets = [target for target in config.targets if statuses[target] == manifest.retag]
+                if len(converted_targets) == 0 and len(retagged_targets) == 0:
+                    print('track {}/{} of disc {}/{} {}'.format(track, n_tracks, disc, n_discs,
+                                                                'has nothing to retag' if config.retag_only
+                                                                else 'is up to date'))
+                    self.up_to_date_tracks.add((disc, track))
+                    continue
+
+                if self.job_queue is not None:
+                    self.job_queue.put(self.album_dir, disc, track,
+                                       self._queued_track(tags, position, converted_targets, retagged_targets))
+                    self.n_queued_tracks += 1
+                    continue
+
+                self.track_jobs[(disc, track)] = list()
+                if len(converted_targets) > 0:
+                    self.track_jobs[(disc, track)].append(self._submit_conversion(tags, position, converted_targets))
+                for target in retagged_targets:
+                    self.track_jobs[(disc, track)].append(self._submit_retag(tags, position, target))
+                print()
+        self._submit_gains()
+        if self.job_queue is not None:
+            # the workers see the album as a whole
+            self.job_queue.commit()
+
+    def _retag_only_status(self, tags, position, target, status):
+        # with --retag-only an output is retagged, whatever changed in its source, and never converted
+        track, n_tracks, disc, n_discs = position
+        if status == manifest.up_to_date:
+            return status
+        if not os.path.isfile(self._outfile(tags, self.dir_names[target], target)):
+            print('track {}/{} of disc {}/{} has no {} output to retag'.format(track, n_tracks, disc, n_discs,
+                                                                                target.name))
+            return manifest.up_to_date
+        return manifest.retag
+
+    def _retag_status(self, tags, target):
+        # a retag that cannot keep the output as it is becomes a conversion
+        outfile = self._outfile(tags, self.dir_names[target], target)
+        if target.extension == '.m4a':
+            try:
+                mp4tags.check(outfile)
+            except (OSError, ValueError) as error:
+                print('warning: cannot retag {} in place ({}), converting it again'.format(outfile, error))
+                return manifest.convert
+        # the gains are only measured while encoding: a remux keeps the ones the output has, one without any
+        # is converted to get them
+        elif self.config.loudness and len(self._stored_gains(outfile)) == 0:
+            return manifest.convert
+        return manifest.retag
+
+    def _stored_gains(self, outfile):
+        # the gains an earlier --loudness run wrote to an opus output
+        try:
+            comments = metadata.MetadataReader(outfile).read_comments()
+        except (OSError, ValueError, IndexError, struct.error):
+            return dict()
+        return { name: comments[name].decode('utf-8', errors='replace') for name in loudness.opus_gain_tags
+                 if name in comments }
+
+    def _queued_track(self, tags, position, converted_targets, retagged_targets):
+        # everything a worker needs to convert the track on its own, as json
+        return { 'album_dir': self.album_dir, 'split_source': self.split_source, 'tags': tags, 'position': position,
+                 'dir_names': { target.name: dir_name for target, dir_name in self.dir_names.items() },
+                 'convert': [target.name for target in converted_targets],
+                 'retag': [target.name for target in retagged_targets] }
+
+    def submit_queued_track(self, queued_track):
+        # the worker side of _queued_track: the track gets the same jobs as in a local run
+        config = self.config
+        targets = { target.name: target for target in config.targets }
+        tags = queued_track['tags']
+        position = tuple(queued_track['position'])
+        track, n_tracks, disc, n_discs = position
+        self.album_dir = queued_track['album_dir']
+        self.split_source = queued_track['split_source']
+        self.dir_names = { targets[name]: dir_name for name, dir_name in queued_track['dir_names'].items() }
+        for dir_name in self.dir_names.values():
+            os.makedirs(dir_name, exist_ok=True)
+        self.album_tags = { disc: { track: tags } }
+        self.album_gain = False
+
+        converted_targets = [targets[name] for name in queued_track['convert']]
+        if len(converted_targets) > 0 and self._uses_temp_file(tags):
+            # the intermediate wav goes to the scratch directory of this worker
+            self._plan_decodes(self.album_tags)
+        self.track_jobs[(disc, track)] = list()
+        if len(converted_targets) > 0:
+            self.track_jobs[(disc, track)].append(self._submit_conversion(tags, position, converted_targets))
+        for name in queued_track['retag']:
+            self.track_jobs[(disc, track)].append(self._submit_retag(tags, position, targets[name]))
+        self._submit_gains()
+
+    def _outfile(self, tags, dir_name, target):
+        return os.path.join(dir_name, os.path.splitext(tags[literals.outfile])[0] + target.extension)
+
+    def _partial_file(self, outfile):
+        # hidden, and with the extension that tells the encoder the container
+        dir_name, file_name = os.path.split(outfile)
+        name, ext = os.path.splitext(file_name)
+        return os.path.join(dir_name, '.' + name + partial_suffix + ext)
+
+    def _remove_partial_files(self, dir_name):
+        # left over by a run that crashed, their tracks are converted again
+        for file_name in os.listdir(dir_name):
+            if file_name.startswith('.') and partial_suffix + '.' in file_name:
+                os.remove(os.path.join(dir_name, file_name))
+
+    def _commit_func(self, tags, targets, renamed=True):
+        # the outputs only get their final name once encoded and tagged, a partial file is never taken for one
+        def commit():
+            outfiles = [self._outfile(tags, self.dir_names[target], target) for target in targets]
+            if renamed:
+                for outfile in outfiles:
+                    os.replace(self._partial_file(outfile), outfile)
+            if self.journal is not None:
+                self.journal.record(outfiles)
+        return commit
+
+    def _manifest_entry(self, tags, position, target):
+        dir_name = self.dir_names[target]
+        outfile = self._outfile(tags, dir_name, target)
+        source = tags.get(literals.losslessfile, self.split_source)
+        # the encoder command without any tag, so that a tag change only leads to a retag
+        encoder_cmd = self._compose_converter_cmd(tags, [(target, dir_name)], source)
+        track_tags = dict()
+        for tag in (literals.title, literals.artist, literals.album, literals.genre, literals.year, literals.comment,
+                    literals.cover):
+            track_tags[tag] = tags[tag]
+        track_tags['position'] = position
+        track_tags['disc_override'] = self._compose_disc_tag(position[2], position[3], tags)
+        return outfile, source, encoder_cmd, track_tags
+
+    def _record_func(self, tags, position, targets):
+        def record():
+            for target in targets:
+                self.manifest.record(*self._manifest_entry(tags, position, target))
+        return record
+
+    def _submit_conversion(self, tags, position, targets):
+        # returns the last job of the track, or the last one before its gains are written
+        scheduler = self.scheduler
+        track, n_tracks, disc, n_discs = position
+
+        estimate = self._estimate_track(tags, position, targets)
+        self.estimates[(disc, track)] = estimate
+        previous_job = None
+        if self.split_cmd is not None:
+            if self.split_job is None:
+                # every track is written at once
+                split_bytes = sum(self._estimate_pcm_bytes(disc_tags) for disc in self.album_tags
+                                  for disc_tags in self.album_tags[disc].values())
+                self.split_job = scheduler.submit('splitting', self.split_cmd, (self.album_dir, None, None),
+                                                  stage='split', reserve=split_bytes)
+            previous_job = self.split_job
+        if (disc, track) in self.decode_cmds:
+            previous_job = scheduler.submit('decoding track {}/{} of disc {}/{}'.format(track, n_tracks, disc, n_discs),
+                                            self.decode_cmds[(disc, track)], (self.album_dir, disc, track), [previous_job],
+                                            stage='decode', reserve=self._estimate_pcm_bytes(tags),
+                                            priority=estimate.cpu_seconds)
+
+        print('converting track {}/{} of disc {}/{} to {}...cmd line is'.format(
+            track, n_tracks, disc, n_discs, ', '.join(target.name for target in targets)))
+
+        outputs = [(target, self.dir_names[target]) for target in targets]
+        meter = self._create_meter(tags, targets)
+        if meter is not None:
+            self.meters[(disc, track)] = meter
+        converter_cmd = self._compose_stream_cmd(tags, outputs, position)
+        output_cmd = ''
+        for param in converter_cmd:
+            if isinstance(param, list):
+                output_cmd += '| ' if output_cmd != '' else ''
+                for pipe_param in param:
+                    output_cmd += pipe_param + ' '
+            else:
+                output_cmd += param + ' '
+        print(output_cmd)
+
+        meter = self.meters.get((disc, track))
+        job = scheduler.submit('converting track {}/{} of disc {}/{}'.format(track, n_tracks, disc, n_discs),
+                               converter_cmd, (self.album_dir, disc, track), [previous_job], tags.get(literals.duration),
+                               stage='encode', on_stdout=self._analysis_callback((disc, track), meter),
+                               priority=estimate.cpu_seconds)
+        self.encode_jobs[(disc, track)] = job
+
+        if self._uses_temp_file(tags):
+            job = scheduler.submit('cleaning up temp file of track {}/{} of disc {}/{}'.format(
+                track, n_tracks, disc, n_discs), self._cleanup_func(tags), (self.album_dir, disc, track), [job],
+                stage='cleanup', release=self._estimate_pcm_bytes(tags))
+
+        # ffmpeg has already tagged its targets while encoding
+        for target in targets:
+            if target.tagger != literals.ffmpeg:
+                job = self._submit_tagging(tags, position, target, job, partial=True)
+
+        if meter is not None:
+            self.pending_gains[(disc, track)] = (tags, position, targets, job)
+            return job
+        return self._submit_commit(tags, position, targets, job)
+
+    def _estimate_track(self, tags, position, targets):
+        track, n_tracks, disc, n_discs = position
+        name = 'track {}/{} of disc {}/{} of {}'.format(track, n_tracks, disc, n_discs, self.album_dir)
+        encoders = [self._encoder_name(target) for target in targets]
+        temp_bytes = self._estimate_pcm_bytes(tags) if self._uses_temp_file(tags) else 0
+        stream_info = tags.get(literals.stream_info)
+        rates = [None if stream_info is None else target.output_rate(stream_info[metadata.sample_rate])
+                 for target in targets]
+        return planner.estimate_track(self.config, name, tags, tags.get(literals.losslessfile, self.split_source),
+                                      encoders, [self._output_bitrate(target) for target in targets], temp_bytes,
+                                      rates)
+
+    def _encoder_name(self, target):
+        # the ffmpeg encoder of a target, or the tool that encodes it
+        if target.encoder == literals.afconvert:
+            return literals.afconvert
+        return self.config.aac_encoder if target.encoder == literals.ffmpeg else 'libopus'
+
+    def _output_bitrate(self, target):
+        # bits per second of the output of a target, see _append_codec_to_cmd
+        if target.encoder == literals.ffmpeg and self.config.aac_encoder == 'libfdk_aac' and \
+                (target.quality is not None or target.bitrate is None):
+            return planner.vbr_bitrates.get('5' if target.quality is None else target.quality)
+        return planner.parse_bitrate(self._compose_bitrate(target))
+
+    def _submit_commit(self, tags, position, targets, job):
+        scheduler = self.scheduler
+        track, n_tracks, disc, n_discs = position
+        job = scheduler.submit('finishing track {}/{} of disc {}/{}'.format(track, n_tracks, disc, n_discs),
+                               self._commit_func(tags, targets), (self.album_dir, disc, track), [job], stage='commit')
+
+        if self.manifest is not None:
+            job = scheduler.submit('recording track {}/{} of disc {}/{}'.format(track, n_tracks, disc, n_discs),
+                                   self._record_func(tags, position, targets), (self.album_dir, disc, track), [job],
+                                   stage='record')
+        return job
+
+    def _submit_gains(self):
+        # the gains of a track are written once every encode of the album is over, successful or not, so that
+        # the album gain is known; then the track is finished as usual
+        encode_jobs = list(self.encode_jobs.values())
+        for key, (tags, position, targets, job) in self.pending_gains.items():
+            track, n_tracks, disc, n_discs = position
+            job = self.scheduler.submit('writing the gains of track {}/{} of disc {}/{}'.format(
+                track, n_tracks, disc, n_discs), self._gains_func(tags, key, targets), (self.album_dir, disc, track),
+                [job], stage='gain', wait_for=encode_jobs)
+            self.track_jobs[key][0] = self._submit_commit(tags, position, targets, job)
+        self.pending_gains = dict()
+
+    def _create_meter(self, tags, targets):
+        stream_info = tags.get(literals.stream_info)
+        if not self.config.loudness or not all(target.encoder in self.config.stdin_encoders for target in targets):
+            return None
+        if stream_info is None:
+            return loudness.LoudnessMeter(analysis_sample_rate, 2, loudness.analysis_executor())
+        # the encoder reads the track at the rate of the decode stage
+        return loudness.LoudnessMeter(self._decode_rate(tags) or stream_info[metadata.sample_rate],
+                                      stream_info[metadata.channels], loudness.analysis_executor())
+
+    def _analysis_callback(self, key, meter):
+        # runs on the event loop with every chunk of pcm the encoder writes: the meter only gathers it, the
+        # batches are analysed in the loudness executor while the loop goes on reading the other pipes
+        if meter is None:
+            return None
+
+        def on_stdout(data):
+            if self.meters.get(key) is None:
+                return
+            try:
+                meter.feed(data)
+            except Exception as exception:
+                print('warning: cannot measure the loudness of track {} of disc {}: {}'.format(key[1], key[0],
+                                                                                             exception))
+                self.meters[key] = None
+        return on_stdout
+
+    def _measured_loudness(self, key):
+        # the loudness of a track whose encode went through, None otherwise
+        meter = self.meters.get(key)
+        job = self.encode_jobs.get(key)
+        if meter is None or job is None or job.returncode != 0:
+            return None
+        try:
+            meter.flush()
+        except Exception as exception:
+            print('warning: cannot measure the loudness of track {} of disc {}: {}'.format(key[1], key[0], exception))
+            self.meters[key] = None
+            return None
+        return meter.loudness
+
+    def _album_loudness(self):
+        if not self.album_gain:
+            return None
+        album_loudness = loudness.Loudness()
+        for disc, tracktags in self.album_tags.items():
+            for track in tracktags:
+                track_loudness = self._measured_loudness((disc, track))
+                if track_loudness is None:
+                    return None
+                album_loudness += track_loudness
+        return album_loudness
+
+    def _gains_func(self, tags, key, targets):
+        def write_gains():
+            with self.loudness_lock:
+                track_loudness = self._measured_loudness(key)
+                album_loudness = self._album_loudness()
+            if track_loudness is None:
+                return
+            for target in targets:
+                gain_tags = loudness.gain_tags(target.extension, track_loudness, album_loudness)
+                if len(gain_tags) == 0:
+                    continue
+                partial_file = self._partial_file(self._outfile(tags, self.dir_names[target], target))
+                if target.extension == '.m4a':
+                    mp4tags.write_tags(partial_file, freeform_tags=gain_tags)
+                else:
+                    self._remux_with_tags(partial_file, gain_tags)
+        return write_gains
+
+    def _remux_with_tags(self, partial_file, gain_tags):
+        # ffmpeg cannot tag in place: the audio and the tags it has are remuxed untouched, with the gains added
+        name, ext = os.path.splitext(partial_file)
+        remuxed_file = name + '.gain' + ext
+        remux_cmd = self.config.other_tools[literals.ffmpeg].copy()
+        remux_cmd.extend(['-i', partial_file, '-map', '0', '-c', 'copy', '-map_metadata', '0'])
+        for key, value in gain_tags.items():
+            remux_cmd.append('-metadata')
+            remux_cmd.append(key + '=' + value)
+        remux_cmd.append('-y')
+        remux_cmd.append(remuxed_file)
+        result = subprocess.run(remux_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                env=subprocess_env())
+        if result.returncode != 0:
+            if os.path.exists(remuxed_file):
+                os.remove(remuxed_file)
+            raise OSError('cannot write the gains: ' + result.stderr.decode('utf-8', errors='replace').strip())
+        os.replace(remuxed_file, partial_file)
+
+    def _submit_tagging(self, tags, position, target, previous_job, partial=False):
+        track, n_tracks, disc, n_discs = position
+        print('taggin track track {}/{} of disc {}/{}...'.format(track, n_tracks, disc, n_discs))
+
+        tagger_cmd = self._compose_tagger_cmd(track, n_tracks, disc, n_discs, tags, self.dir_names[target], target,
+                                              partial)
+        output_cmd = ''
+        for param in tagger_cmd:
+            output_cmd += param + ' '
+        print(output_cmd)
+        return self.scheduler.submit('tagging track {}/{} of disc {}/{}'.format(track, n_tracks, disc, n_discs),
+                                     tagger_cmd, (self.album_dir, disc, track), [previous_job], stage='tag')
+
+    def _submit_retag(self, tags, position, target):
+        # returns the last job of the retag
+        scheduler = self.scheduler
+        track, n_tracks, disc, n_discs = position
+
+        print('retagging track {}/{} of disc {}/{}...'.format(track, n_tracks, disc, n_discs))
+        if target.extension == '.m4a':
+            # written in process, whatever the tagger of the target: only moov is rewritten, the audio stays where
+            # it is and the items no tagger writes (the gains among them) are kept
+            job = scheduler.submit('retagging track {}/{} of disc {}/{}'.format(track, n_tracks, disc, n_discs),
+                                   self._retag_func(tags, position, target), (self.album_dir, disc, track),
+                                   stage='retag')
+            job = scheduler.submit('recording retag of track {}/{} of disc {}/{}'.format(track, n_tracks, disc,
+                                                                                       n_discs),
+                                   self._commit_func(tags, [target], renamed=False), (self.album_dir, disc, track),
+                                   [job], stage='commit')
+        else:
+            # ffmpeg cannot tag in place: remux the audio untouched with the new tags, and the gains the output
+            # has, and swap the files
+            outfile = self._outfile(tags, self.dir_names[target], target)
+            retag_cmd = self._compose_retag_cmd(tags, outfile, self._partial_file(outfile), position, target,
+                                                self._stored_gains(outfile))
+            job = scheduler.submit('retagging track {}/{} of disc {}/{}'.format(track, n_tracks, disc, n_discs),
+                                   retag_cmd, (self.album_dir, disc, track), stage='retag')
+            job = scheduler.submit('replacing track {}/{} of disc {}/{}'.format(track, n_tracks, disc, n_discs),
+                                   self._commit_func(tags, [target]), (self.album_dir, disc, track), [job],
+                                   stage='commit')
+
+        # --retag-only retags without a manifest too
+        if self.manifest is None:
+            return job
+        return scheduler.submit('recording track {}/{} of disc {}/{}'.format(track, n_tracks, disc, n_discs),
+                                self._record_func(tags, position, [target]), (self.album_dir, disc, track), [job],
+                                stage='record')
+
+    def _retag_func(self, tags, position, target):
+        # the tags the tagger of the target writes, see _append_metadata_to_cmd and _compose_tagger_cmd
+        def retag():
+            track, n_tracks, disc, n_discs = position
+            disc_tag = self._compose_disc_tag(disc, n_discs, tags)
+            cover = None
+            if tags[literals.cover] != '' and (target.tagger == literals.atomicparsley or target.embeds_cover()):
+                cover = self._read_cover(tags[literals.cover])
+            items = mp4tags.track_items({ key: tags[tag] for key, tag in metadata_tags }, (track, n_tracks),
+                                        None if disc_tag is None else tuple(int(n) for n in disc_tag.split('/')),
+                                        cover)
+            mp4tags.write_tags(self._outfile(tags, self.dir_names[target], target), items)
+        return retag
+
+    def _read_cover(self, cover):
+        # every track of the album has the same cover, concurrent retags may read it twice at most
+        if self.cover_data is None or self.cover_data[0] != cover:
+            with open(cover, 'rb') as cover_file:
+                self.cover_data = (cover, cover_file.read())
+        return self.cover_data[1]
+
+    def run(self):
+        try:
+            self.scheduler.run()
+        except KeyboardInterrupt:
+            # the running children are already killed, only the temp files are left
+            self.collect_results()
+            raise
+        n_failed_tracks = self.collect_results()
+        if n_failed_tracks > 0:
+            message = '{} track(s) failed to convert'.format(n_failed_tracks)
+            if not self.config.keep_going:
+                message += '\nstopped after the first failed job, use --keep-going to convert the remaining tracks'
+            raise TracksFailedError(message, set(self.failed_tracks))
+
+    def outfiles(self):
+        # the outputs of the album that are converted or up to date, by target
+        outfiles = { target: list() for target in self.dir_names }
+        for disc, tracktags in self.album_tags.items():
+            for track, tags in tracktags.items():
+                if (disc, track) not in self.failed_tracks:
+                    for target, dir_name in self.dir_names.items():
+                        outfiles[target].append(self._outfile(tags, dir_name, target))
+        return outfiles
 
-        for convert_subprocess in converting_subprocess:
-            convert_subprocess.wait()
+    def collect_results(self):
+        config = self.config
 
-        print()
-        for disc, tracktags in album_tags.items():
-            n_tracks = len(tracktags)
+        for disc, tracktags in self.album_tags.items():
             for track, tags in tracktags.items():
-                print('cleaning up temp file...')
-                os.remove(tags[literals.infile])
-
-                print('taggin track track {}/{} of disc {}/{}...'.format(track, n_tracks, disc, n_discs))
-
-                tagger_cmd = self._compose_tagger_cmd(track, n_tracks, disc, n_discs, tags, dir_name)
-                output_cmd = ''
-                for param in tagger_cmd:
-                    output_cmd += param + ' '
-                print(output_cmd)
-                tagging_subprocess.append(subprocess_popen(tagger_cmd))
-
-        for tagging_subproc in tagging_subprocess:
-            tagging_subproc.wait()
-
-        if config.args.cover is not None and config.tagger == literals.atomicparsley:
-            cover_filename, cover_ext = os.path.splitext(config.args.cover)
-            cover_residue = os.path.basename(cover_filename + '-resized')
-            for filename in os.listdir(os.getcwd()):
-                if filename.startswith(cover_residue) and (filename.endswith('.jpeg') or \
-                                                           filename.endswith('.jpg') or \
-                                                           filename.endswith('.png') or filename.endswith(cover_ext)):
-                    os.remove(filename)
-
-    def _compose_converter_cmd(self, tags, dir_name):
+                # temp files of tracks that did not make it to their cleanup step
+                if self._uses_temp_file(tags) and os.path.exists(tags[literals.infile]):
+                    self._remove_temp_file(tags[literals.infile])
+                if (disc, track) in self.up_to_date_tracks:
+                    continue
+                jobs = self.track_jobs.get((disc, track))
+                if jobs is None or any(job.failed() or job.returncode is None for job in jobs):
+                    self.failed_tracks.add((disc, track))
+                    # a failed or interrupted track leaves no output behind, not even a partial one
+                    for target, dir_name in self.dir_names.items():
+                        partial_file = self._partial_file(self._outfile(tags, dir_name, target))
+                        if os.path.exists(partial_file):
+                            os.remove(partial_file)
+
+        return len(self.failed_tracks)
+
+    def temp_bytes(self):
+        return sum(self.temp_file_sizes)
+
+    def _remove_temp_file(self, temp_file):
+        self.temp_file_sizes.append(os.path.getsize(temp_file))
+        os.remove(temp_file)
+
+    def _cleanup_func(self, tags):
+        def cleanup():
+            print('cleaning up temp file {}...'.format(tags[literals.infile]))
+            self._remove_temp_file(tags[literals.infile])
+        return cleanup
+
+    def _uses_temp_file(self, tags):
+        # tracks split out of a single lossless file always come from a temp wav
+        if literals.losslessfile not in tags:
+            return True
+        return self.config.stream == literals.stream_wav and tags[literals.infile] != tags[literals.losslessfile]
+
+    def _frames_to_seconds(self, frames):
+        # cd frames are 1/75 s: rounding to the microsecond keeps the position exact at the sample level
+        microseconds = (frames * 1000000 * 2 + 75) // 150
+        return '{}.{:06d}'.format(microseconds // 1000000, microseconds % 1000000)
+
+    def _append_input_to_cmd(self, cmd, infile, tags):
+        # seek close to the track, it is then cut out by _append_trim_to_cmd
+        if literals.start in tags and infile == tags[literals.losslessfile] and tags[literals.start] > 0:
+            cmd.append('-copyts')
+            cmd.append('-ss')
+            cmd.append(self._frames_to_seconds(tags[literals.start]))
+        cmd.append('-i')
+        cmd.append(infile)
+
+    def _append_trim_to_cmd(self, cmd, infile, tags, filters=()):
+        # filters follow the trim in the same filter chain, an output only takes one
+        filters = list(filters)
+        if literals.start in tags and infile == tags[literals.losslessfile]:
+            # atrim works on the original timestamps, which is sample accurate whatever the frame size of
+            # the lossless codec
+            atrim = 'atrim=start=' + self._frames_to_seconds(tags[literals.start])
+            if tags[literals.end] is not None:
+                atrim += ':end=' + self._frames_to_seconds(tags[literals.end])
+            filters.insert(0, atrim + ',asetpts=PTS-STARTPTS')
+        if len(filters) > 0:
+            cmd.append('-af')
+            cmd.append(','.join(filters))
+
+    def _decoded_separately(self, tags):
+        # the track goes through a decoder of its own, which writes wav
+        if literals.losslessfile not in tags or self.config.stream == literals.stream_single:
+            return False
+        return self.config.stream == literals.stream_pipe or self._uses_temp_file(tags)
+
+    def _output_rates(self, stream_info):
+        return set(target.output_rate(stream_info[metadata.sample_rate]) for target in self.config.targets)
+
+    def _decode_rate(self, tags):
+        # the rate a separate decode brings the track to, the one every target is encoded at; None when the
+        # track keeps the rate of its source, or when the targets differ and each one resamples it once itself
+        stream_info = tags.get(literals.stream_info)
+        if stream_info is None or not self._decoded_separately(tags):
+            return None
+        rates = self._output_rates(stream_info)
+        if len(rates) > 1:
+            return None
+        rate = rates.pop()
+        return rate if rate != stream_info[metadata.sample_rate] else None
+
+    def _decode_bits(self, tags):
+        # the bits of the wav of a separate decode: 16 once the track is at the rate of every target, 24 for a
+        # deeper track whose targets differ, so that the dither comes after their own resample
+        stream_info = tags.get(literals.stream_info)
+        if stream_info is None or stream_info[metadata.bits] <= 16 or len(self._output_rates(stream_info)) == 1:
+            return 16
+        return 24
+
+    def _decode_filters(self, tags):
+        # a hi-res track is resampled once, in the decode stage, and dithered down to the 16 bits of the wav
+        stream_info = tags.get(literals.stream_info)
+        if stream_info is None:
+            return list()
+        rate = self._decode_rate(tags)
+        dither = None
+        if stream_info[metadata.bits] > 16 and self._decode_bits(tags) == 16:
+            dither = next((target.dither_method() for target in self.config.targets
+                           if target.dither_method() is not None), None)
+        if rate is None and dither is None:
+            return list()
+        return [self._resample_filter(rate, dither)]
+
+    def _encode_filters(self, tags, target):
+        # what is left to do for one target: its rate when the decode stage, or the source when the encoder
+        # decodes it, has another one, then the dither of the encoders that only take 16 bits
+        stream_info = tags.get(literals.stream_info)
+        if stream_info is None:
+            return list()
+        source_rate = stream_info[metadata.sample_rate]
+        input_rate = self._decode_rate(tags) or source_rate
+        input_bits = self._decode_bits(tags) if self._decoded_separately(tags) else stream_info[metadata.bits]
+        rate = target.output_rate(source_rate)
+        dither = None
+        if input_bits > 16 and self._encoder_name(target) in s16_encoders:
+            dither = target.dither_method()
+        if rate == input_rate and dither is None:
+            return list()
+        return [self._resample_filter(rate if rate != input_rate else None, dither)]
+
+    def _resample_filter(self, rate=None, dither=None):
+        # soxr when the ffmpeg build has it, otherwise swr with a longer filter than its default
+        options = ['resampler=' + self.config.resampler]
+        if self.config.resampler == 'soxr':
+            options.append('precision=28')
+        else:
+            options.append('filter_size=64')
+        if rate is not None:
+            options.append('osr={}'.format(rate))
+        if dither is not None:
+            options.append('osf=s16')
+            options.append('dither_method=' + dither)
+        return 'aresample=' + ':'.join(options)
+
+    def _embeds_cover(self, tags, position, target):
+        return position is not None and target.tagger == literals.ffmpeg and target.embeds_cover() and \
+            tags[literals.cover] != ''
+
+    def _append_cover_input_to_cmd(self, cmd, tags, position, targets):
+        if not any(self._embeds_cover(tags, position, target) for target in targets):
+            return False
+        cmd.append('-i')
+        cmd.append(tags[literals.cover])
+        return True
+
+    def _append_streams_to_cmd(self, cmd, has_cover):
+        if has_cover:
+            cmd.append('-map')
+            cmd.append('0:a')
+            cmd.append('-map')
+            cmd.append('1:v')
+            cmd.append('-c:v')
+            cmd.append('copy')
+            cmd.append('-disposition:v:0')
+            cmd.append('attached_pic')
+        else:
+            cmd.append('-vn')
+
+    def _append_metadata_to_cmd(self, cmd, tags, position, target):
+        if position is None or target.tagger != literals.ffmpeg:
+            return
+        track, n_tracks, disc, n_discs = position
+
+        self._append_option_to_cmd(cmd, '-metadata', 'track=' + str(track) + '/' + str(n_tracks))
+        for key, tag in metadata_tags:
+            if tags[tag] is not None and str(tags[tag]) != '':
+                self._append_option_to_cmd(cmd, '-metadata', key + '=' + str(tags[tag]))
+        disc_tag = self._compose_disc_tag(disc, n_discs, tags)
+        if disc_tag is not None:
+            self._append_option_to_cmd(cmd, '-metadata', 'disc=' + disc_tag)
+
+    def _compose_disc_tag(self, disc, n_discs, tags):
+        config = self.config
+        if literals.disc in tags:
+            # one disc of a set described by its own cue sheet
+            disc = tags[literals.disc]
+            n_discs = max(int(n_discs), int(tags[literals.disctotal]))
+        if int(n_discs) > 1 or (config.args.discs is not None and int(config.args.discs) > 1):
+            if config.args.disc is not None:
+                disc = config.args.disc
+            if config.args.discs is not None:
+                n_discs = config.args.discs
+            return str(disc) + '/' + str(n_discs)
+        return None
+
+    def _compose_decoder_cmd(self, losslessfile, outfile, tags):
         config = self.config
 
-        infile = tags[literals.infile]
-        outfile = os.path.join(dir_name, tags[literals.outfile])
+        decode_cmd = config.decode_tools[config.decoder].copy()
+        if config.decoder == literals.ffmpeg:
+            self._append_input_to_cmd(decode_cmd, losslessfile, tags)
+            self._append_trim_to_cmd(decode_cmd, losslessfile, tags, self._decode_filters(tags))
+            if self._decode_bits(tags) == 24:
+                decode_cmd.append('-c:a')
+                decode_cmd.append('pcm_s24le')
+            if outfile == '-':
+                decode_cmd.append('-vn')
+                decode_cmd.append('-f')
+                decode_cmd.append('wav')
+            else:
+                decode_cmd.append('-y')
+            decode_cmd.append(outfile)
+        else:
+            raise ConfigError('cannot decode a track with {}, only with {}'.format(config.decoder, literals.ffmpeg))
+        return decode_cmd
+
+    def _compose_stream_cmd(self, tags, outputs, position=None):
+        # the encoders write partial files, renamed once the track is complete
+        config = self.config
 
-        if config.args.bitrate is None:
-            bitrate = str(256000)
+        if self._uses_temp_file(tags):
+            return self._compose_converter_cmd(tags, outputs, position=position, partial=True)
+        losslessfile = tags[literals.losslessfile]
+        if config.stream == literals.stream_single:
+            return self._compose_converter_cmd(tags, outputs, losslessfile, position, partial=True)
+        elif config.stream == literals.stream_pipe:
+            decode_cmd = self._compose_decoder_cmd(losslessfile, '-', tags)
+            return [decode_cmd, self._compose_converter_cmd(tags, outputs, '-', position, partial=True)]
         else:
-            bitrate = config.args.bitrate
+            raise ConfigError('unknown stream {}, the streams are {}'.format(
+                config.stream, ', '.join((literals.stream_single, literals.stream_pipe, literals.stream_wav))))
 
-        if config.encoder == literals.afconvert:
-            encoder_cmd = config.encode_tools[config.encoder].copy()
+    def _compose_converter_cmd(self, tags, outputs, infile=None, position=None, partial=False):
+        # outputs is a list of (target, dir_name): the input is read and decoded once, then encoded for each
+        # target. position is (track, n_tracks, disc, n_discs): when given, the targets tagged by ffmpeg get
+        # their tags and cover from the encoder itself. partial writes to the partial files
+        config = self.config
+
+        if infile is None:
+            infile = tags[literals.infile]
+
+        if outputs[0][0].encoder == literals.afconvert:
+            if len(outputs) > 1:
+                raise ConfigError('{} encodes a single target, not {}'.format(
+                    literals.afconvert, ', '.join(target.name for target, _ in outputs)))
+            target, dir_name = outputs[0]
+            encoder_cmd = config.encode_tools[target.encoder].copy()
             encoder_cmd.append('-b')
-            encoder_cmd.append(bitrate)
-            encoder_cmd.append(infile)
-            encoder_cmd.append(outfile)
-        elif config.encoder == literals.ffmpeg:
-            encoder_cmd = config.encode_tools[config.encoder].copy()
-            encoder_cmd.append('-i')
-            encoder_cmd.append(infile)
-            encoder_cmd.append('-c:a')
-            encoder_cmd.append('libfdk_aac')
-            encoder_cmd.append('-vbr') # bitrate param is ignored!
-            encoder_cmd.append('5')
-            encoder_cmd.append('-y')
-            encoder_cmd.append(outfile)
-        elif config.encoder == literals.opus:
-            encoder_cmd = config.encode_tools[config.encoder].copy()
-            encoder_cmd.append('-i')
+            encoder_cmd.append(self._compose_bitrate(target))
             encoder_cmd.append(infile)
-            encoder_cmd.append('-c:a')
-            encoder_cmd.append('libopus')
-            encoder_cmd.append('-b:a')
-            encoder_cmd.append('256k')
-            encoder_cmd.append('-vbr')
-            encoder_cmd.append('on')
-            encoder_cmd.append('-compression_level')
-            encoder_cmd.append('10')
+            outfile = self._outfile(tags, dir_name, target)
+            encoder_cmd.append(self._partial_file(outfile) if partial else outfile)
+            return encoder_cmd
+
+        encoder_cmd = config.encode_tools[outputs[0][0].encoder].copy()
+        self._append_input_to_cmd(encoder_cmd, infile, tags)
+        has_cover = self._append_cover_input_to_cmd(encoder_cmd, tags, position, [target for target, _ in outputs])
+        for target, dir_name in outputs:
+            outfile = self._outfile(tags, dir_name, target)
+            # the output options apply to the output file that follows them
+            self._append_trim_to_cmd(encoder_cmd, infile, tags, self._encode_filters(tags, target))
+            self._append_streams_to_cmd(encoder_cmd, has_cover and self._embeds_cover(tags, position, target))
+            self._append_codec_to_cmd(encoder_cmd, target)
+            self._append_metadata_to_cmd(encoder_cmd, tags, position, target)
             encoder_cmd.append('-y')
-            encoder_cmd.append(outfile)
-        else:
-            raise NotImplementedError()
+            encoder_cmd.append(self._partial_file(outfile) if partial else outfile)
+        if config.loudness:
+            self._append_analysis_output_to_cmd(encoder_cmd, infile, tags)
         return encoder_cmd
 
+    def _append_analysis_output_to_cmd(self, cmd, infile, tags):
+        # the decoded track also goes to stdout as raw pcm, its loudness is measured while it is encoded
+        self._append_trim_to_cmd(cmd, infile, tags)
+        self._append_streams_to_cmd(cmd, False)
+        cmd.append('-c:a')
+        cmd.append(loudness.pcm_codec)
+        cmd.append('-f')
+        cmd.append(loudness.pcm_format)
+        if tags.get(literals.stream_info) is None:
+            cmd.append('-ar')
+            cmd.append(str(analysis_sample_rate))
+            cmd.append('-ac')
+            cmd.append('2')
+        cmd.append('pipe:1')
+
+    def _compose_bitrate(self, target):
+        if target.bitrate is not None:
+            return target.bitrate
+        if target.encoder == literals.opus:
+            return '256k'
+        if self.config.args.bitrate is not None:
+            return self.config.args.bitrate
+        return str(256000)
+
+    def _append_codec_to_cmd(self, cmd, target):
+        config = self.config
+
+        if target.encoder == literals.ffmpeg:
+            cmd.append('-c:a')
+            cmd.append(config.aac_encoder)
+            if config.aac_encoder == 'libfdk_aac' and (target.quality is not None or target.bitrate is None):
+                cmd.append('-vbr') # bitrate param is ignored!
+                cmd.append('5' if target.quality is None else target.quality)
+            elif config.aac_encoder == 'aac_at':
+                cmd.append('-aac_at_mode')
+                cmd.append('cvbr')
+                cmd.append('-b:a')
+                cmd.append(self._compose_bitrate(target))
+            else:
+                cmd.append('-b:a')
+                cmd.append(self._compose_bitrate(target))
+        elif target.encoder == literals.opus:
+            cmd.append('-c:a')
+            cmd.append('libopus')
+            cmd.append('-b:a')
+            cmd.append(self._compose_bitrate(target))
+            cmd.append('-vbr')
+            cmd.append('on')
+            cmd.append('-compression_level')
+            cmd.append('10' if target.quality is None else target.quality)
+        else:
+            raise ConfigError('unknown encoder {} of target {}'.format(target.encoder, target.name))
+
     def _append_option_to_cmd(self, cmd, option, tag):
         if tag is not None and isinstance(tag, str) and tag != '':
             cmd.append(option)
             cmd.append(tag)
 
-    def _compose_tagger_cmd(self, track, n_tracks, disc, n_discs, tags, dir_name):
+    def _compose_retag_cmd(self, tags, infile, outfile, position, target, kept_tags=None):
+        # remuxes the audio of an already converted track untouched, with the tags and cover of this run and the
+        # kept_tags of the output
+        retag_cmd = self.config.other_tools[literals.ffmpeg].copy()
+        retag_cmd.append('-i')
+        retag_cmd.append(infile)
+        has_cover = self._append_cover_input_to_cmd(retag_cmd, tags, position, [target])
+        self._append_streams_to_cmd(retag_cmd, has_cover)
+        retag_cmd.append('-c:a')
+        retag_cmd.append('copy')
+        retag_cmd.append('-map_metadata')
+        retag_cmd.append('-1')
+        self._append_metadata_to_cmd(retag_cmd, tags, position, target)
+        for key, value in (kept_tags or dict()).items():
+            self._append_option_to_cmd(retag_cmd, '-metadata', key + '=' + value)
+        retag_cmd.append('-y')
+        retag_cmd.append(outfile)
+        return retag_cmd
+
+    def _compose_tagger_cmd(self, track, n_tracks, disc, n_discs, tags, dir_name, target, partial=False):
         config = self.config
-        outfile = os.path.join(dir_name, tags[literals.outfile])
+        outfile = self._outfile(tags, dir_name, target)
+        if partial:
+            outfile = self._partial_file(outfile)
 
-        tagger_cmd = config.other_tools[config.tagger].copy()
-        if config.tagger == literals.atomicparsley:
+        tagger_cmd = config.other_tools[target.tagger].copy()
+        if target.tagger == literals.atomicparsley:
             tagger_cmd.insert(1, outfile)
             tagger_cmd.append('--tracknum')
             tagger_cmd.append(str(track) + '/' + str(n_tracks))
@@ -196,17 +1010,11 @@ class Codec:
             self._append_option_to_cmd(tagger_cmd, '--genre', tags[literals.genre])
             self._append_option_to_cmd(tagger_cmd, '--year', tags[literals.year])
             self._append_option_to_cmd(tagger_cmd, '--comment', tags[literals.comment])
-            if int(n_discs) > 1 or (config.args.discs is not None and int(config.args.discs) > 1):
-                tagger_cmd.append('--disk')
-                if config.args.disc is not None:
-                    disc = config.args.disc
-                if config.args.discs is not None:
-                    n_discs = config.args.discs
-                tagger_cmd.append(str(disc) + '/' + str(n_discs))
-            if config.args.cover is not None:
+            self._append_option_to_cmd(tagger_cmd, '--disk', self._compose_disc_tag(disc, n_discs, tags))
+            if tags[literals.cover] != '':
                 tagger_cmd.append('--artwork')
-                tagger_cmd.append(config.args.cover)
+                tagger_cmd.append(tags[literals.cover])
         else:
-            raise NotImplementedError()
+            raise ConfigError('unknown tagger {} of target {}'.format(target.tagger, target.name))
 
         return tagger_cmd
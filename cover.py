@@ -0,0 +1,120 @@
+import os
+import struct
+import hashlib
+import threading
+import literals
+import subprocess
+
+from metadata import MetadataReader
+from utility import subprocess_env
+from errors import AlbumError
+
+# pictures looked for in an album directory, in order, when no cover is given nor embedded
+cover_names = ('cover', 'folder', 'front', 'albumart')
+cover_extensions = ('.jpg', '.jpeg', '.png')
+
+
+def cover_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'lossless2lossy', 'covers')
+
+
+class CoverArt:
+    """
+    The cover stage: once per album the cover is read (the --cover file, else the art embedded in
+    the first lossless file, else a cover.jpg or folder.jpg next to it), scaled down to max_size
+    pixels and recompressed by ffmpeg through pipes, and stored in a cache keyed by the digest of
+    the original image. Every track of the album is tagged with the same cached file, and albums
+    sharing a cover share the file too. Nothing is ever written next to the sources or in the cwd.
+    One CoverArt serves the albums converted at once, each passes the --cover of its own options.
+    """
+    def __init__(self, config, max_size=None):
+        self.config = config
+        self.max_size = max_size
+        self.cache_dir = cover_cache_dir()
+        # digest of the original image -> cached file, for the covers met during this run
+        self.covers = dict()
+        self._lock = threading.Lock()
+
+    def album_cover(self, album_dir, lossless_files, cover=None):
+        # the cached cover file of the album, '' when it has none
+        config = self.config
+        with config.report.measure('cover', album=album_dir):
+            image = self._find_image(album_dir, lossless_files, cover)
+            if image is None:
+                return ''
+            digest = hashlib.sha256(image + str(self.max_size).encode('ascii')).hexdigest()
+            # albums sharing a cover wait for the first one to cache it instead of resizing it again
+            with self._lock:
+                if digest not in self.covers:
+                    self.covers[digest] = self._cache(digest, image)
+                return self.covers[digest]
+
+    def _find_image(self, album_dir, lossless_files, cover):
+        if cover is not None:
+            try:
+                with open(os.path.expanduser(cover), 'rb') as cover_fd:
+                    return cover_fd.read()
+            except OSError as os_error:
+                raise AlbumError('cannot read the cover file {}: {}'.format(cover, os_error))
+
+        # the first file speaks for the whole album
+        if len(lossless_files) > 0:
+            try:
+                image = MetadataReader(lossless_files[0]).read_picture()
+            except (OSError, ValueError, struct.error):
+                image = None
+            if image:
+                return image
+
+        if album_dir is not None and os.path.isdir(album_dir):
+            file_names = { file_name.lower(): file_name for file_name in os.listdir(album_dir) }
+            for name in cover_names:
+                for ext in cover_extensions:
+                    if name + ext in file_names:
+                        with open(os.path.join(album_dir, file_names[name + ext]), 'rb') as cover_fd:
+                            return cover_fd.read()
+        return None
+
+    def _cache(self, digest, image):
+        # a png stays png only when it cannot be recompressed, everything else ends up jpeg
+        for ext in ('.jpg', '.png'):
+            if os.path.isfile(os.path.join(self.cache_dir, digest + ext)):
+                return os.path.join(self.cache_dir, digest + ext)
+        path = os.path.join(self.cache_dir, digest + '.jpg')
+        data = self._resize(image)
+        if data is None:
+            data = image
+            if image.startswith(b'\x89PNG'):
+                path = os.path.join(self.cache_dir, digest + '.png')
+        return self.store(os.path.basename(path), data)
+
+    def store(self, file_name, data):
+        # also used by the workers of a job queue, for the covers prepared by the coordinator
+        path = os.path.join(self.cache_dir, file_name)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # written aside and renamed, a concurrent run or thread never sees half a picture
+        temp_path = path + '.{}-{}.tmp'.format(os.getpid(), threading.get_ident())
+        with open(temp_path, 'wb') as cover_fd:
+            cover_fd.write(data)
+        os.replace(temp_path, path)
+        return path
+
+    def _resize(self, image):
+        if not self.max_size:
+            return None
+        cmd = self.config.other_tools[literals.ffmpeg] + [
+            '-v', 'error', '-i', '-', '-frames:v', '1',
+            '-vf', "scale='min(iw,{0})':'min(ih,{0})':force_original_aspect_ratio=decrease".format(self.max_size),
+            '-pix_fmt', 'yuvj420p', '-c:v', 'mjpeg', '-q:v', '2', '-f', 'image2pipe', '-']
+        try:
+            result = subprocess.run(cmd, input=image, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    env=subprocess_env())
+        except OSError as os_error:
+            print('warning: cannot resize the cover: {}'.format(os_error))
+            return None
+        if result.returncode != 0 or len(result.stdout) == 0:
+            print('warning: cannot resize the cover, keeping it as it is: {}'.format(
+                result.stderr.decode('utf-8', errors='replace').strip()))
+            return None
+        return result.stdout
@@ -1,32 +1,171 @@
 import os
 import re
+import codecs
 import literals
 
+from errors import CuefileError
+
+# a cue sheet line is a command followed by its arguments
+line_pattern = re.compile(r'^\s*([A-Za-z]+)\s*(.*?)\s*$')
+file_pattern = re.compile(r'^(?:"(.*)"|(\S+))\s*([A-Za-z0-9]*)$')
+track_pattern = re.compile(r'^([0-9]+)\s*(\S*)$')
+index_pattern = re.compile(r'^([0-9]+)\s+([0-9]+):([0-9]+):([0-9]+)$')
+rem_pattern = re.compile(r'^([A-Za-z_]+)\s*(.*)$')
+
+
+class CueTrack:
+    def __init__(self, number, file):
+        self.number = number
+        # the file holding the INDEX 01 of the track, i.e. where the track itself starts
+        self.file = file
+        self.title = None
+        self.performer = None
+        self.rems = dict()
+        # index number -> (file, position in cd frames of 1/75 s)
+        self.indexes = dict()
+
+    def start(self):
+        if 1 in self.indexes:
+            return self.indexes[1][1]
+        return None
+
+
+class CueFileEntry:
+    def __init__(self, name, file_type):
+        self.name = name
+        self.file_type = file_type
+        self.tracks = list()
+
+
+class CueSheet:
+    """
+    The structured content of a cue sheet, filled in by a single pass over its lines. REM
+    entries (GENRE, DATE, DISCNUMBER, ...) are kept in rems, at sheet or at track level.
+    """
+    def __init__(self):
+        self.encoding = literals.utf_8
+        self.rems = dict()
+        self.performer = None
+        self.title = None
+        self.files = list()
+        self.tracks = list()
+
+    def _unquote(self, value):
+        if len(value) >= 2 and value[0] in '"\'' and value[-1] == value[0]:
+            return value[1:-1]
+        return value
+
+    def _decode(self, data):
+        # BOMs first, then utf-8 which is strict enough to reject most legacy codepages
+        for bom, encoding in ((codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'),
+                              (codecs.BOM_UTF16_BE, 'utf-16')):
+            if data.startswith(bom):
+                return data.decode(encoding), literals.utf_8 if encoding == 'utf-8-sig' else encoding
+        try:
+            return data.decode(literals.utf_8), literals.utf_8
+        except UnicodeDecodeError:
+            return data.decode(literals.cp1252, errors='replace'), literals.cp1252
+
+    def parse(self, data):
+        text, self.encoding = self._decode(data)
+        current_file = None
+        current_track = None
+
+        for line in text.splitlines():
+            line_match = line_pattern.match(line)
+            if line_match is None:
+                continue
+            command = line_match.group(1).upper()
+            argument = line_match.group(2)
+
+            if command == 'REM':
+                rem_match = rem_pattern.match(argument)
+                if rem_match is None:
+                    continue
+                command = rem_match.group(1).upper()
+                argument = rem_match.group(2)
+                rems = self.rems if current_track is None else current_track.rems
+                rems[command] = self._unquote(argument)
+            elif command in ('DATE', 'GENRE'):
+                rems = self.rems if current_track is None else current_track.rems
+                rems[command] = self._unquote(argument)
+            elif command == 'FILE':
+                file_match = file_pattern.match(argument)
+                if file_match is not None:
+                    name = file_match.group(1) if file_match.group(1) is not None else file_match.group(2)
+                    current_file = CueFileEntry(name, file_match.group(3).upper())
+                    self.files.append(current_file)
+            elif command == 'TRACK':
+                track_match = track_pattern.match(argument)
+                number = int(track_match.group(1)) if track_match is not None else len(self.tracks) + 1
+                if current_file is None:
+                    raise CuefileError('malformed cuefile: track {} comes before any FILE'.format(number))
+                current_track = CueTrack(number, current_file)
+                self.tracks.append(current_track)
+                current_file.tracks.append(current_track)
+            elif command == 'INDEX' and current_track is not None:
+                index_match = index_pattern.match(argument)
+                if index_match is not None:
+                    index, minutes, seconds, frames = (int(group) for group in index_match.groups())
+                    current_track.indexes[index] = (current_file, (minutes * 60 + seconds) * 75 + frames)
+                    if index == 1 and current_file is not current_track.file:
+                        # the pregap lies in the previous file, the track belongs to this one
+                        if current_track.file is not None:
+                            current_track.file.tracks.remove(current_track)
+                        current_track.file = current_file
+                        current_file.tracks.append(current_track)
+            elif command == 'TITLE':
+                if current_track is None:
+                    self.title = self._unquote(argument)
+                else:
+                    current_track.title = self._unquote(argument)
+            elif command == 'PERFORMER':
+                if current_track is None:
+                    self.performer = self._unquote(argument)
+                else:
+                    current_track.performer = self._unquote(argument)
+        return self
+
+    def read(self, path):
+        with open(path, 'rb') as cuefile_fd:
+            return self.parse(cuefile_fd.read())
+
+    def track_end(self, track):
+        # a track ends where the next track of the same file starts, or with its file
+        tracks = track.file.tracks
+        position = tracks.index(track)
+        if position + 1 < len(tracks):
+            return tracks[position + 1].start()
+        return None
+
+
 class Cuefile:
     def __init__(self, config):
         self.cuefile = None
+        self.sheet = None
         self.mode = None
+        self.lossless_file = None
+        self.track_indexes = dict()
         self.config = config
         self.args = config.args
 
-    def select_cuefile(self):
+    def select_cuefile(self, album_dir=None):
         args = self.args
         if args.cover is not None:
             args.cover = os.path.realpath(os.path.expanduser(args.cover))
-            if not (os.stat(args.cover) or not os.path.isfile(args.cover)):
+            if not os.path.isfile(args.cover):
                 print('warning: cover file does not exist or is not a valid file')
                 args.cover = None
 
-        cwd = os.getcwd()
+        cwd = os.getcwd() if album_dir is None else album_dir
         if args.cuefile is not None:
             args.cuefile = os.path.realpath(os.path.expanduser(args.cuefile))
-            if os.stat(args.cuefile) and os.path.isfile(args.cuefile):
+            if os.path.isfile(args.cuefile):
                 self.cuefile = args.cuefile
                 self.mode = 0
-                self._detect_cuefile_encoding()
+                self._read_cuefile()
             else:
-                print('selected cuefile does not exist')
-                exit(-1)
+                raise CuefileError('selected cuefile does not exist')
         else:
             print('guessing cufile to use...')
             candidates = [f for f in os.listdir(cwd) if f.endswith('.cue')]
@@ -35,43 +174,35 @@ class Cuefile:
                 print('found cuefile {}'.format(cuefile))
                 self.cuefile = cuefile
                 self.mode = 0
-                self._detect_cuefile_encoding()
+                self._read_cuefile()
             elif len(candidates) > 1:
-                print('ambiguous cuefiles...')
-                exit(-1)
+                raise CuefileError('ambiguous cuefiles...')
             else:
                 print('no cuefile present in dir...trying file by file mode...')
                 self.cuefile = None
                 self.mode = 1
 
     def extract_single_lossless_file(self):
-        cuefile = self.cuefile
         config = self.config
-        if not config.single_lossless_file:
+        if not config.single_lossless_file or len(self.sheet.files) != 1:
             return None
-        lossless_file = None
-
-        with open(cuefile, encoding=config.cuefile_encoding) as cuefile_fd:
-            for cuefile_line in cuefile_fd.readlines():
-                lossless_file_match = re.match(r'^ *\t*FILE *\t*"(.*)" *(WAVE)?(FLAC)?(APE)? *\t*$', cuefile_line,
-                                               re.IGNORECASE)
-                if lossless_file_match is not None:
-                    if lossless_file is not None:
-                        return None
-                    else:
-                        lossless_file = os.path.join(os.path.dirname(cuefile), lossless_file_match.group(1))
-
-    def _detect_cuefile_encoding(self):
-        cuefile = self.cuefile
-        encoding = literals.utf_8
-        cuefile_fd = open(cuefile, 'r', encoding=literals.utf_8)
-        try:
-            cuefile_fd.readlines()
-            cuefile_fd.close()
-        except UnicodeDecodeError:
-            cuefile_fd.close()
-            cuefile_fd = open(cuefile, 'r', encoding=literals.cp1252)
-            cuefile_fd.readlines()
-            cuefile_fd.close()
-            encoding = literals.cp1252
-        self.config.cuefile_encoding = encoding
+
+        self.lossless_file = os.path.join(os.path.dirname(self.cuefile), self.sheet.files[0].name)
+        return self.lossless_file
+
+    def extract_track_indexes(self):
+        # maps each track to the position of its INDEX 01 in cd frames (1/75 s)
+        track_indexes = dict()
+        for n_track, track in enumerate(self.sheet.tracks, 1):
+            if track.start() is not None:
+                track_indexes[n_track] = track.start()
+
+        self.track_indexes = track_indexes
+        return track_indexes
+
+    def _read_cuefile(self):
+        # the cue sheet is read and parsed once, every caller shares the resulting model
+        with self.config.report.measure('cue', album=os.path.dirname(os.path.abspath(self.cuefile)),
+                                        filename=self.cuefile):
+            self.sheet = CueSheet().read(self.cuefile)
+        self.config.cuefile_encoding = self.sheet.encoding
@@ -0,0 +1,303 @@
+import os
+import sys
+import time
+import shutil
+import signal
+import asyncio
+import literals
+import subprocess
+
+from report import read_proc_io
+from utility import subprocess_env
+
+read_size = 65536
+
+
+class Progress:
+    """
+    Live state of one ffmpeg encode, fed with the key=value blocks of its -progress output.
+    duration is the length in seconds of the audio the encode writes: when it is known the
+    progress is also given as percent and eta.
+    """
+    def __init__(self, duration=None):
+        self.duration = duration
+        self.out_time = 0.0
+        self.speed = None
+        self.finished = False
+
+    def update(self, key, value):
+        # returns True at the end of a block, i.e. when the state is consistent
+        if key in ('out_time_us', 'out_time_ms'):
+            # despite its name out_time_ms is in microseconds as well
+            try:
+                self.out_time = max(0, int(value)) / 1000000
+            except ValueError:
+                pass
+        elif key == 'speed':
+            try:
+                self.speed = float(value.strip().rstrip('x'))
+            except ValueError:
+                self.speed = None
+        elif key == 'progress':
+            self.finished = value.strip() == 'end'
+            return True
+        return False
+
+    def percent(self):
+        if not self.duration:
+            return None
+        if self.finished:
+            return 100.0
+        return min(100.0, 100.0 * self.out_time / self.duration)
+
+    def eta(self):
+        if not self.duration or not self.speed:
+            return None
+        return max(0.0, self.duration - self.out_time) / self.speed
+
+    def __str__(self):
+        percent = self.percent()
+        text = '{:.1f}s'.format(self.out_time) if percent is None else '{:.0f}%'.format(percent)
+        if self.speed is not None:
+            text += ' {:.1f}x'.format(self.speed)
+        eta = self.eta()
+        if eta is not None and not self.finished:
+            text += ' eta {:.0f}s'.format(eta)
+        return text
+
+
+class ProcessResult:
+    def __init__(self):
+        self.returncode = None
+        self.stdout = b''
+        self.stderr = b''
+        # resource usage of each process of the pipeline, as returned by wait4, and its i/o counters
+        self.rusages = list()
+        self.io = list()
+        self.timed_out = False
+
+
+class ProgressReporter:
+    """
+    Shows the progress of the running encodes. On a terminal a single status line is rewritten
+    in place, otherwise a plain line is printed; either way at most once every interval seconds.
+    """
+    def __init__(self, interval=1.0, stream=None):
+        self.stream = sys.stdout if stream is None else stream
+        self.interactive = self.stream.isatty()
+        self.interval = interval if self.interactive else interval * 10
+        self.active = dict()
+        self.last_report = 0.0
+        self.line_length = 0
+
+    def update(self, name, progress):
+        self.active[name] = progress
+        now = time.monotonic()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self._report()
+
+    def finish(self, name):
+        self.active.pop(name, None)
+
+    def clear(self):
+        if self.interactive and self.line_length > 0:
+            self.stream.write('\r' + ' ' * self.line_length + '\r')
+            self.stream.flush()
+            self.line_length = 0
+
+    def _report(self):
+        if len(self.active) == 0:
+            return
+        line = ' | '.join('{} {}'.format(name, progress) for name, progress in self.active.items())
+        if self.interactive:
+            line = line[:shutil.get_terminal_size().columns - 1]
+            self.stream.write('\r' + line.ljust(self.line_length))
+            self.stream.flush()
+            self.line_length = len(line)
+        else:
+            print(line, file=self.stream, flush=True)
+
+
+class Engine:
+    """
+    Runs commands, or pipelines of commands, under asyncio without any thread per child: every
+    pipe is read as the data arrives and every child is reaped through a pidfd as soon as it
+    exits, which also gives its resource usage. When the last command is ffmpeg and a progress
+    callback is given, ffmpeg reports its progress on a dedicated pipe, so it never mixes with
+    the audio that may flow on stdout. With on_stdout that audio is handed over chunk by chunk as
+    it arrives, and not kept.
+    A job that shows no activity at all (output or progress) for timeout seconds is killed, and
+    cancelling the task awaiting run() kills the children as well.
+    """
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+
+    async def run(self, cmds, duration=None, on_progress=None, on_stderr=None, timeout=None, cores=None,
+                  on_stdout=None):
+        if len(cmds) > 0 and not isinstance(cmds[0], list):
+            cmds = [cmds]
+        cmds = [list(cmd) for cmd in cmds]
+        timeout = self.timeout if timeout is None else timeout
+        result = ProcessResult()
+
+        progress = None
+        progress_fds = None
+        if on_progress is not None and os.path.basename(cmds[-1][0]) == literals.ffmpeg:
+            progress_fds = os.pipe()
+            cmds[-1][1:1] = ['-progress', 'pipe:{}'.format(progress_fds[1]), '-nostats']
+            progress = Progress(duration)
+
+        try:
+            processes = self._spawn(cmds, progress_fds[1] if progress_fds is not None else None, cores)
+        except OSError as os_error:
+            if progress_fds is not None:
+                os.close(progress_fds[0])
+            result.returncode = -1
+            result.stderr = 'cannot run {}: {}\n'.format(' '.join(cmds[0]), os_error).encode('utf-8')
+            return result
+        finally:
+            if progress_fds is not None:
+                os.close(progress_fds[1])
+
+        last_activity = [time.monotonic()]
+        stdout_chunks = list()
+        stderr_chunks = [list() for _ in processes]
+
+        def collect(chunks, forward=None, keep=True):
+            def on_data(data):
+                last_activity[0] = time.monotonic()
+                if keep:
+                    chunks.append(data)
+                if forward is not None:
+                    forward(data)
+            return on_data
+
+        def parse_progress():
+            pending = [b'']
+
+            def on_data(data):
+                last_activity[0] = time.monotonic()
+                lines = (pending[0] + data).split(b'\n')
+                pending[0] = lines.pop()
+                for line in lines:
+                    key, separator, value = line.decode('utf-8', errors='replace').partition('=')
+                    if separator != '' and progress.update(key.strip(), value):
+                        on_progress(progress)
+            return on_data
+
+        readers = [self._read_pipe(process.stderr, collect(stderr_chunks[idx], on_stderr))
+                   for idx, process in enumerate(processes)]
+        readers.append(self._read_pipe(processes[-1].stdout, collect(stdout_chunks, on_stdout, on_stdout is None)))
+        if progress is not None:
+            readers.append(self._read_pipe(os.fdopen(progress_fds[0], 'rb', buffering=0), parse_progress()))
+        waiters = [self._wait(process) for process in processes]
+        pending = asyncio.gather(*readers, *waiters)
+
+        try:
+            while True:
+                remaining = None if timeout is None else last_activity[0] + timeout - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    result.timed_out = True
+                    self._kill(processes)
+                    await asyncio.wait([pending])
+                    break
+                done, _ = await asyncio.wait([pending], timeout=remaining)
+                if len(done) > 0:
+                    break
+        except asyncio.CancelledError:
+            # the children must not outlive a cancelled job
+            self._kill(processes)
+            await asyncio.wait([pending])
+            raise
+
+        gathered = pending.result()
+        result.rusages = [rusage for rusage, io in gathered[len(readers):]]
+        result.io = [io for rusage, io in gathered[len(readers):]]
+        result.stdout = b''.join(stdout_chunks)
+        result.stderr = b''.join(b''.join(chunks) for chunks in stderr_chunks)
+        # an upstream failure is usually the consequence (SIGPIPE) of a downstream one
+        result.returncode = 0
+        for process in reversed(processes):
+            if process.returncode != 0:
+                result.returncode = process.returncode
+                break
+        if result.timed_out:
+            result.stderr += 'killed after {}s without any activity\n'.format(timeout).encode('utf-8')
+        return result
+
+    def _spawn(self, cmds, progress_fd, cores=None):
+        # the affinity is set in the child before exec, the threads of the encoder inherit it
+        preexec_fn = None if cores is None else lambda: os.sched_setaffinity(0, cores)
+        processes = list()
+        pipe_fds = list()
+        try:
+            stdin = subprocess.DEVNULL
+            for idx, cmd in enumerate(cmds):
+                last = idx + 1 == len(cmds)
+                if last:
+                    stdout = subprocess.PIPE
+                else:
+                    read_fd, stdout = os.pipe()
+                    pipe_fds.extend((read_fd, stdout))
+                pass_fds = (progress_fd,) if last and progress_fd is not None else ()
+                processes.append(subprocess.Popen(cmd, stdin=stdin, stdout=stdout, stderr=subprocess.PIPE,
+                                                  env=subprocess_env(), pass_fds=pass_fds, shell=False,
+                                                  preexec_fn=preexec_fn))
+                if not last:
+                    stdin = read_fd
+        except OSError:
+            self._kill(processes)
+            for process in processes:
+                process.wait()
+            raise
+        finally:
+            # the children hold their own ends: an upstream process gets SIGPIPE if the downstream one
+            # exits early
+            for fd in pipe_fds:
+                os.close(fd)
+        return processes
+
+    async def _read_pipe(self, pipe, on_data):
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader(limit=read_size)
+        transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        try:
+            while True:
+                data = await reader.read(read_size)
+                if not data:
+                    return
+                on_data(data)
+        finally:
+            transport.close()
+
+    async def _wait(self, process):
+        loop = asyncio.get_running_loop()
+        io = None
+        try:
+            pidfd = os.pidfd_open(process.pid)
+        except (AttributeError, OSError):
+            # no pidfd (not linux): a blocking wait in the default executor
+            pid, status, rusage = await loop.run_in_executor(None, os.wait4, process.pid, 0)
+        else:
+            exited = loop.create_future()
+            loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+            try:
+                await exited
+            finally:
+                loop.remove_reader(pidfd)
+                os.close(pidfd)
+            # the counters of an exited child stay readable until it is reaped
+            io = read_proc_io('/proc/{}/io'.format(process.pid))
+            pid, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        return rusage, io
+
+    def _kill(self, processes):
+        for process in processes:
+            if process.returncode is None:
+                # not send_signal: it polls, and would reap a child that already exited before _wait does
+                try:
+                    os.kill(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
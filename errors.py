@@ -0,0 +1,32 @@
+class ConversionError(Exception):
+    """
+    Base of the errors that stop the conversion of an album or of a whole run. The message is the
+    one the command line prints; a library user catches these instead of seeing the process exit.
+    """
+
+
+class ConfigError(ConversionError):
+    # options that make no sense: unknown targets, taggers, malformed target options
+    pass
+
+
+class ToolchainError(ConversionError):
+    # a required tool is missing, or cannot do what the options ask for
+    pass
+
+
+class CuefileError(ConversionError):
+    # the cuefile is missing, ambiguous or malformed
+    pass
+
+
+class AlbumError(ConversionError):
+    # the album has no tracks or tags to convert, or its cover cannot be read
+    pass
+
+
+class TracksFailedError(ConversionError):
+    # some tracks of the album failed to convert, failed_tracks is the set of their (disc, track)
+    def __init__(self, message, failed_tracks=None):
+        super().__init__(message)
+        self.failed_tracks = failed_tracks or set()
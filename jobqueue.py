@@ -0,0 +1,319 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import literals
+import threading
+
+from codec import Codec
+from manifest import Manifest
+from toolchain import check_tools
+from errors import ToolchainError
+
+# job states
+pending = 'pending'
+leased = 'leased'
+done = 'done'
+failed = 'failed'
+
+# a worker renews its leases three times per lease time, a lease that is not renewed frees its job
+lease_time = 60.0
+max_attempts = 3
+poll_interval = 2.0
+# the options of a worker, every other one comes from the run that queued the job
+worker_options = ('jobs', 'io_jobs', 'fixed_jobs', 'pin', 'keep_going', 'timeout', 'no_progress', 'report', 'scratch',
+                  'queue', 'worker')
+
+
+class JobQueue:
+    """
+    A queue of track jobs in a sqlite file on storage shared by a coordinator and its workers.
+    The coordinator plans albums as usual but queues each track (sources, sample range, targets,
+    output paths and tags) with the options of its run, instead of converting it. Workers lease
+    jobs for lease_time seconds and renew the leases with heartbeats while they convert; the jobs
+    of a worker that stops heartbeating are leased again once their lease expires. A job that
+    fails is retried up to max_attempts times, possibly by another worker.
+    The rollback journal is kept (no wal), which network filesystems support.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.run_id = None
+        # jobs put by the coordinator, written in one transaction by commit()
+        self.new_jobs = list()
+        self._lock = threading.Lock()
+        # transactions are explicit, leasing must be atomic across hosts
+        self._connection = sqlite3.connect(path, timeout=60.0, isolation_level=None, check_same_thread=False)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, args TEXT, '
+                                 'manifest_root TEXT, created REAL)')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, run_id INTEGER, '
+                                 'album TEXT, disc INTEGER, track INTEGER, payload TEXT, state TEXT, worker TEXT, '
+                                 'lease_expires REAL, attempts INTEGER, error TEXT)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_expires)')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS covers (name TEXT PRIMARY KEY, data BLOB)')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS workers (id TEXT PRIMARY KEY, heartbeat REAL, '
+                                 'n_done INTEGER, n_failed INTEGER)')
+
+    def add_run(self, args, manifest_root=None):
+        with self._lock:
+            cursor = self._connection.execute('INSERT INTO runs (args, manifest_root, created) VALUES (?, ?, ?)',
+                                              (json.dumps(vars(args)), manifest_root, time.time()))
+        self.run_id = cursor.lastrowid
+        return self.run_id
+
+    def run(self, run_id):
+        with self._lock:
+            row = self._connection.execute('SELECT args, manifest_root FROM runs WHERE id = ?', (run_id,)).fetchone()
+        return json.loads(row[0]), row[1]
+
+    def put(self, album, disc, track, payload):
+        self.new_jobs.append((self.run_id, album, disc, track, json.dumps(payload), pending))
+
+    def commit(self):
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            self._connection.executemany('INSERT INTO jobs (run_id, album, disc, track, payload, state, attempts) '
+                                         'VALUES (?, ?, ?, ?, ?, ?, 0)', self.new_jobs)
+            self._connection.execute('COMMIT')
+        self.new_jobs = list()
+
+    def add_cover(self, path):
+        # the workers may not share the cache of the coordinator, the cover travels with the queue
+        with open(path, 'rb') as cover_fd:
+            data = cover_fd.read()
+        with self._lock:
+            self._connection.execute('INSERT OR IGNORE INTO covers VALUES (?, ?)', (os.path.basename(path), data))
+
+    def cover(self, name):
+        with self._lock:
+            row = self._connection.execute('SELECT data FROM covers WHERE name = ?', (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def lease(self, worker_id, n_jobs):
+        # returns up to n_jobs (job id, run id, payload), pending ones first, then the ones of dead workers
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                self._connection.execute('UPDATE jobs SET state = ?, error = ? WHERE state = ? AND lease_expires < ? '
+                                         'AND attempts >= ?', (failed, 'lease expired', leased, now, max_attempts))
+                rows = self._connection.execute('SELECT id, run_id, payload FROM jobs WHERE state = ? OR '
+                                                '(state = ? AND lease_expires < ?) ORDER BY id LIMIT ?',
+                                                (pending, leased, now, n_jobs)).fetchall()
+                self._connection.executemany('UPDATE jobs SET state = ?, worker = ?, lease_expires = ?, '
+                                             'attempts = attempts + 1 WHERE id = ?',
+                                             [(leased, worker_id, now + lease_time, row[0]) for row in rows])
+                self._connection.execute('COMMIT')
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+        return [(job_id, run_id, json.loads(payload)) for job_id, run_id, payload in rows]
+
+    def heartbeat(self, worker_id, job_ids, n_done=0, n_failed=0):
+        now = time.time()
+        with self._lock:
+            self._connection.executemany('UPDATE jobs SET lease_expires = ? WHERE id = ? AND worker = ? AND state = ?',
+                                         [(now + lease_time, job_id, worker_id, leased) for job_id in job_ids])
+            self._connection.execute('INSERT OR REPLACE INTO workers VALUES (?, ?, ?, ?)',
+                                     (worker_id, now, n_done, n_failed))
+
+    def finish(self, job_id, worker_id, error=None):
+        # a job whose lease was lost in the meantime belongs to another worker now and is left alone
+        with self._lock:
+            if error is None:
+                self._connection.execute('UPDATE jobs SET state = ?, error = NULL WHERE id = ? AND worker = ? '
+                                         'AND state = ?', (done, job_id, worker_id, leased))
+            else:
+                self._connection.execute('UPDATE jobs SET state = CASE WHEN attempts < ? THEN ? ELSE ? END, error = ? '
+                                         'WHERE id = ? AND worker = ? AND state = ?',
+                                         (max_attempts, pending, failed, error, job_id, worker_id, leased))
+
+    def release(self, job_id, worker_id):
+        # an interrupted worker gives its jobs back without counting the attempt
+        with self._lock:
+            self._connection.execute('UPDATE jobs SET state = ?, attempts = attempts - 1 WHERE id = ? AND worker = ? '
+                                     'AND state = ?', (pending, job_id, worker_id, leased))
+
+    def counts(self):
+        with self._lock:
+            rows = self._connection.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall()
+        counts = { pending: 0, leased: 0, done: 0, failed: 0 }
+        counts.update(rows)
+        return counts
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class Worker:
+    """
+    Converts the jobs of a JobQueue until there is none left, up to config.jobs tracks at once:
+    a track that ends leases the next job, which joins the running scheduler while the other
+    tracks go on, so that a long track never holds the other slots back.
+    Each job is planned again on this host with the options of the run that queued it, through
+    Codec.submit_queued_track: the same commands as a local run, with the intermediate files in
+    the scratch directory of this worker and the tools found on this host.
+    """
+    def __init__(self, config, job_queue):
+        self.config = config
+        self.job_queue = job_queue
+        self.worker_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+        # run id -> (config, manifest)
+        self.runs = dict()
+        # changed by the finish of the tracks in the executor threads while the heartbeat reads it, under _lock
+        self.leased_ids = set()
+        # job id -> codec of the leased tracks, and the jobs leased by the finish of each one
+        self.codecs = dict()
+        self.next_jobs = dict()
+        self.n_done = 0
+        self.n_failed = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def _run_config(self, run_id):
+        if run_id not in self.runs:
+            from lossless2lossy import ConvertConfig, parser
+            run_args, manifest_root = self.job_queue.run(run_id)
+            merged_args = vars(parser([]))
+            merged_args.update(run_args)
+            for option in worker_options:
+                merged_args[option] = getattr(self.config.args, option)
+            run_config = ConvertConfig(argparse.Namespace(**merged_args))
+            # one report and one scratch directory for the whole worker
+            run_config.report = self.config.report
+            run_config.scratch = self.config.scratch
+            if not check_tools(run_config):
+                raise ToolchainError('cannot convert the jobs of run {} on this host'.format(run_id))
+            manifest = Manifest(manifest_root) if manifest_root is not None else None
+            self.runs[run_id] = (run_config, manifest)
+        return self.runs[run_id]
+
+    def _local_cover(self, name):
+        path = os.path.join(self.config.cover_art.cache_dir, name)
+        if not os.path.isfile(path):
+            data = self.job_queue.cover(name)
+            if data is None:
+                return ''
+            path = self.config.cover_art.store(name, data)
+        return path
+
+    def _heartbeat(self):
+        while not self._stopped.wait(lease_time / 3):
+            with self._lock:
+                job_ids = list(self.leased_ids)
+                n_done, n_failed = self.n_done, self.n_failed
+            self.job_queue.heartbeat(self.worker_id, job_ids, n_done, n_failed)
+
+    def run(self):
+        print('worker {} pulling jobs from {}'.format(self.worker_id, self.job_queue.path))
+        heartbeat = threading.Thread(target=self._heartbeat, daemon=True)
+        heartbeat.start()
+        try:
+            while True:
+                # a failed track must not stop the other leased ones
+                scheduler = self.config.scheduler(keep_going=True)
+                jobs = self.job_queue.lease(self.worker_id, self.config.jobs)
+                if len(jobs) == 0:
+                    counts = self.job_queue.counts()
+                    if counts[pending] == 0 and counts[leased] == 0:
+                        break
+                    # the remaining jobs are leased by other workers, which may die
+                    time.sleep(poll_interval)
+                    continue
+                for job in jobs:
+                    try:
+                        self._submit(scheduler, self._prepare(job))
+                    except Exception as error:
+                        self._drop(job[0], error)
+                # every track that ends leases the next one, the run lasts until the queue has none left
+                scheduler.run()
+        except KeyboardInterrupt:
+            # the running children are already killed, only the temp files are left
+            for job_id, codec in list(self.codecs.items()):
+                codec.collect_results()
+            with self._lock:
+                job_ids = list(self.leased_ids)
+            for job_id in job_ids:
+                self.job_queue.release(job_id, self.worker_id)
+            print('interrupted')
+            return -1
+        finally:
+            self._stopped.set()
+            heartbeat.join()
+            for run_config, manifest in self.runs.values():
+                if manifest is not None:
+                    manifest.close()
+
+        counts = self.job_queue.counts()
+        print('worker summary')
+        print('  jobs converted by this worker: {}'.format(self.n_done))
+        print('  jobs failed on this worker: {}'.format(self.n_failed))
+        print('  queue: {} done, {} failed'.format(counts[done], counts[failed]))
+        return 0 if counts[failed] == 0 else -1
+
+    def _prepare(self, job):
+        # everything that may block is done off the event loop: the config of its run and the cover
+        job_id, run_id, queued_track = job
+        with self._lock:
+            self.leased_ids.add(job_id)
+        run_config, manifest = self._run_config(run_id)
+        tags = queued_track['tags']
+        if tags[literals.cover] != '':
+            tags[literals.cover] = self._local_cover(os.path.basename(tags[literals.cover]))
+        return job_id, run_config, manifest, queued_track
+
+    def _submit(self, scheduler, prepared_job):
+        job_id, run_config, manifest, queued_track = prepared_job
+        codec = Codec(config=run_config, scheduler=scheduler, manifest=manifest)
+        codec.submit_queued_track(queued_track)
+        self.codecs[job_id] = codec
+        last_jobs = [job for jobs in codec.track_jobs.values() for job in jobs]
+        # over once the track is, whether it succeeded or not
+        scheduler.submit('finishing job {}'.format(job_id), self._finish_func(scheduler, job_id, codec),
+                         stage='finish', wait_for=last_jobs, on_finish=self._next_job_callback(scheduler, job_id))
+
+    def _finish_func(self, scheduler, job_id, codec):
+        def finish():
+            if codec.collect_results() == 0:
+                self.job_queue.finish(job_id, self.worker_id)
+                with self._lock:
+                    self.n_done += 1
+            else:
+                # a job holds a single track
+                key = (codec.album_dir,) + next(iter(codec.failed_tracks))
+                errors = ['{} failed with exit code {}'.format(job.name, job.returncode)
+                          for job in list(scheduler.failed_jobs) if job.key == key and not job.skipped]
+                self.job_queue.finish(job_id, self.worker_id, '; '.join(errors) or 'failed on ' + self.worker_id)
+                with self._lock:
+                    self.n_failed += 1
+            with self._lock:
+                self.leased_ids.discard(job_id)
+            del self.codecs[job_id]
+            # the slot of the track goes to the next job right away
+            self.next_jobs[job_id] = list()
+            for job in self.job_queue.lease(self.worker_id, 1):
+                try:
+                    self.next_jobs[job_id].append(self._prepare(job))
+                except Exception as error:
+                    self._drop(job[0], error)
+        return finish
+
+    def _next_job_callback(self, scheduler, job_id):
+        # on the event loop: the job leased by the finish of job_id is submitted to the running scheduler
+        def on_finish(job):
+            for prepared_job in self.next_jobs.pop(job_id, list()):
+                try:
+                    self._submit(scheduler, prepared_job)
+                except Exception as error:
+                    self._drop(prepared_job[0], error)
+        return on_finish
+
+    def _drop(self, job_id, error):
+        # a job this worker cannot even plan fails, another worker may take it
+        print('cannot convert job {}: {}'.format(job_id, error))
+        self.job_queue.finish(job_id, self.worker_id, str(error))
+        with self._lock:
+            self.leased_ids.discard(job_id)
+            self.n_failed += 1
@@ -0,0 +1,56 @@
+import os
+import json
+import time
+import threading
+
+journal_filename = '.lossless2lossy.journal'
+
+
+class Journal:
+    """
+    Append-only record of the tracks a run has finished, one json line per track, written and
+    fsynced as soon as the outputs of the track are renamed into place. A new run starts a new
+    journal; with resume the journal of the previous run is read back and its finished tracks are
+    skipped, provided their outputs are still there. A line torn by a crash is ignored, and cut off
+    before the resumed run appends to the journal.
+    """
+    def __init__(self, out_root, resume=False):
+        self.path = os.path.join(out_root, journal_filename)
+        self.finished_outfiles = set()
+        if resume:
+            self._load()
+            print('resuming: {} output(s) already finished'.format(len(self.finished_outfiles)))
+        self._lock = threading.Lock()
+        self._fd = open(self.path, 'a' if resume else 'w')
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as journal_fd:
+                data = journal_fd.read()
+        except FileNotFoundError:
+            return
+        # only the lines ending with a newline were written whole
+        complete_size = data.rfind(b'\n') + 1
+        for line in data[:complete_size].splitlines():
+            try:
+                self.finished_outfiles.update(json.loads(line.decode('utf-8'))['outfiles'])
+            except (ValueError, KeyError):
+                continue
+        if complete_size < len(data):
+            # the next record would otherwise be appended to the torn line and be lost with it
+            with open(self.path, 'r+b') as journal_fd:
+                journal_fd.truncate(complete_size)
+
+    def finished(self, outfile):
+        return os.path.realpath(outfile) in self.finished_outfiles and os.path.isfile(outfile)
+
+    def record(self, outfiles):
+        line = json.dumps({ 'outfiles': [os.path.realpath(outfile) for outfile in outfiles], 'time': time.time() })
+        with self._lock:
+            self._fd.write(line + '\n')
+            self._fd.flush()
+            os.fsync(self._fd.fileno())
+
+    def close(self):
+        with self._lock:
+            self._fd.close()
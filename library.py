@@ -0,0 +1,168 @@
+import os
+import time
+
+from cuefile import Cuefile
+from tagging import Tagging
+from codec import Codec
+from manifest import Manifest, manifest_filename
+from journal import Journal
+from planner import Plan
+from errors import AlbumError, ConversionError
+
+
+class Library:
+    """
+    Converts every album found under a root directory in one process. All albums are planned first
+    and share one scheduler, so the worker budget stays busy across album boundaries. The output
+    tree mirrors the source tree.
+    """
+    def __init__(self, config, job_queue=None):
+        self.config = config
+        # with a job queue the albums are only planned, workers convert them
+        self.job_queue = job_queue
+        args = config.args
+        self.root = os.path.realpath(os.path.expanduser(args.library))
+        if args.path is not None:
+            self.out_root = os.path.realpath(os.path.expanduser(args.path))
+        else:
+            self.out_root = os.getcwd()
+        self.scheduler = config.scheduler()
+        # the output tree of every target mirrors the source tree
+        self.target_roots = [os.path.realpath(target.root(self.out_root)) for target in config.targets]
+        if not config.dry_run:
+            os.makedirs(self.target_roots[0], exist_ok=True)
+        self.manifest = None
+        if args.incremental and (not config.dry_run or
+                                 os.path.isfile(os.path.join(self.target_roots[0], manifest_filename))):
+            self.manifest = Manifest(self.target_roots[0])
+        self.journal = None
+        if job_queue is None and not config.dry_run:
+            self.journal = Journal(self.target_roots[0], args.resume)
+        self.albums = list()
+        self.skipped_albums = list()
+
+    def find_album_dirs(self):
+        album_dirs = list()
+        for dir_path, dir_names, file_names in os.walk(self.root):
+            dir_names.sort()
+            # never descend into the output trees, their files are not sources
+            dir_names[:] = [dir_name for dir_name in dir_names
+                            if os.path.realpath(os.path.join(dir_path, dir_name)) not in self.target_roots]
+            if any(f.endswith('.cue') or f.endswith('.flac') or f.endswith('.ape') or f.endswith('.wv')
+                   for f in file_names):
+                album_dirs.append(dir_path)
+        return album_dirs
+
+    def plan_album(self, album_dir):
+        config = self.config
+        cuefile = Cuefile(config=config)
+        tagging = Tagging(config=config)
+        codec = Codec(config=config, scheduler=self.scheduler, manifest=self.manifest, job_queue=self.job_queue,
+                      journal=self.journal)
+
+        cuefile.select_cuefile(album_dir)
+        if cuefile.mode == 1:
+            album_tags = tagging.get_album_tags_from_dir(album_dir)
+        else:
+            album_tags = tagging.get_album_tags_from_cuefile(cuefile)
+            cuefile.extract_single_lossless_file()
+            cuefile.extract_track_indexes()
+        if sum(len(tracktags) for tracktags in album_tags.values()) == 0:
+            raise AlbumError('no tracks found in {}'.format(album_dir))
+
+        codec.decode_input_files(album_tags, cuefile)
+        codec.convert_files(album_tags, os.path.relpath(album_dir, self.root), self.out_root)
+        return codec
+
+    def convert(self):
+        start_time = time.monotonic()
+        album_dirs = self.find_album_dirs()
+        print('found {} album(s) in {}'.format(len(album_dirs), self.root))
+        if self.job_queue is not None:
+            self.job_queue.add_run(self.config.args, self.target_roots[0] if self.manifest is not None else None)
+
+        for album_dir in album_dirs:
+            print('planning album {}...'.format(album_dir))
+            try:
+                codec = self.plan_album(album_dir)
+            except ConversionError as error:
+                # a malformed album must not stop the whole library
+                print(error)
+                print('skipping album {}'.format(album_dir))
+                self.skipped_albums.append(album_dir)
+                continue
+            except Exception as error:
+                print('skipping album {}: {}'.format(album_dir, repr(error)))
+                self.skipped_albums.append(album_dir)
+                continue
+            self.albums.append((album_dir, codec))
+
+        if self.job_queue is not None:
+            return self._queue_summary(album_dirs)
+        if self.config.dry_run:
+            return self._plan_summary()
+
+        try:
+            self.scheduler.run()
+        except KeyboardInterrupt:
+            for album_dir, codec in self.albums:
+                codec.collect_results()
+            print('interrupted')
+            return -1
+        finally:
+            self.journal.close()
+
+        n_tracks = 0
+        n_up_to_date_tracks = 0
+        failed_albums = list()
+        for album_dir, codec in self.albums:
+            n_failed_tracks = codec.collect_results()
+            n_tracks += sum(len(tracktags) for tracktags in codec.album_tags.values())
+            n_up_to_date_tracks += len(codec.up_to_date_tracks)
+            if n_failed_tracks > 0:
+                failed_albums.append((album_dir, n_failed_tracks))
+
+        n_failed_tracks = sum(n_failed for album_dir, n_failed in failed_albums)
+        print()
+        print('library summary')
+        print('  albums converted: {}/{}'.format(len(self.albums) - len(failed_albums), len(album_dirs)))
+        print('  tracks converted: {}/{}'.format(n_tracks - n_failed_tracks - n_up_to_date_tracks, n_tracks))
+        if self.manifest is not None:
+            print('  tracks up to date: {}/{}'.format(n_up_to_date_tracks, n_tracks))
+            self.manifest.close()
+        for album_dir, n_failed in failed_albums:
+            print('  {} track(s) failed in {}'.format(n_failed, album_dir))
+        for album_dir in self.skipped_albums:
+            print('  skipped {}'.format(album_dir))
+        temp_bytes = sum(codec.temp_bytes() for album_dir, codec in self.albums)
+        if temp_bytes > 0:
+            print('  temp files: {} byte(s)'.format(temp_bytes))
+        print('  elapsed: {:.2f}s'.format(time.monotonic() - start_time))
+
+        if len(failed_albums) > 0 or len(self.skipped_albums) > 0:
+            return -1
+        return 0
+
+    def _plan_summary(self):
+        plan = Plan(self.config.jobs)
+        for album_dir, codec in self.albums:
+            plan.add_album(codec.estimates.values())
+        print()
+        plan.print()
+        for album_dir in self.skipped_albums:
+            print('  skipped {}'.format(album_dir))
+        if self.manifest is not None:
+            self.manifest.close()
+        return -1 if len(self.skipped_albums) > 0 else 0
+
+    def _queue_summary(self, album_dirs):
+        print()
+        print('library summary')
+        print('  albums queued: {}/{}'.format(len(self.albums), len(album_dirs)))
+        print('  tracks queued: {}'.format(sum(codec.n_queued_tracks for album_dir, codec in self.albums)))
+        for album_dir in self.skipped_albums:
+            print('  skipped {}'.format(album_dir))
+        if self.manifest is not None:
+            self.manifest.close()
+        self.job_queue.close()
+        return -1 if len(self.skipped_albums) > 0 else 0
@@ -14,6 +14,7 @@ genre = 'genre'
 year = 'year'
 album = 'album'
 comment = 'comment'
+disc = 'disc'
 disctotal = 'disctotal'
 global_artist = 'global_artist'
 artist = 'artist'
@@ -22,8 +23,20 @@ infile = 'infile'
 outfile = 'outfile'
 cover = 'cover'
 losslessfile = 'losslessfile'
+start = 'start'
+end = 'end'
+duration = 'duration'
+stream_info = 'stream_info'
+
+# targets
+aac = 'aac'
 
 # encoding
 utf_8 = 'utf-8'
 cp1252 = 'cp1252'
 windows_1252 = 'windows-1252'
+
+# streaming modes
+stream_single = 'single'
+stream_pipe = 'pipe'
+stream_wav = 'wav'
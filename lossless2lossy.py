@@ -1,12 +1,30 @@
 #!/usr/bin/python3
 
 import argparse
+import os
+import signal
 import literals
+import toolchain
+import loudness
 
 from cuefile import Cuefile
 from tagging import Tagging
-from utility import check_tools
+from toolchain import check_tools
 from codec import Codec
+from library import Library
+from manifest import Manifest, manifest_filename
+from journal import Journal
+from planner import Plan
+from report import RunReport
+from scratch import Scratch
+from cover import CoverArt
+from target import parse_targets
+from jobqueue import JobQueue, Worker
+from scheduler import Scheduler
+from pools import Pools
+from service import Service
+from watch import Watcher
+from errors import ConfigError, ConversionError
 
 
 class ConvertConfig:
@@ -15,9 +33,7 @@ class ConvertConfig:
         self.encode_tools = dict()
         self.other_tools = dict()
         self.decoder = ''
-        self.encoder = ''
         self.splitter = ''
-        self.tagger = ''
         self.cuefile_encoding = literals.utf_8
         self.single_lossless_file = None
         self.args = args
@@ -26,24 +42,92 @@ class ConvertConfig:
                               literals.shntool : [literals.shntool, 'split', '-o', 'wav', '-O', 'always'],
                               literals.ffmpeg : [literals.ffmpeg],
                               literals.mac : [literals.mac],
-                              literals.wvunpack : literals.wvunpack }
+                              literals.wvunpack : [literals.wvunpack] }
         self.encode_tools = { literals.ffmpeg : [literals.ffmpeg],
                               literals.opus: [literals.ffmpeg],
                               literals.afconvert : [literals.afconvert, '-v', '-d', 'aac', '-f', 'm4af', '-u', 'pgcm', '2', '-q',
                                                     '127', '-s', '2', '--soundcheck-generate'] }
-        self.other_tools = { literals.ffmpeg : [literals.ffmpeg],
-                             literals.atomicparsley : [literals.atomicparsley, '--overWrite'] }
+        self.other_tools = { literals.ffmpeg : [literals.ffmpeg] }
         self.decoder = literals.ffmpeg
-        self.encoder = literals.ffmpeg
-#        self.encoder = literals.opus
-        self.splitter = literals.shntool
-        self.tagger = literals.atomicparsley
+        # the output formats, every track is decoded once for all of them
+        self.targets = parse_targets(args.targets)
+        # the aac backend of ffmpeg, check_tools picks the best one the build has
+        self.aac_encoder = toolchain.aac_encoders[0]
+        # the resampler of hi-res sources, check_tools picks soxr when the ffmpeg build has it
+        self.resampler = 'swr'
+        self.ffmpeg_version = None
+        self.toolchain = None
+        self.splitter = args.splitter
+        # encoders able to read the decoded PCM from their stdin
+        self.stdin_encoders = [literals.ffmpeg, literals.opus]
+        # afconvert encodes one file into one other, it cannot share the decode of a track with other targets
+        if len(self.targets) > 1 and any(target.encoder == literals.afconvert for target in self.targets):
+            raise ConfigError('{} encodes a single target, it cannot be given with other targets'.format(
+                literals.afconvert))
+        # ffmpeg based encoders write tags and cover themselves, atomicparsley is only needed otherwise
+        for target in self.targets:
+            if target.tagger is None:
+                target.tagger = args.tagger
+            if target.tagger is None:
+                target.tagger = literals.ffmpeg if target.encoder in self.stdin_encoders else literals.atomicparsley
+            elif target.tagger not in (literals.ffmpeg, literals.atomicparsley):
+                raise ConfigError('unknown tagger {} for target {}'.format(target.tagger, target.name))
+            elif target.tagger == literals.ffmpeg and target.encoder not in self.stdin_encoders:
+                print('warning: {} cannot write tags, tagging with {}'.format(target.encoder, literals.atomicparsley))
+                target.tagger = literals.atomicparsley
+            if target.tagger == literals.atomicparsley and target.extension != '.m4a':
+                print('warning: {} only tags mp4 files, tagging {} with {}'.format(literals.atomicparsley, target.name,
+                                                                                literals.ffmpeg))
+                target.tagger = literals.ffmpeg
+            if target.tagger == literals.atomicparsley:
+                self.other_tools[literals.atomicparsley] = [literals.atomicparsley, '--overWrite']
+        stdin_targets = all(target.encoder in self.stdin_encoders for target in self.targets)
+        self.stream = args.stream
+        if self.stream is None:
+            if not stdin_targets:
+                self.stream = literals.stream_wav
+            elif self.decoder == literals.ffmpeg:
+                self.stream = literals.stream_single
+            else:
+                self.stream = literals.stream_pipe
+        elif self.stream != literals.stream_wav and not stdin_targets:
+            print('warning: an encoder cannot read from stdin, falling back to intermediate wav files')
+            self.stream = literals.stream_wav
+        self.jobs = args.jobs if args.jobs is not None else (os.cpu_count() or 1)
+        self.io_jobs = args.io_jobs if args.io_jobs is not None else max(2, self.jobs // 2)
+        self.adaptive = not args.fixed_jobs
+        self.pin = args.pin
+        self.keep_going = args.keep_going
+        self.timeout = args.timeout
+        self.progress = not args.no_progress
+        # only the plan of the run is printed, nothing is converted or written to the outputs
+        self.dry_run = args.dry_run
+        # the existing outputs are only retagged, nothing is decoded or encoded
+        self.retag_only = args.retag_only
+        # the loudness of every converted track is measured on the pcm flowing through its encode
+        self.loudness = args.loudness
+        if self.loudness and not loudness.available():
+            print('warning: numpy is missing, the tracks are converted without loudness tags')
+            self.loudness = False
+        # a report without a path records nothing
+        self.report = RunReport(args.report)
+        self.scratch = Scratch(args.scratch, self.jobs)
+        self.cover_art = CoverArt(self, args.cover_size)
 
+    def scheduler(self, keep_going=None):
+        # every scheduler of a run gets pools of its own, sized by the options of the run
+        return Scheduler(self.jobs, self.keep_going if keep_going is None else keep_going, self.timeout,
+                         self.progress, self.report, Pools(self.jobs, self.io_jobs, self.adaptive, self.pin))
 
-def parser():
+
+def parser(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('-q', '--cuefile', type=str, help='specifies the cuefile to use for track info')
-    parser.add_argument('-c', '--cover', type=str, help='specifies the cover file')
+    parser.add_argument('-c', '--cover', type=str,
+                        help='specifies the cover file (default: the embedded art, or a cover.jpg or folder.jpg)')
+    parser.add_argument('--cover-size', type=int, default=1000,
+                        help='scales the cover down to the given number of pixels per side, 0 keeps it as it is '
+                             '(default: 1000)')
     parser.add_argument('-y', '--year', type=str, help='sets the year')
     parser.add_argument('-g', '--genre', type=str, help='sets the genre')
     parser.add_argument('-a', '--album', type=str, help='sets the album')
@@ -52,22 +136,148 @@ def parser():
     parser.add_argument('-n', '--disc', type=str, help='sets the disc number')
     parser.add_argument('-m', '--discs', type=str, help='sets the total number of discs')
     parser.add_argument('-b', '--bitrate', type=str, help='sets the bitrate')
+    parser.add_argument('--targets', type=str, default=literals.aac,
+                        help='comma separated output formats among aac and opus, each optionally followed by '
+                             ':encoder= (ffmpeg, or afconvert for aac alone), :bitrate=, :quality=, :path=, :tagger=, '
+                             ':rate= (Hz or source, by default sources above '
+                             '48 kHz come down to 48 or 44.1 kHz) and :dither= (none, triangular_hp...) settings, '
+                             'e.g. aac,opus:bitrate=160k; '
+                             'with several targets each one goes to its own subdirectory of the output path unless '
+                             'given a path (default: aac)')
     parser.add_argument('-d', '--path', type=str, help='sets the sets the output path for the converted files')
-    args = parser.parse_args()
+    parser.add_argument('-j', '--jobs', type=int, help='sets the maximum number of concurrent encodes (default: core count)')
+    parser.add_argument('--io-jobs', type=int,
+                        help='sets the maximum number of concurrent decodes, splits, taggings and file moves, which '
+                             'run next to the encodes (default: half the jobs, at least 2)')
+    parser.add_argument('--fixed-jobs', action='store_true',
+                        help='keeps the encodes and the other jobs at their maximum instead of backing off while the '
+                             'host is busy with other work')
+    parser.add_argument('--pin', action='store_true', help='pins every running encode to a core of its own')
+    parser.add_argument('--keep-going', action='store_true',
+                        help='keeps converting the other tracks when a job fails instead of stopping')
+    parser.add_argument('--timeout', type=float,
+                        help='kills a job that shows no activity for the given number of seconds')
+    parser.add_argument('--report', type=str,
+                        help='writes per track and per stage timings and resource usage to the given json file')
+    parser.add_argument('--scratch', type=str,
+                        help='directory for the intermediate wav files (default: /dev/shm when they fit, otherwise '
+                             'the system temp directory)')
+    parser.add_argument('--no-progress', action='store_true', help='does not show the progress of the running encodes')
+    parser.add_argument('-s', '--stream', type=str,
+                        choices=[literals.stream_single, literals.stream_pipe, literals.stream_wav],
+                        help='single: one ffmpeg decodes and encodes, pipe: the decoder is piped into the encoder, '
+                             'wav: decodes to an intermediate wav file (default: best supported by the encoder)')
+    parser.add_argument('--splitter', type=str, choices=[literals.shntool],
+                        help='pre-splits a single lossless file with the given tool instead of seeking into it')
+    parser.add_argument('-t', '--tagger', type=str, choices=[literals.ffmpeg, literals.atomicparsley],
+                        help='ffmpeg: tags and cover are written while encoding, atomicparsley: tags in a separate '
+                             'pass (default: ffmpeg when the encoder supports it)')
+    parser.add_argument('--loudness', action='store_true',
+                        help='measures the EBU R128 loudness and true peak of every track while it is encoded and '
+                             'tags ReplayGain and iTunNORM, or the R128 gains of opus; the album gain needs every track '
+                             'of the album converted in the same run (needs numpy)')
+    parser.add_argument('-l', '--library', type=str,
+                        help='converts every album found under the given root, mirroring its tree in the output path')
+    parser.add_argument('--queue', type=str,
+                        help='queues the tracks in the given sqlite file, on storage shared with the workers, instead '
+                             'of converting them')
+    parser.add_argument('--worker', action='store_true',
+                        help='with --queue: converts the queued tracks until the queue is drained, with the options '
+                             'they were queued with; -j, --keep-going, --timeout, --scratch and --report are the '
+                             'worker\'s own')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='keeps a manifest in the output path and only converts or retags the tracks that changed')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='prints the plan of the run, longest tracks first, with the estimated cpu seconds, temp '
+                             'and output bytes of every track and the predicted wall time for the given --jobs, '
+                             'without converting anything')
+    parser.add_argument('--retag-only', action='store_true',
+                        help='only rewrites the tags of the outputs that already exist, mp4 files in process without '
+                             'decoding their audio; with --incremental only those whose source or tags changed')
+    parser.add_argument('--resume', action='store_true',
+                        help='skips the tracks that the previous run, crashed or interrupted, had already finished')
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help='converts the albums posted as json to http://127.0.0.1:PORT/albums until interrupted, '
+                             'with the other options as defaults')
+    parser.add_argument('--watch', type=str, metavar='DIR',
+                        help='watches the given landing directory and converts every album copied into it, once its '
+                             'files are complete, until interrupted')
+    parser.add_argument('--quiet-period', type=float, default=5.0,
+                        help='with --watch: seconds without any change after which an album is complete (default: 5)')
+    parser.add_argument('--albums', type=int, default=1,
+                        help='with --serve or --watch: sets the number of albums converted at once (default: 1)')
+    args = parser.parse_args(argv)
     return args
 
 
 def main():
     args = parser()
-    config = ConvertConfig(args=args)
+    try:
+        config = ConvertConfig(args=args)
+    except ConversionError as error:
+        print(error)
+        return -1
+    # a terminated run cleans up like an interrupted one
+    signal.signal(signal.SIGTERM, lambda signum, frame: signal.raise_signal(signal.SIGINT))
+    try:
+        return convert(config)
+    except ConversionError as error:
+        print(error)
+        return -1
+    except KeyboardInterrupt:
+        print('interrupted')
+        return -1
+    finally:
+        config.scratch.cleanup()
+        config.report.write(config)
+
+
+def convert(config):
+    args = config.args
     cuefile = Cuefile(config=config)
     tagging = Tagging(config=config)
-    codec = Codec(config=config)
     check = check_tools(config)
 
     if not check:
         return -1
 
+    if args.dry_run and (args.queue is not None or args.serve is not None or args.watch is not None):
+        print('--dry-run plans a local conversion, it cannot be used with --queue, --serve or --watch')
+        return -1
+
+    job_queue = None
+    if args.worker and args.queue is None:
+        print('--worker needs the --queue to pull the jobs from')
+        return -1
+    if args.queue is not None:
+        if args.splitter is not None:
+            print('queued tracks are read straight from their image, --splitter cannot be used with --queue')
+            return -1
+        job_queue = JobQueue(args.queue)
+        if args.worker:
+            try:
+                return Worker(config, job_queue).run()
+            finally:
+                job_queue.close()
+
+    if args.serve is not None:
+        if job_queue is not None or args.library is not None or args.watch is not None:
+            print('--serve converts the albums it is sent, it cannot be used with --queue, --library or --watch')
+            return -1
+        return Service(config, args.serve, args.albums).serve()
+
+    if args.watch is not None:
+        if job_queue is not None or args.library is not None:
+            print('--watch converts the albums it finds, it cannot be used with --queue or --library')
+            return -1
+        if not os.path.isdir(os.path.expanduser(args.watch)):
+            print('cannot watch {}: not a directory'.format(args.watch))
+            return -1
+        return Watcher(config, args.watch, args.quiet_period, args.albums).run()
+
+    if args.library is not None:
+        return Library(config=config, job_queue=job_queue).convert()
+
     cuefile.select_cuefile()
     album_tags = None
 
@@ -76,11 +286,49 @@ def main():
     elif cuefile.mode == 0:
         album_tags = tagging.get_album_tags_from_cuefile(cuefile)
         cuefile.extract_single_lossless_file()
+        cuefile.extract_track_indexes()
+
+    if args.path is not None and os.path.isdir(os.path.expanduser(args.path)):
+        out_root = os.path.realpath(os.path.expanduser(args.path))
+    else:
+        out_root = os.getcwd()
+    # one manifest and one journal for all targets, they live with the first one
+    out_root = config.targets[0].root(out_root)
+    if not args.dry_run:
+        os.makedirs(out_root, exist_ok=True)
+    manifest = None
+    manifest_root = None
+    # a dry run reads the manifest of earlier runs, if any, to plan what --incremental would convert
+    if args.incremental and (not args.dry_run or os.path.isfile(os.path.join(out_root, manifest_filename))):
+        manifest = Manifest(out_root)
+        manifest_root = out_root
+    # queued tracks are finished by the workers, the queue keeps track of them
+    journal = Journal(out_root, args.resume) if job_queue is None and not args.dry_run else None
 
+    codec = Codec(config=config, manifest=manifest, job_queue=job_queue, journal=journal)
     codec.decode_input_files(album_tags, cuefile)
+    if job_queue is not None:
+        job_queue.add_run(args, manifest_root)
     codec.convert_files(album_tags)
+    if args.dry_run:
+        plan = Plan(config.jobs)
+        plan.add_album(codec.estimates.values())
+        print()
+        plan.print()
+    elif job_queue is not None:
+        print('{} track(s) queued in {}'.format(codec.n_queued_tracks, args.queue))
+        job_queue.close()
+    else:
+        try:
+            codec.run()
+        finally:
+            journal.close()
+            if codec.temp_bytes() > 0:
+                print('{} byte(s) written to temp files'.format(codec.temp_bytes()))
+    if manifest is not None:
+        manifest.close()
     return 0
 
 
 if __name__ == '__main__':
-    main()
+    exit(main())
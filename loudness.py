@@ -0,0 +1,328 @@
+import os
+import math
+import threading
+import functools
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# ITU-R BS.1770 / EBU R128 gating
+absolute_gate = -70.0
+relative_gate = -10.0
+# block loudness histogram: bins of 0.01 LU from the absolute gate up to +5 LUFS
+histogram_bins = 7500
+histogram_step = 0.01
+# reference loudness of ReplayGain 2.0 and of the R128 gains of Ogg Opus (RFC 7845)
+replaygain_reference = -18.0
+r128_reference = -23.0
+# the gains of an opus output, a retag keeps them
+opus_gain_tags = ('R128_TRACK_GAIN', 'R128_ALBUM_GAIN')
+# the analysed PCM: 32 bit float, interleaved, on the stdout of the encoder
+pcm_format = 'f32le'
+pcm_codec = 'pcm_f32le'
+# the pcm is analysed in batches of this many seconds, the numpy calls cost less on longer arrays
+batch_seconds = 1.0
+# 4x oversampling for the true peak, 12 taps per phase
+oversampling = 4
+phase_taps = 12
+
+
+# the executor the meters of a run share, made on first use
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def available():
+    return numpy is not None
+
+
+def analysis_executor():
+    # numpy releases the GIL in its transforms and products, the tracks are analysed on every core
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='loudness')
+        return _executor
+
+
+def k_weighting(sample_rate):
+    # (b, a) of the two biquads of the K-weighting filter, high shelf then high pass, as in libebur128,
+    # for any sample rate
+    k = math.tan(math.pi * 1681.974450955533 / sample_rate)
+    q = 0.7071752369554196
+    vh = math.pow(10.0, 3.999843853973347 / 20.0)
+    vb = math.pow(vh, 0.4996667741545416)
+    a0 = 1.0 + k / q + k * k
+    shelf_b = [(vh + vb * k / q + k * k) / a0, 2.0 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0]
+    shelf_a = [1.0, 2.0 * (k * k - 1.0) / a0, (1.0 - k / q + k * k) / a0]
+    k = math.tan(math.pi * 38.13547087602444 / sample_rate)
+    q = 0.5003270373238773
+    a0 = 1.0 + k / q + k * k
+    pass_b = [1.0, -2.0, 1.0]
+    pass_a = [1.0, 2.0 * (k * k - 1.0) / a0, (1.0 - k / q + k * k) / a0]
+    return (shelf_b, shelf_a), (pass_b, pass_a)
+
+
+@functools.lru_cache(maxsize=None)
+def block_filter(sample_rate, n_frames):
+    # the two biquads as one 4 state system (transposed direct form II), stepped n_frames samples at a
+    # time: s' = a s + b x, y = c s + d x. Over a block, the output is the convolution of the block with
+    # the impulse response plus the response to the state left by the previous block, and the state left
+    # for the next block is a linear function of the samples, so whole blocks go through matrix products
+    # and one rfft, exactly as a sample by sample recurrence would
+    systems = list()
+    for b, a in k_weighting(sample_rate):
+        systems.append((numpy.array([[-a[1], 1.0], [-a[2], 0.0]]),
+                        numpy.array([b[1] - a[1] * b[0], b[2] - a[2] * b[0]]), numpy.array([1.0, 0.0]), b[0]))
+    (a1, b1, c1, d1), (a2, b2, c2, d2) = systems
+    a = numpy.block([[a1, numpy.zeros((2, 2))], [numpy.outer(b2, c1), a2]])
+    b = numpy.concatenate((b1, b2 * d1))
+    c = numpy.concatenate((d2 * c1, c2))
+    d = d2 * d1
+
+    # c a^n for the response to the state, a^n b for the impulse response and for the next state
+    state_response = numpy.empty((n_frames, 4))
+    input_response = numpy.empty((n_frames, 4))
+    row, column = c, b
+    for n in range(n_frames):
+        state_response[n] = row
+        input_response[n] = column
+        row, column = row @ a, a @ column
+    impulse_response = numpy.concatenate(([d], input_response[:-1] @ c))
+    # long enough for the convolution not to wrap around, 100 ms at the usual rates has small factors
+    n_fft = 2 * n_frames
+    return (numpy.fft.rfft(impulse_response, n_fft), n_fft, state_response, input_response[::-1],
+            numpy.linalg.matrix_power(a, n_frames))
+
+
+def channel_weights(channels):
+    # 5.1 in the ffmpeg order: the lfe does not count, the surround channels count 1.41 times
+    if channels == 6:
+        return numpy.array([1.0, 1.0, 1.0, 0.0, 1.41, 1.41])
+    return numpy.ones(channels)
+
+
+def oversampling_filter():
+    # windowed sinc interpolator, one row of phase_taps coefficients per phase
+    n = numpy.arange(oversampling * phase_taps) - (oversampling * phase_taps - 1) / 2.0
+    taps = numpy.sinc(n / oversampling) * numpy.hanning(len(n))
+    phases = taps.reshape(phase_taps, oversampling).T
+    return (phases / phases.sum(axis=1, keepdims=True)).astype(numpy.float32)
+
+
+class Loudness:
+    """
+    What is kept of a track: the histogram of its 400 ms block loudnesses (counts and summed
+    energies per bin) and its true peak. Histograms add up, so the album loudness is computed from
+    the histograms of its tracks, without their audio.
+    """
+    def __init__(self, counts=None, energies=None, peak=0.0):
+        self.counts = counts if counts is not None else numpy.zeros(histogram_bins, dtype=numpy.int64)
+        self.energies = energies if energies is not None else numpy.zeros(histogram_bins)
+        self.peak = peak
+
+    def __add__(self, other):
+        return Loudness(self.counts + other.counts, self.energies + other.energies, max(self.peak, other.peak))
+
+    def integrated(self):
+        # integrated loudness in LUFS, None for silence
+        if self.counts.sum() == 0:
+            return None
+        threshold = energy_to_loudness(self.energies.sum() / self.counts.sum()) + relative_gate
+        first_bin = max(0, int(math.floor((threshold - absolute_gate) / histogram_step)))
+        n_blocks = self.counts[first_bin:].sum()
+        if n_blocks == 0:
+            return None
+        return energy_to_loudness(self.energies[first_bin:].sum() / n_blocks)
+
+
+def energy_to_loudness(energy):
+    return -0.691 + 10.0 * math.log10(energy) if energy > 0 else -math.inf
+
+
+class AnalysisQueue:
+    """
+    The batches of one track, handed to analyse one at a time and in order by a shared executor, so
+    that whoever puts them (the event loop reading the encoder) only copies the pcm. A single task
+    runs while batches are waiting, it ends when the queue is empty. join() waits for the batches
+    put so far and raises the error of the analysis, if any; the batches after an error are dropped.
+    """
+    def __init__(self, analyse, executor):
+        self.analyse = analyse
+        self.executor = executor
+        self.batches = collections.deque()
+        self.lock = threading.Lock()
+        self.running = None
+        self.error = None
+
+    def put(self, data):
+        with self.lock:
+            self.batches.append(data)
+            if self.running is None:
+                self.running = self.executor.submit(self._run)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if len(self.batches) == 0 or self.error is not None:
+                    self.batches.clear()
+                    self.running = None
+                    return
+                data = self.batches.popleft()
+            try:
+                self.analyse(data)
+            except Exception as exception:
+                self.error = exception
+
+    def join(self):
+        with self.lock:
+            running = self.running
+        if running is not None:
+            running.result()
+        if self.error is not None:
+            raise self.error
+
+
+class LoudnessMeter:
+    """
+    EBU R128 integrated loudness and true peak of a PCM stream fed in chunks of any size, as it
+    flows out of the encoder. The stream is cut in 100 ms sub-blocks that go through the K-weighting
+    biquads all at once (see block_filter), the filter state carried from one sub-block to the next as
+    in a sample by sample filter; four consecutive sub-blocks make a 400 ms gating block, with the
+    75 % overlap of BS.1770. The true peak comes from a 4x polyphase interpolation of the whole chunk.
+    Chunks are gathered in batches of batch_seconds, flush analyses what is left at the end of the
+    stream. Only the filter state, the last three sub-block energies and a few samples are carried
+    from one batch to the next. With an executor the batches are analysed by it (see AnalysisQueue),
+    flush then waits for them before it analyses the rest.
+    """
+    def __init__(self, sample_rate, channels, executor=None):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.frame_bytes = 4 * channels
+        self.block_frames = sample_rate // 10
+        self.impulse_spectrum, self.n_fft, self.state_response, self.input_response, self.state_step = \
+            block_filter(sample_rate, self.block_frames)
+        # the 4 filter states of every channel at the start of the next sub-block
+        self.state = numpy.zeros((channels, 4))
+        self.channel_weights = channel_weights(channels)
+        self.phases = oversampling_filter()
+        self.pending = b''
+        # frames not yet filling a sub-block, and the end of the previous chunk for the interpolation
+        self.leftover = numpy.zeros((0, channels), dtype=numpy.float32)
+        self.history = numpy.zeros((phase_taps - 1, channels), dtype=numpy.float32)
+        self.recent_energies = numpy.zeros(0)
+        self.chunks = list()
+        self.n_chunk_bytes = 0
+        self.batch_bytes = int(batch_seconds * sample_rate) * self.frame_bytes
+        self.loudness = Loudness()
+        self.queue = None if executor is None else AnalysisQueue(self._analyse, executor)
+
+    def feed(self, data):
+        self.chunks.append(data)
+        self.n_chunk_bytes += len(data)
+        if self.n_chunk_bytes >= self.batch_bytes:
+            data = b''.join(self.chunks)
+            self.chunks = list()
+            self.n_chunk_bytes = 0
+            if self.queue is not None:
+                self.queue.put(data)
+            else:
+                self._analyse(data)
+
+    def flush(self):
+        if self.queue is not None:
+            self.queue.join()
+        data = b''.join(self.chunks)
+        self.chunks = list()
+        self.n_chunk_bytes = 0
+        self._analyse(data)
+
+    def _analyse(self, data):
+        data = self.pending + data
+        usable = len(data) - len(data) % self.frame_bytes
+        self.pending = data[usable:]
+        if usable == 0:
+            return
+        frames = numpy.frombuffer(data, dtype='<f4', count=usable // 4).reshape(-1, self.channels)
+        self._true_peak(frames)
+
+        frames = numpy.concatenate((self.leftover, frames))
+        n_blocks = len(frames) // self.block_frames
+        self.leftover = frames[n_blocks * self.block_frames:]
+        if n_blocks == 0:
+            return
+        # sub-block, channel, sample: the transforms and products run along contiguous samples
+        blocks = frames[:n_blocks * self.block_frames].reshape(n_blocks, self.block_frames, self.channels)
+        blocks = numpy.ascontiguousarray(blocks.transpose(0, 2, 1), dtype=numpy.float64)
+        spectra = numpy.fft.rfft(blocks, self.n_fft) * self.impulse_spectrum
+        weighted = numpy.fft.irfft(spectra, self.n_fft)[:, :, :self.block_frames]
+        # the state at the start of every sub-block, from the one before it: 4x4 steps, a few per batch
+        inputs = blocks @ self.input_response
+        states = numpy.empty((n_blocks, self.channels, 4))
+        for n_block in range(n_blocks):
+            states[n_block] = self.state
+            self.state = self.state @ self.state_step.T + inputs[n_block]
+        weighted += states @ self.state_response.T
+        mean_squares = numpy.einsum('bck,bck->bc', weighted, weighted) / self.block_frames
+        energies = numpy.concatenate((self.recent_energies, mean_squares @ self.channel_weights))
+        if len(energies) >= 4:
+            gating_blocks = (energies[:-3] + energies[1:-2] + energies[2:-1] + energies[3:]) / 4.0
+            self._count(gating_blocks)
+        self.recent_energies = energies[-3:]
+
+    def _count(self, energies):
+        with numpy.errstate(divide='ignore'):
+            loudnesses = -0.691 + 10.0 * numpy.log10(energies)
+        bins = numpy.floor((loudnesses - absolute_gate) / histogram_step)
+        gated = bins >= 0
+        bins = numpy.minimum(bins[gated], histogram_bins - 1).astype(numpy.int64)
+        self.loudness.counts += numpy.bincount(bins, minlength=histogram_bins)
+        self.loudness.energies += numpy.bincount(bins, weights=energies[gated], minlength=histogram_bins)
+
+    def _true_peak(self, frames):
+        samples = numpy.concatenate((self.history, frames))
+        self.history = samples[-(phase_taps - 1):]
+        # every window of phase_taps samples times every phase, in one matrix product
+        windows = numpy.lib.stride_tricks.sliding_window_view(samples, phase_taps, axis=0)
+        interpolated = windows @ self.phases.T
+        peak = max(float(numpy.abs(frames).max()), float(numpy.abs(interpolated).max()))
+        self.loudness.peak = max(self.loudness.peak, peak)
+
+
+def gain_tags(container, track, album=None):
+    # the tags of a track of the given container ('.m4a' or '.opus'), album is None when unknown
+    track_loudness = track.integrated()
+    if track_loudness is None:
+        return dict()
+    album_loudness = album.integrated() if album is not None else None
+    tags = dict()
+    if container == '.opus':
+        # RFC 7845: Q7.8 gains towards -23 LUFS, and no ReplayGain tags
+        tags[opus_gain_tags[0]] = str(int(round((r128_reference - track_loudness) * 256)))
+        if album_loudness is not None:
+            tags[opus_gain_tags[1]] = str(int(round((r128_reference - album_loudness) * 256)))
+        return tags
+    track_gain = replaygain_reference - track_loudness
+    tags['replaygain_track_gain'] = '{:.2f} dB'.format(track_gain)
+    tags['replaygain_track_peak'] = '{:.6f}'.format(track.peak)
+    if album_loudness is not None:
+        tags['replaygain_album_gain'] = '{:.2f} dB'.format(replaygain_reference - album_loudness)
+        tags['replaygain_album_peak'] = '{:.6f}'.format(album.peak)
+    tags['iTunNORM'] = itunnorm(track_gain, track.peak)
+    return tags
+
+
+def itunnorm(gain, peak):
+    # Sound Check: the volume adjustment for 1/1000 W and 1/2500 W (twice, for left and right), then
+    # the unused positions and the peak as a 16 bit sample value
+    adjustment_1000 = min(0xffffffff, int(round(1000.0 * math.pow(10.0, -gain / 10.0))))
+    adjustment_2500 = min(0xffffffff, int(round(2500.0 * math.pow(10.0, -gain / 10.0))))
+    peak_value = min(0xffffffff, int(round(peak * 32768.0)))
+    values = [adjustment_1000, adjustment_1000, adjustment_2500, adjustment_2500, 0x24ca8, 0x24ca8,
+              peak_value, peak_value, 0x24ca8, 0x24ca8]
+    return ''.join(' {:08X}'.format(value) for value in values)
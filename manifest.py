@@ -0,0 +1,66 @@
+import os
+import json
+import sqlite3
+import threading
+
+manifest_filename = '.lossless2lossy.sqlite'
+
+# what a track needs on this run
+up_to_date = 'up_to_date'
+retag = 'retag'
+convert = 'convert'
+
+
+class Manifest:
+    """
+    Persistent record of every converted track, stored as a sqlite file in the output root.
+    A track is keyed by its output path (relative to the root) and remembers the source it was
+    converted from (path, size, mtime), the encoder command and the tag values it was written with,
+    so a rerun only converts what changed and only retags when nothing but tags changed.
+    """
+    def __init__(self, out_root):
+        self.out_root = out_root
+        self.path = os.path.join(out_root, manifest_filename)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS tracks ('
+                                 'outfile TEXT PRIMARY KEY, source TEXT, source_size INTEGER, '
+                                 'source_mtime INTEGER, encoder TEXT, tags TEXT)')
+        self._connection.commit()
+
+    def _key(self, outfile):
+        return os.path.relpath(os.path.realpath(outfile), os.path.realpath(self.out_root))
+
+    def _source_stat(self, source):
+        try:
+            stat = os.stat(source)
+        except OSError:
+            return None, None
+        return stat.st_size, stat.st_mtime_ns
+
+    def status(self, outfile, source, encoder_cmd, tags):
+        if not os.path.isfile(outfile):
+            return convert
+        with self._lock:
+            row = self._connection.execute('SELECT source, source_size, source_mtime, encoder, tags FROM tracks '
+                                           'WHERE outfile = ?', (self._key(outfile),)).fetchone()
+        if row is None:
+            return convert
+        source_size, source_mtime = self._source_stat(source)
+        if row[0] != source or row[1] != source_size or row[2] != source_mtime or row[3] != json.dumps(encoder_cmd):
+            return convert
+        if row[4] != json.dumps(tags, sort_keys=True):
+            return retag
+        return up_to_date
+
+    def record(self, outfile, source, encoder_cmd, tags):
+        source_size, source_mtime = self._source_stat(source)
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?)',
+                                     (self._key(outfile), source, source_size, source_mtime, json.dumps(encoder_cmd),
+                                      json.dumps(tags, sort_keys=True)))
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
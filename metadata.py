@@ -0,0 +1,437 @@
+import os
+import struct
+
+# tag names as ffmpeg reports them, which is what Tagging expects
+artist = 'artist'
+album = 'album'
+album_artist = 'album_artist'
+date = 'date'
+disc = 'disc'
+disctotal = 'disctotal'
+title = 'title'
+genre = 'genre'
+track = 'track'
+comment = 'comment'
+# not a tag: the embedded cover art
+picture = 'picture'
+
+vorbis_keys = { 'ARTIST': artist, 'ALBUM': album, 'ALBUMARTIST': album_artist, 'ALBUM ARTIST': album_artist,
+                'DATE': date, 'YEAR': date, 'DISCNUMBER': disc, 'DISC': disc, 'DISCTOTAL': disctotal,
+                'TOTALDISCS': disctotal, 'TITLE': title, 'GENRE': genre, 'TRACKNUMBER': track, 'TRACK': track,
+                'COMMENT': comment, 'DESCRIPTION': comment }
+ape_keys = { 'ARTIST': artist, 'ALBUM': album, 'ALBUM ARTIST': album_artist, 'ALBUMARTIST': album_artist,
+             'YEAR': date, 'DATE': date, 'DISC': disc, 'DISCNUMBER': disc, 'DISCTOTAL': disctotal,
+             'TITLE': title, 'GENRE': genre, 'TRACK': track, 'TRACKNUMBER': track, 'COMMENT': comment }
+mp4_keys = { b'\xa9ART': artist, b'\xa9alb': album, b'aART': album_artist, b'\xa9day': date, b'\xa9nam': title,
+             b'\xa9gen': genre, b'\xa9cmt': comment }
+# the id3v1 genre list, used by the legacy mp4 'gnre' atom
+id3_genres = ('Blues', 'Classic Rock', 'Country', 'Dance', 'Disco', 'Funk', 'Grunge', 'Hip-Hop', 'Jazz', 'Metal',
+              'New Age', 'Oldies', 'Other', 'Pop', 'R&B', 'Rap', 'Reggae', 'Rock', 'Techno', 'Industrial',
+              'Alternative', 'Ska', 'Death Metal', 'Pranks', 'Soundtrack', 'Euro-Techno', 'Ambient', 'Trip-Hop',
+              'Vocal', 'Jazz+Funk', 'Fusion', 'Trance', 'Classical', 'Instrumental', 'Acid', 'House', 'Game',
+              'Sound Clip', 'Gospel', 'Noise', 'AlternRock', 'Bass', 'Soul', 'Punk', 'Space', 'Meditative',
+              'Instrumental Pop', 'Instrumental Rock', 'Ethnic', 'Gothic', 'Darkwave', 'Techno-Industrial',
+              'Electronic', 'Pop-Folk', 'Eurodance', 'Dream', 'Southern Rock', 'Comedy', 'Cult', 'Gangsta',
+              'Top 40', 'Christian Rap', 'Pop/Funk', 'Jungle', 'Native American', 'Cabaret', 'New Wave',
+              'Psychadelic', 'Rave', 'Showtunes', 'Trailer', 'Lo-Fi', 'Tribal', 'Acid Punk', 'Acid Jazz', 'Polka',
+              'Retro', 'Musical', 'Rock & Roll', 'Hard Rock')
+
+mp4_containers = (b'moov', b'udta', b'ilst')
+mp4_stream_containers = (b'moov', b'mdia', b'minf', b'stbl')
+wavpack_sample_rates = (6000, 8000, 9600, 11025, 12000, 16000, 22050, 24000, 32000, 44100, 48000, 64000, 88200,
+                        96000, 192000)
+
+# stream info fields
+sample_rate = 'sample_rate'
+channels = 'channels'
+bits = 'bits'
+total_samples = 'total_samples'
+
+
+# flac picture type of the front cover, and the apev2 item holding it
+flac_front_cover = 3
+ape_front_cover = 'COVER ART (FRONT)'
+
+
+class MetadataReader:
+    """
+    Reads the tags of a lossless (or m4a) file in process, touching only the header blocks:
+    FLAC Vorbis comments, APEv2 tags (APE, WavPack) and MP4 'ilst' atoms.
+    Values are returned as raw bytes keyed by the ffmpeg tag name, decoding is up to the caller.
+    read_picture() returns the embedded cover art the same way, read_comments() the raw vorbis
+    comments of FLAC and Ogg files (the gains of an opus output among them).
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+    def read_tags(self):
+        with open(self.filename, 'rb') as fd:
+            head = fd.read(12)
+            offset = self._skip_id3v2(fd, head)
+            if offset > 0:
+                fd.seek(offset)
+                head = fd.read(12)
+
+            if head[0:4] == b'fLaC':
+                return self._read_flac_tags(fd, offset + 4)
+            if head[4:8] == b'ftyp':
+                tags = self._read_mp4_tags(fd)
+            else:
+                # APE and WavPack files carry an APEv2 tag at their end
+                tags = self._read_ape_tags(fd)
+            tags.pop(picture, None)
+            return tags
+
+    def read_comments(self):
+        # every vorbis comment of a FLAC or Ogg (Opus, Vorbis) file, raw: upper case key -> bytes, as written
+        with open(self.filename, 'rb') as fd:
+            head = fd.read(4)
+            block = None
+            if head == b'OggS':
+                block = self._read_ogg_comment_block(fd)
+            elif head == b'fLaC':
+                while True:
+                    block_header = fd.read(4)
+                    if len(block_header) < 4:
+                        break
+                    block_length = int.from_bytes(block_header[1:4], 'big')
+                    if block_header[0] & 0x7f == 4:
+                        block = fd.read(block_length)
+                        break
+                    if block_header[0] & 0x80:
+                        break
+                    fd.seek(block_length, os.SEEK_CUR)
+            comments = dict()
+            for key, value in self._vorbis_comments(block) if block is not None else ():
+                comments.setdefault(key, value)
+            return comments
+
+    def read_stream_info(self):
+        # sample rate, channels, bits per sample and length in samples, from the headers only
+        with open(self.filename, 'rb') as fd:
+            head = fd.read(12)
+            offset = self._skip_id3v2(fd, head)
+            fd.seek(offset)
+            head = fd.read(12)
+
+            if head[0:4] == b'fLaC':
+                return self._read_flac_stream_info(fd, offset + 4)
+            if head[0:4] == b'wvpk':
+                return self._read_wavpack_stream_info(fd, offset)
+            if head[0:4] == b'MAC ':
+                return self._read_ape_stream_info(fd, offset)
+            if head[4:8] == b'ftyp':
+                return self._read_mp4_stream_info(fd)
+            return None
+
+    def read_picture(self):
+        # the image bytes of the embedded front cover (or of the first picture), None without any
+        with open(self.filename, 'rb') as fd:
+            head = fd.read(12)
+            offset = self._skip_id3v2(fd, head)
+            fd.seek(offset)
+            head = fd.read(12)
+
+            if head[0:4] == b'fLaC':
+                return self._read_flac_picture(fd, offset + 4)
+            if head[4:8] == b'ftyp':
+                tags = self._read_mp4_tags(fd)
+            else:
+                tags = self._read_ape_tags(fd)
+            return tags.get(picture)
+
+    def _read_flac_picture(self, fd, offset):
+        pictures = list()
+        fd.seek(offset)
+        while True:
+            block_header = fd.read(4)
+            if len(block_header) < 4:
+                break
+            is_last = block_header[0] & 0x80
+            block_type = block_header[0] & 0x7f
+            block_length = int.from_bytes(block_header[1:4], 'big')
+            if block_type == 6:
+                block = fd.read(block_length)
+                picture_type, mime_length = struct.unpack_from('>II', block, 0)
+                description_length = struct.unpack_from('>I', block, 8 + mime_length)[0]
+                data_offset = 12 + mime_length + description_length + 16
+                data_length = struct.unpack_from('>I', block, data_offset)[0]
+                pictures.append((picture_type != flac_front_cover, block[data_offset + 4:data_offset + 4 + data_length]))
+            else:
+                fd.seek(block_length, os.SEEK_CUR)
+            if is_last:
+                break
+        if len(pictures) == 0:
+            return None
+        return min(pictures, key=lambda picture: picture[0])[1]
+
+    def _read_flac_stream_info(self, fd, offset):
+        fd.seek(offset)
+        block_header = fd.read(4)
+        if len(block_header) < 4 or block_header[0] & 0x7f != 0:
+            return None
+        block = fd.read(34)
+        packed = int.from_bytes(block[10:18], 'big')
+        return { sample_rate: packed >> 44, channels: ((packed >> 41) & 0x7) + 1, bits: ((packed >> 36) & 0x1f) + 1,
+                 total_samples: packed & 0xfffffffff }
+
+    def _read_wavpack_stream_info(self, fd, offset):
+        fd.seek(offset)
+        header = fd.read(32)
+        if len(header) < 32:
+            return None
+        total_samples_low, flags = struct.unpack_from('<I', header, 12)[0], struct.unpack_from('<I', header, 24)[0]
+        rate_index = (flags >> 23) & 0xf
+        if rate_index >= len(wavpack_sample_rates) or total_samples_low == 0xffffffff:
+            return None
+        return { sample_rate: wavpack_sample_rates[rate_index], channels: 1 if flags & 0x4 else 2,
+                 bits: ((flags & 0x3) + 1) * 8, total_samples: total_samples_low + (header[11] << 32) }
+
+    def _read_ape_stream_info(self, fd, offset):
+        fd.seek(offset)
+        header = fd.read(76)
+        version = struct.unpack_from('<H', header, 4)[0]
+        if version >= 3980:
+            descriptor_bytes = struct.unpack_from('<I', header, 8)[0]
+            fd.seek(offset + descriptor_bytes)
+            ape_header = fd.read(24)
+            (compression, format_flags, blocks_per_frame, final_frame_blocks, total_frames, bits_per_sample,
+             n_channels, rate) = struct.unpack('<HHIIIHHI', ape_header)
+        else:
+            (compression, format_flags, n_channels, rate, header_bytes, terminating_bytes, total_frames,
+             final_frame_blocks) = struct.unpack_from('<HHHIIIII', header, 6)
+            if version >= 3950:
+                blocks_per_frame = 73728 * 4
+            elif version >= 3900 or (version >= 3800 and compression == 4000):
+                blocks_per_frame = 73728
+            else:
+                blocks_per_frame = 9216
+            bits_per_sample = 8 if format_flags & 0x1 else (24 if format_flags & 0x8 else 16)
+        if total_frames == 0:
+            return None
+        return { sample_rate: rate, channels: n_channels, bits: bits_per_sample,
+                 total_samples: (total_frames - 1) * blocks_per_frame + final_frame_blocks }
+
+    def _read_mp4_stream_info(self, fd):
+        fd.seek(0, os.SEEK_END)
+        return self._walk_mp4_stream_atoms(fd, 0, fd.tell())
+
+    def _walk_mp4_stream_atoms(self, fd, start, end, track_info=None):
+        # the stream info of the first sound track; track_info gathers what the atoms of a track tell
+        position = start
+        while position + 8 <= end:
+            fd.seek(position)
+            atom_size, atom_type = struct.unpack('>I4s', fd.read(8))
+            header_size = 8
+            if atom_size == 1:
+                atom_size = struct.unpack('>Q', fd.read(8))[0]
+                header_size = 16
+            elif atom_size == 0:
+                atom_size = end - position
+            if atom_size < header_size:
+                break
+
+            if atom_type == b'trak':
+                track_info = dict()
+                self._walk_mp4_stream_atoms(fd, position + header_size, position + atom_size, track_info)
+                if track_info.get('handler', b'soun') == b'soun' and sample_rate in track_info:
+                    return { sample_rate: track_info[sample_rate], channels: track_info.get(channels, 2),
+                             bits: track_info.get(bits, 16), total_samples: track_info[total_samples] }
+            elif atom_type in mp4_stream_containers:
+                stream_info = self._walk_mp4_stream_atoms(fd, position + header_size, position + atom_size,
+                                                          track_info)
+                if stream_info is not None:
+                    return stream_info
+            elif track_info is None:
+                pass
+            elif atom_type == b'mdhd':
+                # the media timescale of an audio track is its sample rate
+                mdhd = fd.read(min(atom_size - header_size, 64))
+                if mdhd[0] == 1:
+                    timescale, duration = struct.unpack_from('>IQ', mdhd, 20)
+                else:
+                    timescale, duration = struct.unpack_from('>II', mdhd, 12)
+                track_info[sample_rate] = timescale
+                track_info[total_samples] = duration
+            elif atom_type == b'hdlr':
+                track_info['handler'] = fd.read(min(atom_size - header_size, 12))[8:12]
+            elif atom_type == b'stsd':
+                self._parse_mp4_sample_entry(fd.read(min(atom_size - header_size, 256)), track_info)
+            position += atom_size
+        return None
+
+    def _parse_mp4_sample_entry(self, stsd, track_info):
+        # version, flags and entry count, then the first sample entry: size, format, 8 reserved bytes and the
+        # audio fields (version, revision, vendor, channels, sample size, ...), 36 bytes in all for version 0
+        if len(stsd) < 8 + 28:
+            return
+        entry = stsd[8:]
+        entry_size, entry_format = struct.unpack_from('>I4s', entry, 0)
+        track_info[channels], track_info[bits] = struct.unpack_from('>HH', entry, 24)
+        if entry_format != b'alac':
+            return
+        # the decoder config of alac (its magic cookie) follows, it is what the decoder goes by
+        version = struct.unpack_from('>H', entry, 16)[0]
+        cookie_position = 36 + (16 if version == 1 else 36 if version == 2 else 0)
+        cookie = entry[cookie_position:entry_size]
+        if len(cookie) >= 24 and cookie[4:8] == b'alac':
+            track_info[bits], track_info[channels] = cookie[17], cookie[21]
+
+    def _skip_id3v2(self, fd, head):
+        if head[0:3] != b'ID3' or len(head) < 10:
+            return 0
+        size = 0
+        for byte in head[6:10]:
+            size = (size << 7) | (byte & 0x7f)
+        footer = 10 if head[5] & 0x10 else 0
+        return 10 + size + footer
+
+    def _add_tag(self, tags, key, value):
+        if key is not None and key not in tags:
+            tags[key] = value
+
+    def _read_flac_tags(self, fd, offset):
+        tags = dict()
+        fd.seek(offset)
+        while True:
+            block_header = fd.read(4)
+            if len(block_header) < 4:
+                break
+            is_last = block_header[0] & 0x80
+            block_type = block_header[0] & 0x7f
+            block_length = int.from_bytes(block_header[1:4], 'big')
+            if block_type == 4:
+                block = fd.read(block_length)
+                self._parse_vorbis_comment(block, tags)
+            else:
+                fd.seek(block_length, os.SEEK_CUR)
+            if is_last:
+                break
+        return tags
+
+    def _parse_vorbis_comment(self, block, tags):
+        for key, value in self._vorbis_comments(block):
+            self._add_tag(tags, vorbis_keys.get(key), value)
+
+    def _vorbis_comments(self, block):
+        # (upper case key, value) of every comment of a vorbis comment block
+        comments = list()
+        vendor_length = struct.unpack_from('<I', block, 0)[0]
+        position = 4 + vendor_length
+        n_comments = struct.unpack_from('<I', block, position)[0]
+        position += 4
+        for _ in range(n_comments):
+            comment_length = struct.unpack_from('<I', block, position)[0]
+            position += 4
+            comment = block[position:position + comment_length]
+            position += comment_length
+            key, separator, value = comment.partition(b'=')
+            if separator:
+                comments.append((key.decode('ascii', errors='replace').upper(), value))
+        return comments
+
+    def _read_ogg_comment_block(self, fd):
+        # the second packet of an ogg stream holds its comments: OpusTags, or a vorbis comment header
+        packets = list()
+        packet = b''
+        fd.seek(0)
+        while len(packets) < 2:
+            header = fd.read(27)
+            if len(header) < 27 or header[0:4] != b'OggS':
+                return None
+            for segment_size in fd.read(header[26]):
+                packet += fd.read(segment_size)
+                # a packet ends with the first segment shorter than 255 bytes
+                if segment_size < 255:
+                    packets.append(packet)
+                    packet = b''
+                    if len(packets) == 2:
+                        break
+        for magic in (b'OpusTags', b'\x03vorbis'):
+            if packets[1].startswith(magic):
+                return packets[1][len(magic):]
+        return None
+
+    def _read_ape_tags(self, fd):
+        tags = dict()
+        fd.seek(0, os.SEEK_END)
+        file_size = fd.tell()
+        for footer_offset in (file_size - 32, file_size - 128 - 32):
+            if footer_offset < 0:
+                continue
+            fd.seek(footer_offset)
+            footer = fd.read(32)
+            if footer[0:8] != b'APETAGEX':
+                continue
+            tag_size, n_items = struct.unpack_from('<II', footer, 12)
+            fd.seek(footer_offset + 32 - tag_size)
+            items = fd.read(tag_size - 32)
+            position = 0
+            for _ in range(n_items):
+                if position + 8 > len(items):
+                    break
+                value_size, item_flags = struct.unpack_from('<II', items, position)
+                key_end = items.index(b'\0', position + 8)
+                key = items[position + 8:key_end].decode('ascii', errors='replace').upper()
+                value = items[key_end + 1:key_end + 1 + value_size]
+                position = key_end + 1 + value_size
+                # only utf-8 text items, binary ones hold cover art and the like
+                if (item_flags >> 1) & 3 == 0:
+                    self._add_tag(tags, ape_keys.get(key), value.split(b'\0')[0])
+                elif key == ape_front_cover:
+                    # the file name the picture came from, then the image itself
+                    self._add_tag(tags, picture, value.partition(b'\0')[2])
+            break
+        return tags
+
+    def _read_mp4_tags(self, fd):
+        tags = dict()
+        fd.seek(0, os.SEEK_END)
+        self._walk_mp4_atoms(fd, 0, fd.tell(), tags, None)
+        return tags
+
+    def _walk_mp4_atoms(self, fd, start, end, tags, parent_type):
+        position = start
+        while position + 8 <= end:
+            fd.seek(position)
+            atom_size, atom_type = struct.unpack('>I4s', fd.read(8))
+            header_size = 8
+            if atom_size == 1:
+                atom_size = struct.unpack('>Q', fd.read(8))[0]
+                header_size = 16
+            elif atom_size == 0:
+                atom_size = end - position
+            if atom_size < header_size:
+                break
+
+            if atom_type in mp4_containers:
+                self._walk_mp4_atoms(fd, position + header_size, position + atom_size, tags, atom_type)
+            elif atom_type == b'meta':
+                # a full atom: version and flags come before its children
+                self._walk_mp4_atoms(fd, position + header_size + 4, position + atom_size, tags, atom_type)
+            elif parent_type == b'ilst' and atom_size < 64 * 1024 * 1024:
+                self._parse_mp4_item(atom_type, fd.read(atom_size - header_size), tags)
+            position += atom_size
+
+    def _parse_mp4_item(self, atom_type, payload, tags):
+        # an ilst item holds a 'data' atom: size, 'data', type, locale, value
+        if len(payload) < 16 or payload[4:8] != b'data':
+            return
+        data_size = struct.unpack_from('>I', payload, 0)[0]
+        value = payload[16:data_size]
+        if atom_type in mp4_keys:
+            self._add_tag(tags, mp4_keys[atom_type], value)
+        elif atom_type == b'covr':
+            self._add_tag(tags, picture, value)
+        elif atom_type in (b'trkn', b'disk') and len(value) >= 6:
+            number, total = struct.unpack_from('>HH', value, 2)
+            if atom_type == b'trkn':
+                self._add_tag(tags, track, '{}/{}'.format(number, total).encode('ascii'))
+            else:
+                self._add_tag(tags, disc, str(number).encode('ascii'))
+                if total > 0:
+                    self._add_tag(tags, disctotal, str(total).encode('ascii'))
+        elif atom_type == b'gnre' and len(value) >= 2:
+            genre_index = struct.unpack_from('>H', value, 0)[0] - 1
+            if 0 <= genre_index < len(id3_genres):
+                self._add_tag(tags, genre, id3_genres[genre_index].encode('ascii'))
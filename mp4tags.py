@@ -0,0 +1,248 @@
+import os
+import struct
+import shutil
+
+# the atoms on the way from moov to the chunk offset tables
+sample_table_path = (b'trak', b'mdia', b'minf', b'stbl')
+# the domain of the freeform atoms iTunes reads, iTunNORM among them
+itunes_domain = 'com.apple.iTunes'
+# the ilst items of the tags ffmpeg writes, by the names the encoder command gives them
+text_items = { 'title': b'\xa9nam', 'artist': b'\xa9ART', 'album': b'\xa9alb', 'genre': b'\xa9gen',
+               'date': b'\xa9day', 'comment': b'\xa9cmt' }
+# type codes of the data atoms
+data_binary = 0
+data_utf8 = 1
+data_jpeg = 13
+data_png = 14
+# room left after a moov that comes before the audio, so that the next tags fit without moving the audio
+padding_size = 4096
+padding_atoms = (b'free', b'skip')
+copy_size = 1 << 20
+
+
+def _atoms(data, start=0, end=None):
+    # (type, start, payload start, end) of the atoms that follow each other in data[start:end]
+    end = len(data) if end is None else end
+    atoms = list()
+    while start + 8 <= end:
+        size, kind = struct.unpack_from('>I4s', data, start)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, start + 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - start
+        if size < header_size or start + size > end:
+            raise ValueError('malformed mp4 atom {} at {}'.format(kind, start))
+        atoms.append((kind, start, start + header_size, start + size))
+        start += size
+    return atoms
+
+
+def _atom(kind, payload):
+    return struct.pack('>I4s', 8 + len(payload), kind) + payload
+
+
+def _top_level_atoms(mp4_file):
+    # only the headers are read, mdat is never loaded
+    atoms = list()
+    file_size = mp4_file.seek(0, os.SEEK_END)
+    start = 0
+    while start + 8 <= file_size:
+        mp4_file.seek(start)
+        header = mp4_file.read(16)
+        size, kind = struct.unpack_from('>I4s', header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', header, 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = file_size - start
+        if size < header_size or start + size > file_size:
+            raise ValueError('malformed mp4 atom {} at {}'.format(kind, start))
+        atoms.append((kind, start, start + header_size, start + size))
+        start += size
+    return atoms
+
+
+def _edit_child(payload, offset, kind, edit):
+    # the first child atom of the given kind, found after offset, is replaced by one with the payload
+    # edit returns for its current payload (None when there is none, it is then appended)
+    for child_kind, start, payload_start, end in _atoms(payload, offset):
+        if child_kind == kind:
+            return payload[:start] + _atom(kind, edit(payload[payload_start:end])) + payload[end:]
+    return payload + _atom(kind, edit(None))
+
+
+def _data(data_type, value):
+    # the payload of a data atom: its type, a null locale and the value
+    return struct.pack('>II', data_type, 0) + value
+
+
+def freeform_atom(name, value, domain=itunes_domain):
+    # ----: a mean (the domain), a name and a utf-8 data atom
+    return _atom(b'----', _atom(b'mean', bytes(4) + domain.encode('utf-8')) +
+                 _atom(b'name', bytes(4) + name.encode('utf-8')) +
+                 _atom(b'data', _data(data_utf8, value.encode('utf-8'))))
+
+
+def track_items(texts, track, disc=None, cover=None):
+    """
+    The ilst items of a track, as write_tags takes them: texts maps the names of text_items to
+    their values, track and disc are (number, total) and cover the bytes of a jpeg or png image.
+    An empty text, no disc or no cover removes the item.
+    """
+    items = dict()
+    for name, kind in text_items.items():
+        value = texts.get(name)
+        items[kind] = None if value is None or str(value) == '' else _data(data_utf8, str(value).encode('utf-8'))
+    items[b'trkn'] = _data(data_binary, struct.pack('>HHHH', 0, track[0], track[1], 0))
+    items[b'disk'] = None if disc is None else _data(data_binary, struct.pack('>HHH', 0, disc[0], disc[1]))
+    items[b'covr'] = None
+    if cover is not None:
+        items[b'covr'] = _data(data_png if cover.startswith(b'\x89PNG') else data_jpeg, cover)
+    return items
+
+
+def _freeform_name(payload):
+    for kind, start, payload_start, end in _atoms(payload):
+        if kind == b'name':
+            return payload[payload_start + 4:end].decode('utf-8', errors='replace')
+    return None
+
+
+def _edit_ilst(ilst, items, freeform_tags):
+    # the given items and the freeform atoms of the given names are replaced, every other item is kept
+    names = set(name.lower() for name in freeform_tags)
+    kept = b''
+    for kind, start, payload_start, end in _atoms(ilst or b''):
+        if kind in items:
+            continue
+        if kind == b'----' and (_freeform_name(ilst[payload_start:end]) or '').lower() in names:
+            continue
+        kept += ilst[start:end]
+    return kept + b''.join(_atom(kind, _atom(b'data', data)) for kind, data in items.items() if data is not None) + \
+        b''.join(freeform_atom(name, value) for name, value in freeform_tags.items())
+
+
+def _edit_meta(meta, items, freeform_tags):
+    if meta is None:
+        # a full box: version and flags, then the handler of itunes metadata
+        meta = bytes(4) + _atom(b'hdlr', bytes(8) + b'mdirappl' + bytes(9))
+    return _edit_child(meta, 4, b'ilst', lambda ilst: _edit_ilst(ilst, items, freeform_tags))
+
+
+def _shift_chunk_offsets(payload, moved_from, delta, path=sample_table_path):
+    # the chunk offsets that point past moved_from move by delta, payload is the one of moov or below
+    payload = bytearray(payload)
+    for kind, start, payload_start, end in _atoms(payload):
+        if len(path) > 0 and kind == path[0]:
+            payload[payload_start:end] = _shift_chunk_offsets(payload[payload_start:end], moved_from, delta, path[1:])
+        elif len(path) == 0 and kind in (b'stco', b'co64'):
+            value_format = '>I' if kind == b'stco' else '>Q'
+            value_size = struct.calcsize(value_format)
+            n_entries = struct.unpack_from('>I', payload, payload_start + 4)[0]
+            for idx in range(n_entries):
+                position = payload_start + 8 + idx * value_size
+                value = struct.unpack_from(value_format, payload, position)[0]
+                if value >= moved_from:
+                    if kind == b'stco' and value + delta > 0xffffffff:
+                        raise ValueError('the chunk offsets no longer fit in stco')
+                    struct.pack_into(value_format, payload, position, value + delta)
+    return bytes(payload)
+
+
+def _copy_range(source, destination, start, length):
+    source.seek(start)
+    while length > 0:
+        data = source.read(min(copy_size, length))
+        if not data:
+            raise ValueError('truncated mp4 file')
+        destination.write(data)
+        length -= len(data)
+
+
+def _read_moov(mp4_file, path):
+    # the top level atoms, the index of moov among them and its payload
+    atoms = _top_level_atoms(mp4_file)
+    moov_indexes = [idx for idx, atom in enumerate(atoms) if atom[0] == b'moov']
+    if len(moov_indexes) != 1:
+        raise ValueError('{} has no moov atom'.format(path))
+    kind, start, payload_start, end = atoms[moov_indexes[0]]
+    mp4_file.seek(payload_start)
+    return atoms, moov_indexes[0], mp4_file.read(end - payload_start)
+
+
+def _edit_moov(payload, items, freeform_tags):
+    return _edit_child(payload, 0, b'udta', lambda udta: _edit_child(
+        udta or b'', 0, b'meta', lambda meta: _edit_meta(meta, items, freeform_tags)))
+
+
+def check(path):
+    """
+    Raises ValueError when write_tags cannot parse the mp4 file: its atoms, the ones on the way to
+    ilst and the chunk offset tables are all read as write_tags reads them, nothing is written.
+    """
+    with open(path, 'rb') as mp4_file:
+        atoms, moov_index, payload = _read_moov(mp4_file, path)
+    _edit_moov(payload, dict(), dict())
+    _shift_chunk_offsets(payload, 0, 0)
+
+
+def write_tags(path, items=None, freeform_tags=None):
+    """
+    Writes ilst items (atom type -> data payload, see track_items) and iTunes freeform tags
+    (----:com.apple.iTunes:name -> value) to an mp4 file, in place of any of the same kind; every
+    other item is kept:
+    - a moov followed by free atoms is rewritten where it is when it fits their room, the rest of
+      the room staying free; only moov is read and written again, the audio is never read;
+    - a moov that is the last atom, as ffmpeg writes it, goes to a copy of the file that replaces
+      it, so that a crash never leaves a half written moov: the audio stays where it was;
+    - otherwise the file is copied around the new moov, followed by padding_size bytes of padding
+      so that the next tags fit, with the chunk offsets of the audio that moved patched.
+    """
+    items = items or dict()
+    freeform_tags = freeform_tags or dict()
+    with open(path, 'r+b') as mp4_file:
+        atoms, moov_index, payload = _read_moov(mp4_file, path)
+        kind, moov_start, payload_start, moov_end = atoms[moov_index]
+        payload = _edit_moov(payload, items, freeform_tags)
+        new_moov = _atom(b'moov', payload)
+
+        # the free atoms that follow moov are room it can grow into
+        room_end = moov_end
+        for kind, start, payload_start, end in atoms[moov_index + 1:]:
+            if kind not in padding_atoms:
+                break
+            room_end = end
+        room = room_end - moov_start
+        if room_end == atoms[-1][3]:
+            # no audio follows moov, no offset changes
+            padding = b''
+        elif len(new_moov) == room or len(new_moov) + 8 <= room:
+            mp4_file.seek(moov_start)
+            mp4_file.write(new_moov)
+            if len(new_moov) < room:
+                mp4_file.write(_atom(b'free', bytes(room - len(new_moov) - 8)))
+            os.fsync(mp4_file.fileno())
+            return
+        else:
+            padding = _atom(b'free', bytes(padding_size))
+            delta = len(new_moov) + len(padding) - room
+            new_moov = _atom(b'moov', _shift_chunk_offsets(payload, room_end, delta))
+
+        temp_path = path + '.moov'
+        try:
+            with open(temp_path, 'wb') as temp_file:
+                _copy_range(mp4_file, temp_file, 0, moov_start)
+                temp_file.write(new_moov)
+                temp_file.write(padding)
+                _copy_range(mp4_file, temp_file, room_end, atoms[-1][3] - room_end)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            shutil.copymode(path, temp_path)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
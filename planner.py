@@ -0,0 +1,118 @@
+import os
+import heapq
+import literals
+import metadata
+
+# seconds of 44.1 kHz stereo audio one core decodes or encodes per second, by source extension and by encoder:
+# rough figures of ffmpeg, the estimates scale with the sample rate and the number of channels
+decode_speeds = { '.flac': 900.0, '.wv': 500.0, '.ape': 150.0, '.wav': 5000.0, '.m4a': 400.0 }
+default_decode_speed = 500.0
+encode_speeds = { 'libfdk_aac': 90.0, 'aac_at': 150.0, 'aac': 60.0, 'libopus': 70.0 }
+default_encode_speed = 60.0
+# the loudness analysis of --loudness
+analysis_speed = 150.0
+reference_rate = 44100
+reference_channels = 2
+# bits per second of libfdk_aac in vbr mode for a stereo track, by vbr level
+vbr_bitrates = { '1': 64000, '2': 80000, '3': 112000, '4': 144000, '5': 224000 }
+# a source whose headers tell nothing: how many bytes of it make a second of audio (cd audio compressed by half)
+fallback_bytes_per_second = 44100 * 4 * 0.5
+
+
+def parse_bitrate(bitrate):
+    # '256k', '256000' -> bits per second, None when it cannot be told
+    try:
+        if bitrate.lower().endswith('k'):
+            return int(float(bitrate[:-1]) * 1000)
+        return int(float(bitrate))
+    except (ValueError, AttributeError):
+        return None
+
+
+def format_bytes(n_bytes):
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if n_bytes < 1000 or unit == 'GB':
+            return '{:.0f} {}'.format(n_bytes, unit) if unit == 'B' else '{:.1f} {}'.format(n_bytes, unit)
+        n_bytes /= 1000
+
+
+class TrackEstimate:
+    def __init__(self, name, duration, cpu_seconds, temp_bytes, output_bytes):
+        self.name = name
+        # None when neither the headers nor the cuefile tell the length of the track
+        self.duration = duration
+        self.cpu_seconds = cpu_seconds
+        self.temp_bytes = temp_bytes
+        self.output_bytes = output_bytes
+
+
+def estimate_track(config, name, tags, source, encoders, bitrates, temp_bytes, rates=None):
+    """
+    The cost of converting one track: its cpu seconds (the decode, an encode per target and the
+    loudness analysis), the bytes of its intermediate wav and of its outputs. The length comes from
+    the duration of the tags (source headers or cue INDEX times), the source size otherwise.
+    encoders, bitrates and rates are those of the targets, a bitrate is None when it cannot be told
+    and a rate None when it is the one of the source.
+    """
+    duration = tags.get(literals.duration)
+    stream_info = tags.get(literals.stream_info)
+    scale = 1.0
+    channel_scale = 1.0
+    if stream_info is not None:
+        channel_scale = stream_info[metadata.channels] / reference_channels
+        scale = stream_info[metadata.sample_rate] / reference_rate * channel_scale
+    audio_seconds = duration
+    if audio_seconds is None:
+        try:
+            audio_seconds = os.path.getsize(source) / fallback_bytes_per_second
+        except (OSError, TypeError):
+            audio_seconds = 0.0
+    extension = os.path.splitext(source or '')[1].lower()
+    cpu_seconds = audio_seconds * scale / decode_speeds.get(extension, default_decode_speed)
+    # the encoders work at the rate of their target, hi-res sources are resampled first
+    for encoder, rate in zip(encoders, rates or [None] * len(encoders)):
+        encode_scale = scale if rate is None else rate / reference_rate * channel_scale
+        cpu_seconds += audio_seconds * encode_scale / encode_speeds.get(encoder, default_encode_speed)
+    if config.loudness:
+        cpu_seconds += audio_seconds * scale / analysis_speed
+    output_bytes = sum(audio_seconds * bitrate / 8 for bitrate in bitrates if bitrate is not None)
+    return TrackEstimate(name, duration, cpu_seconds, temp_bytes, int(output_bytes))
+
+
+class Plan:
+    """
+    The estimated cost of the tracks a run would convert, and the wall time it would take: the
+    tracks are started longest first (as the scheduler does) on n_jobs cores, each one on the first
+    core that is free.
+    """
+    def __init__(self, n_jobs):
+        self.n_jobs = max(1, int(n_jobs))
+        self.estimates = list()
+        self.n_albums = 0
+
+    def add_album(self, estimates):
+        self.n_albums += 1
+        self.estimates.extend(estimates)
+
+    def wall_time(self):
+        cores = [0.0] * self.n_jobs
+        for estimate in sorted(self.estimates, key=lambda estimate: -estimate.cpu_seconds):
+            heapq.heappush(cores, heapq.heappop(cores) + estimate.cpu_seconds)
+        return max(cores)
+
+    def print(self):
+        print('plan: {} track(s) of {} album(s), longest first'.format(len(self.estimates), self.n_albums))
+        for estimate in sorted(self.estimates, key=lambda estimate: -estimate.cpu_seconds):
+            duration = '?' if estimate.duration is None else '{}:{:02d}'.format(int(estimate.duration) // 60,
+                                                                               int(estimate.duration) % 60)
+            print('  {:>6}  cpu {:7.1f}s  temp {:>9}  output {:>9}  {}'.format(
+                duration, estimate.cpu_seconds, format_bytes(estimate.temp_bytes),
+                format_bytes(estimate.output_bytes), estimate.name))
+        n_unknown = len([estimate for estimate in self.estimates if estimate.duration is None])
+        if n_unknown > 0:
+            print('  {} track(s) of unknown length, estimated from the size of their source'.format(n_unknown))
+        print('total: cpu {:.1f}s, temp {}, output {}'.format(
+            sum(estimate.cpu_seconds for estimate in self.estimates),
+            format_bytes(sum(estimate.temp_bytes for estimate in self.estimates)),
+            format_bytes(sum(estimate.output_bytes for estimate in self.estimates))))
+        print('predicted wall time with {} job(s): {:.1f}s'.format(self.n_jobs, self.wall_time()))
@@ -0,0 +1,119 @@
+import os
+
+cpu_pool = 'cpu'
+io_pool = 'io'
+# encodes keep their cores busy, every other stage mostly waits on the disks
+cpu_stages = ('encode',)
+
+adapt_interval = 2.0
+# share of cpu time left idle under which the host is saturated, and over which it has room for one more encode
+busy_idle = 0.05
+spare_idle = 0.2
+# share of cpu time waiting on io over which the io pool shrinks, and under which it may grow
+busy_iowait = 0.2
+spare_iowait = 0.05
+
+
+def read_cpu_times(path='/proc/stat'):
+    # (total, idle, iowait) jiffies of all the cpus since boot, None without procfs
+    try:
+        with open(path) as stat_fd:
+            fields = [int(field) for field in stat_fd.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    if len(fields) < 5:
+        return None
+    # user nice system idle iowait irq softirq steal, guest time is already part of user
+    return sum(fields[:8]), fields[3], fields[4]
+
+
+def read_load_average(path='/proc/loadavg'):
+    try:
+        with open(path) as load_fd:
+            return float(load_fd.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Pools:
+    """
+    Separate limits for the jobs that keep cores busy (encodes: the cpu pool) and for the ones that
+    mostly wait on the disks (decodes, splits, tagging, renames: the io pool), so that a tagger
+    rewriting a file never holds the place of an encode. With adaptive, the limits follow the host
+    every adapt_interval seconds, between 1 and their maximum: the cpu pool backs off while the cpus
+    are saturated and load that is not ours keeps them busy, and grows back when they idle; the io
+    pool shrinks while the cpus wait on io. With pin, every running encode gets a core of its own,
+    or the least used one when there are more encodes than cores.
+    With no io_jobs there is a single pool of cpu_jobs jobs, whatever they do.
+    """
+    def __init__(self, cpu_jobs, io_jobs=0, adaptive=False, pin=False):
+        self.max_limits = { cpu_pool: max(1, int(cpu_jobs)) }
+        if io_jobs:
+            self.max_limits[io_pool] = max(1, int(io_jobs))
+        self.limits = dict(self.max_limits)
+        self.running = { pool: 0 for pool in self.max_limits }
+        self.adaptive = adaptive
+        self.n_cpus = len(os.sched_getaffinity(0))
+        # core -> number of running encodes pinned to it
+        self.core_users = { core: 0 for core in sorted(os.sched_getaffinity(0)) } if pin else dict()
+        self.last_cpu_times = read_cpu_times() if adaptive else None
+
+    def n_workers(self):
+        return sum(self.max_limits.values())
+
+    def pool(self, job):
+        if job.stage in cpu_stages or io_pool not in self.limits:
+            return cpu_pool
+        return io_pool
+
+    def admits(self, job):
+        pool = self.pool(job)
+        return self.running[pool] < self.limits[pool]
+
+    def start(self, job):
+        job.pool = self.pool(job)
+        self.running[job.pool] += 1
+        if len(self.core_users) > 0 and job.stage in cpu_stages:
+            core = min(self.core_users, key=self.core_users.get)
+            self.core_users[core] += 1
+            job.cores = { core }
+
+    def finish(self, job):
+        self.running[job.pool] -= 1
+        if job.cores is not None:
+            for core in job.cores:
+                self.core_users[core] -= 1
+
+    def adapt(self):
+        # returns True when a limit changed, None when the host cannot be measured
+        cpu_times = read_cpu_times()
+        if cpu_times is None or self.last_cpu_times is None:
+            self.last_cpu_times = cpu_times
+            return None
+        total, idle, iowait = (now - last for now, last in zip(cpu_times, self.last_cpu_times))
+        self.last_cpu_times = cpu_times
+        if total <= 0:
+            return False
+        limits = dict(self.limits)
+
+        # the load average counts our own jobs too, what is left is somebody else's
+        load = read_load_average()
+        others = 0.0 if load is None else max(0.0, load - sum(self.running.values()))
+        headroom = max(1, round(self.n_cpus - others))
+        spare = (idle + iowait) / total
+        if spare < busy_idle and others >= 1.0:
+            limits[cpu_pool] -= 1
+        elif spare > spare_idle:
+            limits[cpu_pool] += 1
+        limits[cpu_pool] = max(1, min(limits[cpu_pool], headroom, self.max_limits[cpu_pool]))
+
+        if io_pool in limits:
+            if iowait / total > busy_iowait:
+                limits[io_pool] -= 1
+            elif iowait / total < spare_iowait:
+                limits[io_pool] += 1
+            limits[io_pool] = max(1, min(limits[io_pool], self.max_limits[io_pool]))
+
+        changed = limits != self.limits
+        self.limits = limits
+        return changed
@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import resource
+import threading
+import contextlib
+
+
+def read_proc_io(path):
+    # rchar/wchar count every byte passed to read/write calls, pipes included; None without procfs
+    try:
+        with open(path) as io_fd:
+            fields = dict(line.split(':', 1) for line in io_fd.read().splitlines() if ':' in line)
+        return { 'read_bytes': int(fields['rchar']), 'write_bytes': int(fields['wchar']) }
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+class RunReport:
+    """
+    Per track and per stage timing of a run: wall time, cpu time, bytes read and written, and for
+    scheduled jobs the time spent waiting in the ready queue. In process stages (cue parse, tag
+    probe) are measured with measure(), jobs are recorded by the scheduler when they finish.
+    write() adds a summary (time per stage, cpu utilisation, critical path) and saves it all as json.
+    A report without a path records nothing.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.enabled = path is not None
+        self.start_time = time.monotonic()
+        self.start_date = time.time()
+        self.start_usage = self._usage()
+        self.records = list()
+        self.job_ids = dict()
+        self.n_skipped_jobs = 0
+        # the limits of the pools each time they adapted to the load of the host
+        self.pool_limits = list()
+        self._lock = threading.Lock()
+
+    def _usage(self):
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return (self_usage.ru_utime + self_usage.ru_stime, children_usage.ru_utime + children_usage.ru_stime)
+
+    def _clock(self, monotonic_time):
+        return None if monotonic_time is None else round(monotonic_time - self.start_time, 6)
+
+    def _add(self, record):
+        with self._lock:
+            record['id'] = len(self.records)
+            self.records.append(record)
+        return record['id']
+
+    @contextlib.contextmanager
+    def measure(self, stage, album=None, disc=None, track=None, filename=None):
+        if not self.enabled:
+            yield
+            return
+        io_before = read_proc_io('/proc/thread-self/io')
+        cpu_before = time.thread_time()
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            end_time = time.monotonic()
+            io_after = read_proc_io('/proc/thread-self/io')
+            record = { 'stage': stage, 'album': album, 'disc': disc, 'track': track, 'file': filename,
+                       'in_process': True, 'start': self._clock(start_time), 'end': self._clock(end_time),
+                       'wall': round(end_time - start_time, 6), 'queue_wait': 0.0,
+                       'cpu': round(time.thread_time() - cpu_before, 6), 'max_rss_kb': None,
+                       'read_bytes': None, 'write_bytes': None, 'after': list() }
+            if io_before is not None and io_after is not None:
+                record['read_bytes'] = io_after['read_bytes'] - io_before['read_bytes']
+                record['write_bytes'] = io_after['write_bytes'] - io_before['write_bytes']
+            self._add(record)
+
+    def record_job(self, job):
+        if not self.enabled:
+            return
+        album, disc, track = job.key if isinstance(job.key, tuple) and len(job.key) == 3 else (None, None, None)
+        record = { 'stage': job.stage, 'album': album, 'disc': disc, 'track': track, 'file': None,
+                   'name': job.name, 'pool': job.pool, 'in_process': job.func is not None,
+                   'returncode': job.returncode,
+                   'start': self._clock(job.start_time), 'end': self._clock(job.end_time),
+                   'wall': round(job.end_time - job.start_time, 6),
+                   'queue_wait': round(job.start_time - job.ready_time, 6),
+                   'cpu': None, 'max_rss_kb': None, 'read_bytes': None, 'write_bytes': None }
+        if len(job.rusages) > 0:
+            record['cpu'] = round(sum(rusage.ru_utime + rusage.ru_stime for rusage in job.rusages), 6)
+            record['max_rss_kb'] = max(rusage.ru_maxrss for rusage in job.rusages)
+        if len(job.io) > 0 and all(io is not None for io in job.io):
+            record['read_bytes'] = sum(io['read_bytes'] for io in job.io)
+            record['write_bytes'] = sum(io['write_bytes'] for io in job.io)
+        # the schedulers of albums converted at once record their jobs from their own threads
+        with self._lock:
+            record['after'] = [self.job_ids[dependency] for dependency in job.after if dependency in self.job_ids]
+            record['id'] = len(self.records)
+            self.records.append(record)
+            self.job_ids[job] = record['id']
+
+    def record_pool_limits(self, limits):
+        if self.enabled:
+            with self._lock:
+                self.pool_limits.append(dict(limits, time=self._clock(time.monotonic())))
+
+    def record_skipped(self, n_jobs):
+        if self.enabled:
+            with self._lock:
+                self.n_skipped_jobs += n_jobs
+
+    def _critical_path(self):
+        # longest chain of dependent jobs, a lower bound of the run time whatever the number of workers
+        length = dict()
+        previous = dict()
+        for record in self.records:
+            length[record['id']] = record['wall']
+            for dependency in record['after']:
+                if length[dependency] + record['wall'] > length[record['id']]:
+                    length[record['id']] = length[dependency] + record['wall']
+                    previous[record['id']] = dependency
+        if len(length) == 0:
+            return 0.0, list()
+        last = max(length, key=length.get)
+        chain = [last]
+        while chain[-1] in previous:
+            chain.append(previous[chain[-1]])
+        return round(length[last], 6), list(reversed(chain))
+
+    def summary(self):
+        wall = time.monotonic() - self.start_time
+        self_cpu, children_cpu = (end - start for end, start in zip(self._usage(), self.start_usage))
+        n_cpus = os.cpu_count() or 1
+        stages = dict()
+        for record in self.records:
+            stage = stages.setdefault(record['stage'], { 'count': 0, 'wall': 0.0, 'cpu': 0.0, 'queue_wait': 0.0,
+                                                         'max_queue_wait': 0.0, 'read_bytes': 0,
+                                                         'write_bytes': 0 })
+            stage['count'] += 1
+            stage['wall'] += record['wall']
+            stage['cpu'] += record['cpu'] or 0.0
+            stage['queue_wait'] += record['queue_wait']
+            stage['max_queue_wait'] = max(stage['max_queue_wait'], record['queue_wait'])
+            stage['read_bytes'] += record['read_bytes'] or 0
+            stage['write_bytes'] += record['write_bytes'] or 0
+        critical_path_length, critical_path = self._critical_path()
+        busy_time = sum(record['wall'] for record in self.records if not record['in_process'])
+        return { 'wall': round(wall, 6),
+                 'cpu': { 'self': round(self_cpu, 6), 'children': round(children_cpu, 6), 'cpus': n_cpus,
+                          'utilisation': round((self_cpu + children_cpu) / (wall * n_cpus), 4) if wall > 0 else None },
+                 # average number of jobs running at once
+                 'concurrency': round(busy_time / wall, 4) if wall > 0 else None,
+                 'critical_path': { 'wall': critical_path_length, 'jobs': critical_path,
+                                    'share_of_wall': round(critical_path_length / wall, 4) if wall > 0 else None },
+                 'skipped_jobs': self.n_skipped_jobs,
+                 'stages': stages }
+
+    def write(self, config=None):
+        if not self.enabled:
+            return
+        report = { 'started': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(self.start_date)),
+                   'summary': self.summary(), 'pool_limits': self.pool_limits, 'records': self.records }
+        if config is not None:
+            report['tools'] = { 'ffmpeg_version': config.ffmpeg_version, 'aac_encoder': config.aac_encoder,
+                                'targets': [{ 'name': target.name, 'encoder': target.encoder, 'tagger': target.tagger }
+                                            for target in config.targets],
+                                'stream': config.stream, 'jobs': config.jobs, 'io_jobs': config.io_jobs,
+                                'adaptive': config.adaptive, 'pin': config.pin }
+        with open(self.path, 'w') as report_fd:
+            json.dump(report, report_fd, indent=2)
+        print('run report written to {}'.format(self.path))
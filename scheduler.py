@@ -0,0 +1,317 @@
+import time
+import asyncio
+
+from collections import deque
+from engine import Engine, ProgressReporter
+from pools import Pools, adapt_interval
+
+
+class Job:
+    def __init__(self, name, cmd, key=None, after=None, duration=None, stage=None, reserve=0, release=0,
+                 on_stdout=None, wait_for=None, priority=0.0, on_finish=None):
+        self.name = name
+        self.stage = stage
+        # scratch space taken when the job starts, and given back when it ends
+        self.reserve = reserve
+        self.release = release
+        # a job is either a python callable, a single command or a pipeline, i.e. a list of
+        # commands where each command's stdout is fed to the stdin of the next one
+        if callable(cmd):
+            self.func = cmd
+            self.cmds = list()
+        else:
+            self.func = None
+            self.cmds = cmd if len(cmd) > 0 and isinstance(cmd[0], list) else [cmd]
+        self.key = key
+        # estimated cpu seconds of the track the job belongs to: the longest tracks start first
+        self.priority = priority
+        # set when the job starts: the pool it runs in, and the cores it is pinned to
+        self.pool = None
+        self.cores = None
+        self.after = [job for job in (after or list()) if job is not None]
+        self.dependents = list()
+        # jobs that only have to be over, successful or not, before this one starts
+        self.wait_for = [job for job in (wait_for or list()) if job is not None and job not in self.after]
+        self.waiters = list()
+        self.n_pending = 0
+        self.skipped = False
+        # length in seconds of the audio the job writes, if known, for its progress
+        self.duration = duration
+        self.progress = None
+        # called with the stdout of the job as it arrives, instead of keeping it
+        self.on_stdout = on_stdout
+        # called with the job on the event loop once it is over, it may submit more jobs to the running scheduler
+        self.on_finish = on_finish
+        self.returncode = None
+        self.stdout = b''
+        self.stderr = b''
+        self.rusages = list()
+        self.io = list()
+        # monotonic times at which the job became ready, started and ended
+        self.ready_time = None
+        self.start_time = None
+        self.end_time = None
+
+    def failed(self):
+        return self.skipped or (self.returncode is not None and self.returncode != 0)
+
+
+class Scheduler:
+    """
+    Runs jobs from a bounded queue with at most n_jobs of them alive at once, or within the limits of
+    the cpu and io pools when pools are given.
+    A job may depend on other jobs and only becomes ready when all of them succeeded, so a track
+    is a chain decode -> encode -> cleanup -> tag that moves on as soon as its own previous step is
+    done. A job may also wait for jobs that only have to be over, whether they succeed or not.
+    Among the jobs ready when the run starts, and among those a finished job makes ready, the ones
+    with the highest priority go first: with the estimated cost of their track as priority, the
+    longest tracks start first and no long track is left to stretch the end of the run. Jobs that
+    just became ready are started before jobs that never started a chain, which keeps the number of
+    half converted tracks (and temp files) low.
+    Commands run on the asyncio Engine, which reads the output of the children as it arrives and
+    reports the progress of ffmpeg encodes; python callables run in the default executor. When
+    keep_going is False no new job is started after the first failure (running jobs are allowed to
+    finish); otherwise every job whose dependencies succeeded is run. The on_finish callback of a job
+    may submit more jobs while the scheduler runs, the run ends once every job is over.
+    """
+    def __init__(self, n_jobs, keep_going=False, timeout=None, show_progress=True, report=None, pools=None):
+        self.n_jobs = max(1, int(n_jobs))
+        self.pools = pools if pools is not None else Pools(self.n_jobs)
+        self.keep_going = keep_going
+        self.report = report
+        self.engine = Engine(timeout)
+        self.reporter = ProgressReporter() if show_progress else None
+        self.ready = deque()
+        self.jobs = list()
+        self.failed_jobs = list()
+        self.stopped = False
+        self.n_running = 0
+        # admission control: jobs reserving scratch space only start while the reservations fit in space_budget
+        self.space_budget = None
+        self.reserved_bytes = 0
+        self.running_tasks = dict()
+        self._loop = None
+        self._condition = None
+
+    def submit(self, name, cmd, key=None, after=None, duration=None, stage=None, reserve=0, release=0,
+               on_stdout=None, wait_for=None, priority=0.0, on_finish=None):
+        job = Job(name, cmd, key, after, duration, stage, reserve, release, on_stdout, wait_for, priority, on_finish)
+        self.jobs.append(job)
+        if any(dependency.failed() for dependency in job.after):
+            self._skip(job)
+            return job
+        for dependency in job.after:
+            if dependency.returncode is None:
+                job.n_pending += 1
+                dependency.dependents.append(job)
+        for waited_job in job.wait_for:
+            if waited_job.returncode is None and not waited_job.skipped:
+                job.n_pending += 1
+                waited_job.waiters.append(job)
+        if job.n_pending == 0:
+            if self._loop is not None:
+                job.ready_time = time.monotonic()
+            self.ready.append(job)
+        return job
+
+    def cancel(self, job=None):
+        # safe to call from any thread: cancels one running job, or stops the whole run
+        if self._loop is None:
+            # a run stopped before it starts starts no job
+            if job is None:
+                self.stopped = True
+            return
+        self._loop.call_soon_threadsafe(self._cancel, job)
+
+    def _cancel(self, job):
+        if job is None:
+            self.stopped = True
+            tasks = list(self.running_tasks.values())
+        else:
+            tasks = [self.running_tasks[job]] if job in self.running_tasks else list()
+        for task in tasks:
+            task.cancel()
+
+    def _skip(self, job):
+        if job.skipped:
+            return
+        job.skipped = True
+        # the space of a chain that stops is given back, whatever is left is removed after the run
+        self.reserved_bytes -= job.release
+        self.failed_jobs.append(job)
+        for dependent in job.dependents:
+            self._skip(dependent)
+        self._release_waiters(job, time.monotonic())
+
+    def _release_waiters(self, job, end_time):
+        for waiter in job.waiters:
+            waiter.n_pending -= 1
+            if waiter.n_pending == 0 and not waiter.skipped:
+                waiter.ready_time = end_time
+                self.ready.append(waiter)
+
+    async def _next_job(self):
+        async with self._condition:
+            while True:
+                if self.stopped:
+                    return None
+                job = self._next_admitted_job()
+                if job is not None:
+                    self.n_running += 1
+                    self.pools.start(job)
+                    self.reserved_bytes += job.reserve
+                    job.start_time = time.monotonic()
+                    return job
+                if self.n_running == 0:
+                    return None
+                await self._condition.wait()
+
+    def _next_admitted_job(self):
+        for job in self.ready:
+            if not self.pools.admits(job):
+                continue
+            # with nothing running a job that does not fit is started anyway, waiting would never end
+            if job.reserve == 0 or self.space_budget is None or self.n_running == 0 or \
+                    self.reserved_bytes + job.reserve <= self.space_budget:
+                self.ready.remove(job)
+                return job
+        return None
+
+    async def _finish_job(self, job):
+        job.end_time = time.monotonic()
+        if self.report is not None:
+            self.report.record_job(job)
+        async with self._condition:
+            self.n_running -= 1
+            self.pools.finish(job)
+            self.reserved_bytes -= job.release
+            if job.failed():
+                self.failed_jobs.append(job)
+                if not self.keep_going:
+                    self.stopped = True
+                for dependent in job.dependents:
+                    self._skip(dependent)
+            else:
+                # appended to the left: the first one ends up first, the ones of equal priority in submission order
+                for dependent in sorted(reversed(job.dependents), key=lambda dependent: dependent.priority):
+                    dependent.n_pending -= 1
+                    if dependent.n_pending == 0 and not dependent.skipped:
+                        dependent.ready_time = job.end_time
+                        self.ready.appendleft(dependent)
+            self._release_waiters(job, job.end_time)
+            if job.on_finish is not None:
+                job.on_finish(job)
+            self._condition.notify_all()
+
+    async def _worker(self):
+        while True:
+            job = await self._next_job()
+            if job is None:
+                return
+
+            # the job runs in its own task so that it can be cancelled without its worker
+            task = asyncio.ensure_future(self._run_job(job))
+            self.running_tasks[job] = task
+            try:
+                await asyncio.wait([task])
+            except asyncio.CancelledError:
+                task.cancel()
+                await asyncio.wait([task])
+                raise
+            finally:
+                del self.running_tasks[job]
+                if self.reporter is not None:
+                    self.reporter.finish(job.name)
+            if task.cancelled():
+                job.returncode = -1
+                job.stderr += b'cancelled\n'
+
+            if job.failed():
+                self._report_failure(job)
+            await self._finish_job(job)
+
+    async def _run_job(self, job):
+        if job.func is not None:
+            await self._run_func(job)
+            return
+        result = await self.engine.run(job.cmds, job.duration, self._progress_callback(job), cores=job.cores,
+                                       on_stdout=job.on_stdout)
+        job.returncode = result.returncode
+        job.stdout = result.stdout
+        job.stderr = result.stderr
+        job.rusages = result.rusages
+        job.io = result.io
+
+    def _progress_callback(self, job):
+        def on_progress(progress):
+            job.progress = progress
+            if self.reporter is not None:
+                self.reporter.update(job.name, progress)
+        return on_progress
+
+    async def _run_func(self, job):
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, job.func)
+            job.returncode = 0
+        except Exception as exception:
+            job.stderr = (str(exception) + '\n').encode('utf-8')
+            job.returncode = -1
+
+    def _report_failure(self, job):
+        if self.reporter is not None:
+            self.reporter.clear()
+        print('{} failed with exit code {}'.format(job.name, job.returncode))
+        if job.stderr:
+            print(job.stderr.decode('utf-8', errors='replace'), end='')
+        if job.stdout and not (job.stderr and job.stderr.strip()):
+            print(job.stdout.decode('utf-8', errors='replace'), end='')
+
+    async def _adapt_pools(self):
+        while True:
+            await asyncio.sleep(adapt_interval)
+            if self.pools.adapt():
+                if self.report is not None:
+                    self.report.record_pool_limits(self.pools.limits)
+                # a pool that grew may start the jobs waiting for it
+                async with self._condition:
+                    self._condition.notify_all()
+
+    def run(self):
+        return asyncio.run(self.run_async())
+
+    async def run_async(self):
+        start_time = time.monotonic()
+        self._loop = asyncio.get_running_loop()
+        self._condition = asyncio.Condition()
+        self.ready = deque(sorted(self.ready, key=lambda job: -job.priority))
+        # jobs submitted before the run only start waiting now
+        for job in self.ready:
+            job.ready_time = start_time
+        # jobs submitted during the run may need every worker, even when few are submitted before it
+        n_workers = self.pools.n_workers()
+        adapter = asyncio.ensure_future(self._adapt_pools()) if self.pools.adaptive else None
+        try:
+            await asyncio.gather(*(self._worker() for _ in range(n_workers)))
+        finally:
+            if adapter is not None:
+                adapter.cancel()
+            self._loop = None
+            if self.reporter is not None:
+                self.reporter.clear()
+
+        not_started = [job for job in self.jobs if job.returncode is None and not job.skipped]
+        for job in not_started:
+            job.skipped = True
+            self.failed_jobs.append(job)
+        if len(not_started) > 0:
+            print('{} job(s) not started because of earlier failures'.format(len(not_started)))
+        if self.report is not None:
+            self.report.record_skipped(len([job for job in self.jobs if job.skipped]))
+        n_run = len([job for job in self.jobs if job.returncode is not None])
+        print('{} job(s) run in {:.2f}s'.format(n_run, time.monotonic() - start_time))
+
+        self.ready.clear()
+        self.jobs = list()
+        failed_jobs = self.failed_jobs
+        self.failed_jobs = list()
+        return failed_jobs
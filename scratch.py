@@ -0,0 +1,89 @@
+import os
+import socket
+import shutil
+import tempfile
+import threading
+
+shm_dir = '/dev/shm'
+run_dir_prefix = 'lossless2lossy-'
+
+
+class Scratch:
+    """
+    Where the intermediate wav files of a run go: the directory given with --scratch, otherwise
+    /dev/shm when it has room for the largest tracks that can be decoded at once, otherwise the
+    system temp directory. Sources are never written to, so read-only or network mounts are fine.
+    Every run works in its own subdirectory, which cleanup() removes with everything in it,
+    whether the run succeeded, failed or was interrupted. The subdirectory is named after the host
+    and pid of the run, the ones left by runs of this host that were killed are swept.
+    budget is the space the run may fill at once, the scheduler admits decodes within it.
+    Albums converted at once share the run directory, each gets its own subdirectory in it.
+    """
+    def __init__(self, root=None, n_jobs=1):
+        self.root = None if root is None else os.path.realpath(os.path.expanduser(root))
+        self.n_jobs = n_jobs
+        self.run_dir = None
+        self.budget = None
+        self.n_albums = 0
+        self._lock = threading.Lock()
+
+    def _choose_root(self, estimates):
+        if self.root is not None:
+            return self.root
+        # estimates are 0 when the size of a track is unknown, RAM is then not worth the risk
+        if len(estimates) > 0 and all(estimate > 0 for estimate in estimates) and os.path.isdir(shm_dir) \
+                and os.access(shm_dir, os.W_OK):
+            needed = sum(sorted(estimates, reverse=True)[:self.n_jobs])
+            if self._usable_bytes(shm_dir) >= needed:
+                return shm_dir
+        return tempfile.gettempdir()
+
+    def _usable_bytes(self, path):
+        free = shutil.disk_usage(path).free
+        # RAM is shared with everything else: only half of what is free is used
+        if os.path.realpath(path).startswith(os.path.realpath(shm_dir)):
+            return free // 2
+        return free * 9 // 10
+
+    def album_dir(self, estimates, create=True):
+        # estimates are the expected sizes of the intermediate files of the album, in bytes; without create
+        # (a dry run) only the path the album would get is told, nothing is swept nor created
+        if not create:
+            return os.path.join(self._choose_root(estimates), self._run_prefix(os.getpid()) + 'XXXXXXXX',
+                                'album-{:03d}'.format(self.n_albums + 1))
+        with self._lock:
+            if self.run_dir is None:
+                root = self._choose_root(estimates)
+                os.makedirs(root, exist_ok=True)
+                self._sweep(root)
+                self.run_dir = tempfile.mkdtemp(prefix=self._run_prefix(os.getpid()), dir=root)
+                self.budget = self._usable_bytes(self.run_dir)
+                print('intermediate files go to {}'.format(self.run_dir))
+            self.n_albums += 1
+            album_dir = os.path.join(self.run_dir, 'album-{:03d}'.format(self.n_albums))
+            os.makedirs(album_dir)
+            return album_dir
+
+    def _run_prefix(self, pid):
+        return '{}{}-{}-'.format(run_dir_prefix, socket.gethostname(), pid)
+
+    def _sweep(self, root):
+        # the scratch root may be shared by several hosts, only the dead runs of this one are known
+        prefix = run_dir_prefix + socket.gethostname() + '-'
+        for dir_name in os.listdir(root):
+            pid = dir_name[len(prefix):].split('-')[0]
+            if not dir_name.startswith(prefix) or not pid.isdigit():
+                continue
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                print('removing the intermediate files of a killed run: {}'.format(os.path.join(root, dir_name)))
+                shutil.rmtree(os.path.join(root, dir_name), ignore_errors=True)
+            except PermissionError:
+                pass
+
+    def cleanup(self):
+        with self._lock:
+            if self.run_dir is not None:
+                shutil.rmtree(self.run_dir, ignore_errors=True)
+                self.run_dir = None
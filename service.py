@@ -0,0 +1,122 @@
+import json
+import itertools
+import threading
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from api import Converter
+from errors import ConversionError, TracksFailedError
+
+# finished albums whose status can still be polled, the oldest ones are forgotten first
+max_finished_albums = 1000
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != '/albums':
+            self._reply(404, { 'error': 'no such resource' })
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            album_id = self.server.service.submit(request)
+        except (ValueError, TypeError, ConversionError) as error:
+            self._reply(400, { 'error': str(error) })
+            return
+        self._reply(202, { 'id': album_id })
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == '/albums':
+            self._reply(200, service.statuses())
+            return
+        album_id = self.path[len('/albums/'):] if self.path.startswith('/albums/') else ''
+        status = service.status(int(album_id)) if album_id.isdigit() else None
+        if status is None:
+            self._reply(404, { 'error': 'no such album' })
+        else:
+            self._reply(200, status)
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # the conversions already say what they do
+        pass
+
+
+class Service:
+    """
+    Converts the albums posted to a local http endpoint, in one long lived process: no interpreter
+    start or tool check per album. POST /albums takes a json object with the album_dir and any of
+    the album options, and answers with the id of the album; GET /albums/<id> tells its state
+    (queued, running, done or failed) with its result or error, GET /albums lists them all.
+    Every other option is the one the service was started with. The server only listens on the
+    loopback interface: it converts whatever path it is given.
+    """
+    def __init__(self, config, port, n_albums=1):
+        self.converter = Converter(config, n_albums)
+        # album id -> (album dir, future), in submission order
+        self.albums = dict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), ServiceHandler)
+        self.server.daemon_threads = True
+        self.server.service = self
+
+    def submit(self, request):
+        if not isinstance(request, dict) or not isinstance(request.get('album_dir'), str):
+            raise ValueError('the request must be a json object with an album_dir')
+        options = { option: value for option, value in request.items() if option != 'album_dir' }
+        future = self.converter.convert_album(request['album_dir'], **options)
+        with self._lock:
+            album_id = next(self._ids)
+            self.albums[album_id] = (request['album_dir'], future)
+            finished_ids = [finished_id for finished_id, (album_dir, album_future) in self.albums.items()
+                            if album_future.done()]
+            for finished_id in finished_ids[:max(0, len(finished_ids) - max_finished_albums)]:
+                del self.albums[finished_id]
+        return album_id
+
+    def status(self, album_id):
+        with self._lock:
+            if album_id not in self.albums:
+                return None
+            album_dir, future = self.albums[album_id]
+        status = { 'id': album_id, 'album_dir': album_dir, 'state': 'queued' }
+        if future.running():
+            status['state'] = 'running'
+        elif future.cancelled():
+            status.update(state='failed', error='cancelled')
+        elif future.done():
+            error = future.exception()
+            if error is None:
+                status.update(state='done', result=future.result().as_dict())
+            else:
+                status.update(state='failed', error=str(error) if isinstance(error, ConversionError) else repr(error))
+                if isinstance(error, TracksFailedError):
+                    status['failed_tracks'] = sorted(error.failed_tracks)
+        return status
+
+    def statuses(self):
+        with self._lock:
+            album_ids = list(self.albums)
+        statuses = [self.status(album_id) for album_id in album_ids]
+        return [status for status in statuses if status is not None]
+
+    def serve(self):
+        host, port = self.server.server_address[:2]
+        print('converting the albums posted to http://{}:{}/albums'.format(host, port))
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            # interrupting or terminating the service is the way to stop it
+            print('service stopped')
+        finally:
+            self.server.server_close()
+            # the running albums are stopped and the queued ones dropped
+            self.converter.close(cancel=True)
+        return 0
@@ -1,15 +1,20 @@
 import re
 import os
+import struct
 import literals
+import metadata
 
-from utility import subprocess_popen
+from metadata import MetadataReader
 from utility import slugify
+from errors import CuefileError
 
 
 class Tagging:
     def __init__(self, config):
         self.config = config
         self.encoding = literals.utf_8
+        # stream headers already read, an image holding every track is read once
+        self.stream_infos = dict()
 
     def _fix_coding_issue(self, line):
         try:
@@ -26,142 +31,101 @@ class Tagging:
     def get_album_tags_from_cuefile(self, cuefile_obj):
         config = self.config
         cuefile = cuefile_obj.cuefile
-        encoding = config.cuefile_encoding
+        sheet = cuefile_obj.sheet
+        cuefile_dir = os.path.dirname(os.path.abspath(cuefile))
         tag_dict = dict()
         tag_dict[1] = dict()
 
-        n_track = 0
-        n_lossless_file = 0
         global_artist = None if config.args.performer is None else config.args.performer.title()
         global_genre = None if config.args.genre is None else config.args.genre.title()
         album = None if config.args.album is None else config.args.album.title()
-        first_track_detected = False
-        # detecting multiple lossless files
-        lossless_files = dict()
-
-        with open(cuefile, encoding=encoding) as cuefile_fd:
-            for cuefile_line in cuefile_fd.readlines():
-                title = None
-
-                if config.args.year is None:
-                    year_match = re.match(r'^ *\t*(REM )?DATE *\t*["\']?([0-9]*)["\']? *$', cuefile_line, re.IGNORECASE)
-                    if year_match is not None:
-                        year = year_match.group(2)
-                        continue
-                else:
-                    year = config.args.year
-
-                if config.args.performer is None:
-                    artist_match = re.match(r'^ *\t*(REM )?PERFORMER *\t*["\'](.*)["\'] *$', cuefile_line, re.IGNORECASE)
-                    if artist_match is not None:
-                        artist = artist_match.group(2)
-                        if first_track_detected:
-                            track_tag_dict[literals.artist] = artist.title()
-                        global_artist = artist.title()
-                        continue
-                elif first_track_detected:
-                    track_tag_dict[literals.artist] = global_artist
-
-                if config.args.genre is None:
-                    genre_match = re.match(r'^ *\t*(REM )?GENRE *\t*["\'](.*)["\'] *$', cuefile_line, re.IGNORECASE)
-                    if genre_match is not None:
-                        genre = genre_match.group(2)
-                        if first_track_detected:
-                            track_tag_dict[literals.genre] = genre.title()
-                        global_genre = genre.title()
-                        continue
-                elif first_track_detected:
-                    track_tag_dict[literals.genre] = global_genre
-
-                title_match = re.match(r'^ *\t*(REM )?TITLE *\t*["\'](.*)["\'] *$', cuefile_line, re.IGNORECASE)
-                if title_match is not None:
-                    if first_track_detected:
-                        title = title_match.group(2)
-                        track_tag_dict[literals.title] = title.title()
-                        track_tag_dict[literals.outfile] = f'{n_track:02d} {slugify(title)}.m4a'
-                        track_tag_dict[literals.album] = album
-                    elif config.args.album is None:
-                        album = title_match.group(2)
-                    continue
-
-                file_match = re.match(r'^ *\t*(REM )?TRACK .*$', cuefile_line, re.IGNORECASE)
-                if file_match is not None:
-                    first_track_detected = True
-                    n_track += 1
-                    tag_dict[1][n_track] = dict()
-                    track_tag_dict = tag_dict[1][n_track]
-                    track_tag_dict[literals.global_genre] = global_genre
-                    track_tag_dict[literals.genre] = global_genre
-                    track_tag_dict[literals.year] = year
-                    track_tag_dict[literals.album] = album
-                    track_tag_dict[literals.comment] = 'Generated by all new lossless2lossy.py!'
-                    track_tag_dict[literals.disctotal] = '1'
-                    track_tag_dict[literals.global_artist] = global_artist
-                    track_tag_dict[literals.artist] = global_artist
-                    track_tag_dict[literals.title] = ''
-                    track_tag_dict[literals.infile] = ''
-                    track_tag_dict[literals.outfile] = f'{n_track:02d} {slugify(title)}.m4a'
-                    if config.args.cover is not None:
-                        track_tag_dict[literals.cover] = config.args.cover
-                    else:
-                        track_tag_dict[literals.cover] = ''
-                    continue
-
-                file_match = re.match(r'^ *\t*FILE *\t*"(.*)" *(WAVE)?(FLAC)?(APE)? *\t*$', cuefile_line, re.IGNORECASE)
-                if file_match is not None:
-                    n_lossless_file += 1
-                    lossless_files[n_lossless_file] = file_match.group(1)
+        year = config.args.year
+
+        if year is None and 'DATE' in sheet.rems:
+            year_match = re.match(r'^([0-9]*)', sheet.rems['DATE'])
+            year = year_match.group(1)
+        if config.args.performer is None and sheet.performer is not None:
+            global_artist = sheet.performer.title()
+        if config.args.genre is None and 'GENRE' in sheet.rems:
+            global_genre = sheet.rems['GENRE'].title()
+        if config.args.album is None:
+            album = sheet.title
+
+        for n_track, cue_track in enumerate(sheet.tracks, 1):
+            title = cue_track.title
+            track_tag_dict = dict()
+            tag_dict[1][n_track] = track_tag_dict
+            track_tag_dict[literals.global_genre] = global_genre
+            track_tag_dict[literals.genre] = global_genre
+            if config.args.genre is None and 'GENRE' in cue_track.rems:
+                track_tag_dict[literals.genre] = cue_track.rems['GENRE'].title()
+            track_tag_dict[literals.year] = year
+            track_tag_dict[literals.album] = album
+            track_tag_dict[literals.comment] = 'Generated by all new lossless2lossy.py!'
+            track_tag_dict[literals.disctotal] = sheet.rems.get('TOTALDISCS', '1')
+            if 'DISCNUMBER' in sheet.rems:
+                track_tag_dict[literals.disc] = sheet.rems['DISCNUMBER']
+            track_tag_dict[literals.global_artist] = global_artist
+            track_tag_dict[literals.artist] = global_artist
+            if config.args.performer is None and cue_track.performer is not None:
+                track_tag_dict[literals.artist] = cue_track.performer.title()
+            track_tag_dict[literals.title] = '' if title is None else title.title()
+            track_tag_dict[literals.infile] = ''
+            track_tag_dict[literals.outfile] = f'{n_track:02d} {slugify(title)}.m4a'
+            if config.args.cover is not None:
+                track_tag_dict[literals.cover] = config.args.cover
+            else:
+                track_tag_dict[literals.cover] = ''
 
-        lossless_files_len = len(lossless_files)
+        lossless_files_len = len(sheet.files)
 
         if lossless_files_len == 0:
-            print('malformed cuefile: no lossless file specified')
-            exit(-1)
+            raise CuefileError('malformed cuefile: no lossless file specified')
         elif lossless_files_len > 1:
             config.single_lossless_file = False
-            if lossless_files_len != len(tag_dict[1]):
-                print('malformed cuefile: number of lossless files differs from number of tracks')
-                exit(-1)
-            for track, lossless_file in lossless_files.items():
-                lossless_file = os.path.join(os.path.dirname(os.path.abspath(cuefile)), lossless_file)
+            for n_track, cue_track in enumerate(sheet.tracks, 1):
+                if cue_track.file is None:
+                    raise CuefileError('malformed cuefile: track {} does not belong to any file'.format(n_track))
+                lossless_file = os.path.join(cuefile_dir, cue_track.file.name)
                 filename, ext = os.path.splitext(lossless_file)
-                tag_dict[1][track][literals.losslessfile] = lossless_file
-                tag_dict[1][track][literals.infile] = filename + '.wav'
+                track_dict = tag_dict[1][n_track]
+                track_dict[literals.losslessfile] = lossless_file
+                track_dict[literals.stream_info] = self._stream_info(lossless_file)
+                if len(cue_track.file.tracks) == 1:
+                    track_dict[literals.infile] = filename + '.wav'
+                    track_dict[literals.duration] = self._stream_duration(lossless_file)
+                else:
+                    # a file holding several tracks: each one is read from its own range
+                    if cue_track.start() is None:
+                        raise CuefileError('malformed cuefile: track {} has no INDEX 01'.format(n_track))
+                    track_dict[literals.infile] = f'{filename}-track{n_track:02d}.wav'
+                    track_dict[literals.start] = cue_track.start()
+                    track_dict[literals.end] = sheet.track_end(cue_track)
+                    track_dict[literals.duration] = self._range_duration(cue_track.start(), track_dict[literals.end],
+                                                                         lossless_file)
         else:
             config.single_lossless_file = True
-            config.single_lossless_file_name = lossless_files[1]
+            config.single_lossless_file_name = sheet.files[0].name
+            lossless_file = os.path.join(cuefile_dir, config.single_lossless_file_name)
             for track, track_dict in tag_dict[1].items():
-                track_dict[literals.infile] = f'split-track{track:02d}.wav'
+                track_dict[literals.infile] = os.path.join(cuefile_dir, f'split-track{track:02d}.wav')
+                cue_track = sheet.tracks[track - 1]
+                track_dict[literals.stream_info] = self._stream_info(lossless_file)
+                track_dict[literals.duration] = self._range_duration(cue_track.start(), sheet.track_end(cue_track),
+                                                                     lossless_file)
 
         return tag_dict
 
-    def get_album_tags_from_dir(self):
+    def get_album_tags_from_dir(self, album_dir=None):
         config = self.config
-        cwd = os.getcwd()
-        audio_source_files = [f for f in os.listdir(cwd) if f.endswith('.ape')
+        if album_dir is None:
+            album_dir = os.getcwd()
+        audio_source_files = [os.path.join(album_dir, f) for f in sorted(os.listdir(album_dir)) if f.endswith('.ape')
                               or f.endswith('.wv')
                               or f.endswith('.flac')
                               or f.endswith('.m4a')]
         tag_dict = dict()
 
-        decode_stderr = list()
-        for track_file in audio_source_files:
-
-            if config.decoder == literals.ffmpeg:
-                decode_cmd = config.other_tools[config.decoder].copy()
-                decode_cmd.append('-i')
-                decode_cmd.append(track_file)
-                decode_cmd.append('-y')
-                decode_cmd.append('-f')
-                decode_cmd.append('ffmetadata')
-
-                decode_subprocess = subprocess_popen(decode_cmd)
-                decode_subprocess.wait()
-                decode_stderr.append(decode_subprocess.stderr)
-            else:
-                raise NotImplementedError()
-
-        track_idx = 0
         for track_file in audio_source_files:
             artist = None
             album = None
@@ -174,68 +138,56 @@ class Tagging:
             filename, ext = os.path.splitext(track_file)
             converted_filename = filename + '.wav'
 
-            if config.decoder == literals.ffmpeg:
-                decode_output = decode_stderr[track_idx]
-
-                for line in decode_output.readlines():
-                    decoded_line = self._detect_tag_line_encoding(line)
-                    decoded_line = self._fix_coding_issue(decoded_line)
-
-                    if config.args.performer is None:
-                        artist_match = re.match(r'^ +ARTIST +: +(.*)$', decoded_line, re.IGNORECASE)
-                        if artist_match is not None:
-                            artist = artist_match.group(1)
-                            continue
-                    else:
-                        artist = config.args.performer
-
-                    if config.args.album is None:
-                        album_match = re.match(r'^ +ALBUM +: +(.*)$', decoded_line, re.IGNORECASE)
-                        if album_match is not None:
-                            album = album_match.group(1)
-                            continue
-                    else:
-                        album = config.args.album
+            file_tags = dict()
+            with config.report.measure('probe', album=album_dir, filename=track_file):
+                try:
+                    raw_tags = MetadataReader(track_file).read_tags()
+                except (OSError, ValueError, IndexError, struct.error) as error:
+                    # a damaged tag block must not stop the album, the track is converted without its tags
+                    print('warning: cannot read the tags of {}: {}'.format(track_file, error))
+                    raw_tags = dict()
+            for key, value in raw_tags.items():
+                file_tags[key] = self._fix_coding_issue(self._detect_tag_line_encoding(value)).strip()
+
+            if config.args.performer is None:
+                artist = file_tags.get(metadata.artist)
+            else:
+                artist = config.args.performer
 
-                    if config.args.year is None:
-                        year_match = re.match(r' +DATE +: +([0-9][0-9][0-9][0-9]).?[0-9]?.?[0-9]?', decoded_line,
-                                              re.IGNORECASE)
-                        if year_match is not None:
-                            year = int(year_match.group(1))
-                            continue
-                    else:
-                        year = config.args.year
+            if config.args.album is None:
+                album = file_tags.get(metadata.album)
+            else:
+                album = config.args.album
 
-                    disc_match = re.match(r'^ +disc +: +([0-9]+)$', decoded_line, re.IGNORECASE)
-                    if disc_match is not None:
-                        disc = int(disc_match.group(1))
-                        continue
+            if config.args.year is None:
+                year_match = re.match(r'^([0-9][0-9][0-9][0-9])', file_tags.get(metadata.date, ''))
+                if year_match is not None:
+                    year = int(year_match.group(1))
+            else:
+                year = config.args.year
 
-                    disctotal_match = re.match(r'^ +DISCTOTAL +: +([0-9]+)$', decoded_line,
-                                               re.IGNORECASE)
-                    if disctotal_match is not None:
-                        disctotal = int(disctotal_match.group(1))
-                        continue
+            disc_match = re.match(r'^([0-9]+)', file_tags.get(metadata.disc, ''))
+            if disc_match is not None:
+                disc = int(disc_match.group(1))
 
-                    title_match = re.match(r'^ +title +: +(.*)$', decoded_line, re.IGNORECASE)
-                    if title_match is not None:
-                        title = title_match.group(1)
-                        continue
+            disctotal_match = re.match(r'^([0-9]+)$', file_tags.get(metadata.disctotal, ''))
+            if disctotal_match is not None:
+                disctotal = int(disctotal_match.group(1))
 
-                    if config.args.genre is None:
-                        genre_match = re.match(r'^ +GENRE +: +(.*)$', decoded_line, re.IGNORECASE)
-                        if genre_match is not None:
-                            genre = genre_match.group(1)
-                            continue
-                    else:
-                        genre = config.args.genre
+            # a file without tags, or whose tags cannot be read, is named after its file: '01 title.flac'
+            name_match = re.match(r'^([0-9]+)?[ ._-]*(.*)$', os.path.basename(filename))
+            title = file_tags.get(metadata.title) or name_match.group(2)
 
-                    track_match = re.match(r'^ +track +: +([0-9]+)/?[0-9]*$', decoded_line, re.IGNORECASE)
-                    if track_match is not None:
-                        track = int(track_match.group(1))
-                        continue
+            if config.args.genre is None:
+                genre = file_tags.get(metadata.genre)
             else:
-                raise NotImplementedError()
+                genre = config.args.genre
+
+            track_match = re.match(r'^([0-9]+)/?[0-9]*$', file_tags.get(metadata.track, ''))
+            if track_match is not None:
+                track = int(track_match.group(1))
+            elif name_match.group(1) is not None:
+                track = int(name_match.group(1))
 
             track_tag_dict = dict()
             track_tag_dict[literals.artist] = self._titlecase(artist.title())
@@ -247,12 +199,13 @@ class Tagging:
             # disctotal is unused from now because infered by the size of the tag_dict dict
             track_tag_dict[literals.disctotal] = disctotal
             track_tag_dict[literals.losslessfile] = track_file
+            track_tag_dict[literals.duration] = self._stream_duration(track_file)
+            track_tag_dict[literals.stream_info] = self._stream_info(track_file)
             track_tag_dict[literals.infile] = converted_filename
             track_tag_dict[literals.outfile] = f'{track:02d} {slugify(title)}.m4a'
             if disc not in tag_dict:
                 tag_dict[disc] = dict()
             tag_dict[disc][track] = track_tag_dict
-            track_idx += 1
             if config.args.cover is not None:
                 track_tag_dict[literals.cover] = config.args.cover
             else:
@@ -262,6 +215,37 @@ class Tagging:
 
         return tag_dict
 
+    def _stream_info(self, lossless_file):
+        # sample rate, channels, bits and length in samples, None when the headers cannot tell
+        if lossless_file not in self.stream_infos:
+            try:
+                with self.config.report.measure('probe', album=os.path.dirname(lossless_file), filename=lossless_file):
+                    stream_info = MetadataReader(lossless_file).read_stream_info()
+            except (OSError, ValueError, IndexError, struct.error):
+                stream_info = None
+            if stream_info is not None and stream_info[metadata.sample_rate] == 0:
+                stream_info = None
+            self.stream_infos[lossless_file] = stream_info
+        return self.stream_infos[lossless_file]
+
+    def _stream_duration(self, lossless_file):
+        # length in seconds
+        stream_info = self._stream_info(lossless_file)
+        if stream_info is None:
+            return None
+        return stream_info[metadata.total_samples] / stream_info[metadata.sample_rate]
+
+    def _range_duration(self, start, end, lossless_file):
+        # start and end are cd frames of 1/75 s, a missing end is the end of the file
+        if start is None:
+            return None
+        if end is not None:
+            return (end - start) / 75
+        file_duration = self._stream_duration(lossless_file)
+        if file_duration is None:
+            return None
+        return max(0.0, file_duration - start / 75)
+
     def _detect_tag_line_encoding(self, line):
         try:
             decoded_line = line.decode(self.encoding)
@@ -0,0 +1,108 @@
+import os
+import literals
+
+from errors import ConfigError
+
+# what each target stands for: the encoders it can be given, the first one by default, and the extension of its files
+target_encoders = { literals.aac: (literals.ffmpeg, literals.afconvert), literals.opus: (literals.opus,) }
+target_extensions = { literals.aac: '.m4a', literals.opus: '.opus' }
+# the containers that take the cover as an attached picture stream
+cover_targets = (literals.aac,)
+target_options = ('encoder', 'bitrate', 'quality', 'path', 'tagger', 'rate', 'dither')
+# the rates hi-res sources come down to, by the rate family they belong to
+rate_families = (48000, 44100)
+# the encoders that only take one rate: libopus encodes at 48 kHz, whatever it is given
+fixed_rates = { literals.opus: 48000 }
+# the dither methods of ffmpeg's resampler, for the reduction to 16 bits of the encoders that need it
+dither_methods = ('none', 'rectangular', 'triangular', 'triangular_hp', 'lipshitz', 'shibata', 'low_shibata',
+                  'high_shibata', 'f_weighted', 'e_weighted', 'modified_e_weighted')
+default_dither = 'triangular_hp'
+
+
+class Target:
+    """
+    One output format of a run: the encoder with its bitrate/quality profile, the root its files
+    go to and the tagger that writes their tags. All the targets of a run share the decode of
+    every track, one ffmpeg encodes the decoded audio for each of them.
+    rate is the sample rate the target is encoded at: a rate in Hz, source to keep the one of the
+    source, or by default the 48 or 44.1 kHz of its family for sources above 48 kHz; opus is always
+    48 kHz. dither is the method used when a track goes down to 16 bits, none truncates.
+    encoder is the tool that encodes the target, afconvert for aac on macOS instead of ffmpeg.
+    """
+    def __init__(self, name, encoder=None, bitrate=None, quality=None, path=None, tagger=None, rate=None,
+                 dither=None):
+        self.name = name
+        self.encoder = encoder if encoder is not None else target_encoders[name][0]
+        self.extension = target_extensions[name]
+        self.bitrate = bitrate
+        self.quality = quality
+        self.path = path
+        self.tagger = tagger
+        self.rate = rate
+        self.dither = dither
+        # with several targets and no path of their own, each one gets a subdirectory of the output path
+        self.subdir = None
+
+    def root(self, out_root):
+        if self.path is not None:
+            return os.path.realpath(os.path.expanduser(self.path))
+        if self.subdir is not None:
+            return os.path.join(out_root, self.subdir)
+        return out_root
+
+    def output_rate(self, source_rate):
+        # never above the rate of the source, but for the encoders that only take one
+        if self.name in fixed_rates:
+            return fixed_rates[self.name]
+        if self.rate == 'source':
+            return source_rate
+        if self.rate is not None:
+            return min(int(self.rate), source_rate)
+        if source_rate <= rate_families[0]:
+            return source_rate
+        return next((rate for rate in rate_families if source_rate % rate == 0), rate_families[0])
+
+    def dither_method(self):
+        # None when the reduction to 16 bits truncates
+        dither = self.dither if self.dither is not None else default_dither
+        return None if dither == 'none' else dither
+
+    def embeds_cover(self):
+        return self.name in cover_targets
+
+    def __repr__(self):
+        return self.name
+
+
+def parse_targets(spec):
+    # name[:option=value...][,name...], e.g. aac:quality=4,opus:bitrate=160k:path=~/opus
+    targets = list()
+    for target_spec in spec.split(','):
+        name, *options = target_spec.strip().split(':')
+        if name not in target_encoders:
+            raise ConfigError('unknown target {}, the targets are {}'.format(name, ', '.join(target_encoders)))
+        if any(target.name == name for target in targets):
+            raise ConfigError('target {} is given twice'.format(name))
+        target = Target(name)
+        for option in options:
+            key, separator, value = option.partition('=')
+            if separator == '' or key not in target_options or value == '':
+                raise ConfigError('malformed option {} of target {}, the options are {}'.format(
+                    option, name, ', '.join(target_options)))
+            if key == 'rate' and value != 'source' and not value.isdigit():
+                raise ConfigError('malformed rate {} of target {}, a rate is given in Hz or as source'.format(
+                    value, name))
+            if key == 'rate' and name in fixed_rates and value != str(fixed_rates[name]):
+                raise ConfigError('target {} is always encoded at {} Hz'.format(name, fixed_rates[name]))
+            if key == 'encoder' and value not in target_encoders[name]:
+                raise ConfigError('unknown encoder {} of target {}, the encoders are {}'.format(
+                    value, name, ', '.join(target_encoders[name])))
+            if key == 'dither' and value not in dither_methods:
+                raise ConfigError('unknown dither {} of target {}, the dithers are {}'.format(
+                    value, name, ', '.join(dither_methods)))
+            setattr(target, key, value)
+        targets.append(target)
+    if len(targets) > 1:
+        for target in targets:
+            target.subdir = target.name
+    return targets
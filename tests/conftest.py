@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+# the modules live flat at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def stub_tools(tmp_path, monkeypatch):
+    # the stub ffmpeg of the benchmark answers the probes and copies its input to its output
+    import benchmark
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    for tool in benchmark.stub_tools:
+        os.symlink(os.path.realpath(benchmark.__file__), str(bin_dir / tool))
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ.get('PATH', ''))
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    return bin_dir
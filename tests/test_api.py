@@ -0,0 +1,55 @@
+import os
+import json
+
+import pytest
+
+import benchmark
+from api import Converter
+from errors import ToolchainError
+from utility import subprocess_popen
+
+
+def write_album(root, n_tracks):
+    generator = benchmark.AlbumGenerator(str(root), n_tracks, 1, 'sine', True)
+    album_dir = generator.generate('tagged', 'flac')
+    with open(os.path.join(album_dir, 'cover.jpg'), 'wb') as cover_fd:
+        cover_fd.write(b'\xff\xd8\xff\xe0 same picture')
+    return album_dir
+
+
+def test_two_albums_at_once(tmp_path, stub_tools):
+    album_dirs = [write_album(tmp_path / name, n_tracks) for name, n_tracks in (('one', 3), ('two', 2))]
+    # the second album overrides the picture of its directory with a cover of its own
+    cover_file = tmp_path / 'other.jpg'
+    cover_file.write_bytes(b'\xff\xd8\xff\xe0 other picture')
+    album_covers = [None, str(cover_file)]
+    out_dirs = [tmp_path / 'out' / name for name in ('one', 'two')]
+    for out_dir in out_dirs:
+        out_dir.mkdir(parents=True)
+    report_path = tmp_path / 'report.json'
+    # decoded to wav files, the albums share the scratch directory of the converter
+    with Converter(n_albums=2, stream='wav', scratch=str(tmp_path / 'scratch'), report=str(report_path),
+                   no_progress=True) as converter:
+        futures = [converter.convert_album(album_dir, path=str(out_dir), cover=cover)
+                   for album_dir, out_dir, cover in zip(album_dirs, out_dirs, album_covers)]
+        results = [future.result() for future in futures]
+        run_dir = converter.config.scratch.run_dir
+        # both albums worked in the same run directory, each in a subdirectory of its own
+        assert sorted(os.listdir(run_dir)) == ['album-001', 'album-002']
+        assert len(converter.config.cover_art.covers) == 2
+
+    assert [result.n_tracks for result in results] == [3, 2]
+    for result, out_dir in zip(results, out_dirs):
+        outfiles = result.outfiles['aac']
+        assert len(outfiles) == result.n_tracks
+        assert all(os.path.isfile(outfile) and outfile.startswith(str(out_dir)) for outfile in outfiles)
+    assert not os.path.exists(run_dir)
+    with open(str(report_path)) as report_fd:
+        records = json.load(report_fd)['records']
+    assert [record['id'] for record in records] == list(range(len(records)))
+    assert set(record['album'] for record in records if record['stage'] == 'cover') == set(album_dirs)
+
+
+def test_missing_tool_raises():
+    with pytest.raises(ToolchainError):
+        subprocess_popen(['/nonexistent/ffmpeg', '-version'])
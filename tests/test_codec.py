@@ -0,0 +1,173 @@
+import os
+import struct
+import pytest
+
+import api
+import literals
+import manifest
+import metadata
+
+from codec import Codec
+from errors import ConfigError
+from target import parse_targets
+
+
+class RecordingScheduler:
+    # takes the jobs of a codec without running them
+    def __init__(self):
+        self.jobs = list()
+
+    def submit(self, name, cmd, key=None, after=None, duration=None, stage=None, **options):
+        self.jobs.append((name, cmd, stage))
+        return name
+
+
+def ogg_page(packet, sequence):
+    segments = [255] * (len(packet) // 255) + [len(packet) % 255]
+    return b'OggS' + bytes(2) + bytes(8) + struct.pack('<III', 1, sequence, 0) + bytes([len(segments)]) + \
+        bytes(segments) + packet
+
+
+def write_opus(path, comments):
+    # an opus header page, then the comments; no audio, only the headers are read
+    block = struct.pack('<I', 6) + b'ffmpeg' + struct.pack('<I', len(comments))
+    for comment in comments:
+        block += struct.pack('<I', len(comment)) + comment.encode('utf-8')
+    with open(path, 'wb') as opus_file:
+        opus_file.write(ogg_page(b'OpusHead' + bytes([1, 2]) + bytes(9), 0))
+        opus_file.write(ogg_page(b'OpusTags' + block, 1))
+
+
+def make_codec(tmp_path, targets='opus', loudness=False):
+    config = api.make_config(targets=targets)
+    config.loudness = loudness
+    codec = Codec(config, scheduler=RecordingScheduler())
+    codec.album_dir = str(tmp_path)
+    for target in config.targets:
+        codec.dir_names[target] = str(tmp_path)
+    return codec
+
+
+def track_tags():
+    return { literals.outfile: '01 song.flac', literals.title: 'Song', literals.artist: 'Artist',
+             literals.album: 'Album', literals.genre: 'Jazz', literals.year: '1999', literals.comment: '',
+             literals.cover: '' }
+
+
+def test_opus_retag_keeps_the_gains(tmp_path):
+    codec = make_codec(tmp_path, loudness=True)
+    target = codec.config.targets[0]
+    write_opus(os.path.join(str(tmp_path), '01 song.opus'),
+               ['TITLE=Old', 'R128_TRACK_GAIN=-512', 'R128_ALBUM_GAIN=-300', 'GENRE=Rock'])
+
+    assert codec._retag_status(track_tags(), target) == manifest.retag
+    codec._submit_retag(track_tags(), (1, 9, 1, 1), target)
+    retag_cmd = codec.scheduler.jobs[0][1]
+    assert retag_cmd[retag_cmd.index('-map_metadata') + 1] == '-1'
+    metadata = [retag_cmd[idx + 1] for idx, param in enumerate(retag_cmd) if param == '-metadata']
+    assert 'R128_TRACK_GAIN=-512' in metadata
+    assert 'R128_ALBUM_GAIN=-300' in metadata
+    assert 'genre=Jazz' in metadata
+    assert 'GENRE=Rock' not in metadata
+
+
+def test_opus_without_gains_is_converted_with_loudness(tmp_path):
+    codec = make_codec(tmp_path, loudness=True)
+    write_opus(os.path.join(str(tmp_path), '01 song.opus'), ['TITLE=Old'])
+    assert codec._retag_status(track_tags(), codec.config.targets[0]) == manifest.convert
+    codec.config.loudness = False
+    assert codec._retag_status(track_tags(), codec.config.targets[0]) == manifest.retag
+
+
+def test_unreadable_m4a_is_converted(tmp_path):
+    codec = make_codec(tmp_path, targets='aac')
+    with open(os.path.join(str(tmp_path), '01 song.m4a'), 'wb') as m4a_file:
+        m4a_file.write(struct.pack('>I4s', 16, b'ftyp') + b'M4A ' + bytes(4) + struct.pack('>I4s', 8, b'mdat'))
+    assert codec._retag_status(track_tags(), codec.config.targets[0]) == manifest.convert
+
+
+def test_missing_output_is_not_retagged(tmp_path):
+    codec = make_codec(tmp_path, targets='aac')
+    codec.config.retag_only = True
+    status = codec._retag_only_status(track_tags(), (1, 9, 1, 1), codec.config.targets[0], manifest.convert)
+    assert status == manifest.up_to_date
+
+
+def hires_tags(sample_rate, bits=24):
+    tags = track_tags()
+    tags[literals.losslessfile] = '/music/01 song.flac'
+    tags[literals.stream_info] = { metadata.sample_rate: sample_rate, metadata.channels: 2, metadata.bits: bits,
+                                   metadata.total_samples: sample_rate * 60 }
+    return tags
+
+
+def make_piped_codec(tmp_path, targets):
+    codec = make_codec(tmp_path, targets)
+    codec.config.stream = literals.stream_pipe
+    return codec
+
+
+def test_opus_from_88200_is_resampled_once_to_48000(tmp_path):
+    codec = make_piped_codec(tmp_path, 'opus')
+    tags = hires_tags(88200)
+    assert codec._decode_rate(tags) == 48000
+    decode_filters = codec._decode_filters(tags)
+    assert len(decode_filters) == 1 and 'osr=48000' in decode_filters[0] and 'osf=s16' in decode_filters[0]
+    assert codec._encode_filters(tags, codec.config.targets[0]) == list()
+
+
+def test_targets_of_different_rates_resample_the_source_themselves(tmp_path):
+    codec = make_piped_codec(tmp_path, 'aac,opus')
+    tags = hires_tags(88200)
+    aac, opus = codec.config.targets
+    assert codec._decode_rate(tags) is None
+    assert codec._decode_bits(tags) == 24
+    assert codec._decode_filters(tags) == list()
+    assert 'pcm_s24le' in codec._compose_decoder_cmd(tags[literals.losslessfile], '-', tags)
+    # each target resamples the 24 bit source once, the dither comes after
+    aac_filters = codec._encode_filters(tags, aac)
+    assert len(aac_filters) == 1 and 'osr=44100' in aac_filters[0]
+    opus_filters = codec._encode_filters(tags, opus)
+    assert len(opus_filters) == 1 and 'osr=48000' in opus_filters[0]
+
+
+def test_opus_rate_is_fixed():
+    assert parse_targets('opus')[0].output_rate(44100) == 48000
+    with pytest.raises(ConfigError):
+        parse_targets('opus:rate=44100')
+
+
+def test_afconvert_reads_a_wav_and_is_tagged_by_atomicparsley(tmp_path, capsys):
+    config = api.make_config(targets='aac:encoder=afconvert', stream='pipe', tagger='ffmpeg')
+    assert 'falling back to intermediate wav files' in capsys.readouterr().out
+    target = config.targets[0]
+    assert (config.stream, target.encoder, target.tagger) == (literals.stream_wav, literals.afconvert,
+                                                               literals.atomicparsley)
+    codec = make_codec(tmp_path, 'aac:encoder=afconvert')
+    tags = dict(track_tags(), **{ literals.infile: str(tmp_path / 'track.wav') })
+    cmd = codec._compose_converter_cmd(tags, [(codec.config.targets[0], str(tmp_path))], partial=True)
+    assert cmd[0] == literals.afconvert
+    assert cmd[-2:] == [str(tmp_path / 'track.wav'), codec._partial_file(str(tmp_path / '01 song.m4a'))]
+    # afconvert cannot stream its pcm, its tracks are not measured
+    assert make_codec(tmp_path, 'aac:encoder=afconvert', loudness=True)._create_meter(tags, config.targets) is None
+
+
+@pytest.mark.parametrize('targets', ['aac:encoder=afconvert,opus', 'opus:encoder=afconvert', 'aac:encoder=lame'])
+def test_afconvert_only_encodes_aac_alone(targets):
+    with pytest.raises(ConfigError):
+        api.make_config(targets=targets)
+
+
+def test_unknown_settings_name_the_bad_value(tmp_path):
+    codec = make_piped_codec(tmp_path, 'aac')
+    target = codec.config.targets[0]
+    target.encoder = 'lame'
+    with pytest.raises(ConfigError, match='lame'):
+        codec._append_codec_to_cmd(list(), target)
+    codec.config.decoder = literals.flac
+    with pytest.raises(ConfigError, match='flac'):
+        codec._compose_decoder_cmd('album.flac', '-', track_tags())
+    codec.config.stream = 'tcp'
+    tags = dict(track_tags(), **{ literals.losslessfile: 'album.flac', literals.infile: 'album.flac' })
+    with pytest.raises(ConfigError, match='tcp'):
+        codec._compose_stream_cmd(tags, [(target, str(tmp_path))])
@@ -0,0 +1,91 @@
+import os
+import hashlib
+
+import pytest
+
+from api import make_config
+from cover import CoverArt
+from errors import AlbumError
+from test_metadata import flac_bytes, write
+
+
+@pytest.fixture
+def cache_home(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    return tmp_path / 'cache' / 'lossless2lossy' / 'covers'
+
+
+def cover_art(monkeypatch, max_size=1000, resized=b'\xff\xd8 resized'):
+    # the resizes are counted instead of run through ffmpeg
+    cover_art = CoverArt(make_config(), max_size)
+    cover_art.n_resizes = 0
+
+    def resize(image):
+        cover_art.n_resizes += 1
+        return resized
+
+    monkeypatch.setattr(cover_art, '_resize', resize)
+    return cover_art
+
+
+def album_with_cover(root, image, name='cover.jpg'):
+    root.mkdir(parents=True)
+    (root / name).write_bytes(image)
+    return str(root)
+
+
+def test_miss_then_hit(tmp_path, cache_home, monkeypatch):
+    image = b'\xff\xd8\xff\xe0 picture'
+    first_album = album_with_cover(tmp_path / 'one', image)
+    second_album = album_with_cover(tmp_path / 'two', image, 'Folder.JPG')
+    covers = cover_art(monkeypatch)
+    path = covers.album_cover(first_album, list())
+    digest = hashlib.sha256(image + b'1000').hexdigest()
+    assert path == str(cache_home / (digest + '.jpg'))
+    with open(path, 'rb') as cover_fd:
+        assert cover_fd.read() == b'\xff\xd8 resized'
+    # the albums sharing a cover share the cached file, it is resized once
+    assert covers.album_cover(second_album, list()) == path
+    assert covers.n_resizes == 1
+
+    # the next run finds it in the cache
+    next_run = cover_art(monkeypatch)
+    assert next_run.album_cover(first_album, list()) == path
+    assert next_run.n_resizes == 0
+    assert sorted(os.listdir(str(cache_home))) == [digest + '.jpg']
+
+
+def test_size_is_part_of_the_key(tmp_path, cache_home, monkeypatch):
+    album = album_with_cover(tmp_path / 'album', b'\xff\xd8\xff\xe0 picture')
+    small = cover_art(monkeypatch, 300).album_cover(album, list())
+    large = cover_art(monkeypatch, 1000).album_cover(album, list())
+    assert small != large
+    assert len(os.listdir(str(cache_home))) == 2
+
+
+def test_png_that_cannot_be_resized_stays_png(tmp_path, cache_home, monkeypatch):
+    album = album_with_cover(tmp_path / 'album', b'\x89PNG picture', 'front.png')
+    path = cover_art(monkeypatch, resized=None).album_cover(album, list())
+    assert path.endswith('.png')
+    with open(path, 'rb') as cover_fd:
+        assert cover_fd.read() == b'\x89PNG picture'
+
+
+def test_where_the_cover_comes_from(tmp_path, cache_home, monkeypatch):
+    album = album_with_cover(tmp_path / 'album', b'\xff\xd8 folder picture')
+    flac = write(tmp_path / 'album', '01.flac', flac_bytes([b'TITLE=x'], picture=b'\x89PNG embedded'))
+    given = tmp_path / 'given.jpg'
+    given.write_bytes(b'\xff\xd8 given picture')
+    covers = CoverArt(make_config(), 0)
+    # the given file, then the embedded picture, then the picture of the directory
+    assert covers._find_image(album, [flac], str(given)) == b'\xff\xd8 given picture'
+    assert covers._find_image(album, [flac], None) == b'\x89PNG embedded'
+    assert covers._find_image(album, list(), None) == b'\xff\xd8 folder picture'
+    assert covers._find_image(str(tmp_path), list(), None) is None
+    assert covers.album_cover(str(tmp_path), list()) == ''
+    with pytest.raises(AlbumError):
+        covers.album_cover(album, list(), str(tmp_path / 'missing.jpg'))
+    # kept as it is without a size
+    with open(covers.album_cover(album, list()), 'rb') as cover_fd:
+        assert cover_fd.read() == b'\xff\xd8 folder picture'
+    assert not any(name.endswith('.tmp') for name in os.listdir(str(cache_home)))
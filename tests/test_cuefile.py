@@ -0,0 +1,125 @@
+import codecs
+
+import pytest
+
+import literals
+from api import make_config
+from cuefile import CueSheet, Cuefile
+from errors import CuefileError
+
+image_sheet = '''REM GENRE "Progressive Rock"
+REM DATE 1973
+REM DISCID 8A0A6B0B
+PERFORMER "The Band"
+TITLE "Great Album"
+FILE "Great Album.flac" WAVE
+  TRACK 01 AUDIO
+    TITLE "First Song"
+    INDEX 01 00:00:00
+  TRACK 02 AUDIO
+    TITLE "Second Song"
+    PERFORMER 'Guest'
+    REM COMPOSER Someone
+    INDEX 00 03:58:70
+    INDEX 01 04:00:05
+  track 03 audio
+    title Third
+    index 01 10:01:74
+'''
+
+
+def test_image_sheet():
+    sheet = CueSheet().parse(image_sheet.encode('utf-8'))
+    assert sheet.rems == { 'GENRE': 'Progressive Rock', 'DATE': '1973', 'DISCID': '8A0A6B0B' }
+    assert (sheet.performer, sheet.title) == ('The Band', 'Great Album')
+    assert [(entry.name, entry.file_type) for entry in sheet.files] == [('Great Album.flac', 'WAVE')]
+    assert [track.number for track in sheet.tracks] == [1, 2, 3]
+    assert [track.title for track in sheet.tracks] == ['First Song', 'Second Song', 'Third']
+    first, second, third = sheet.tracks
+    assert (first.performer, second.performer) == (None, 'Guest')
+    assert second.rems == { 'COMPOSER': 'Someone' }
+    # positions in cd frames of 1/75 s
+    assert second.indexes[0][1] == (3 * 60 + 58) * 75 + 70
+    assert [track.start() for track in sheet.tracks] == [0, 240 * 75 + 5, 601 * 75 + 74]
+    assert [sheet.track_end(track) for track in sheet.tracks] == [240 * 75 + 5, 601 * 75 + 74, None]
+
+
+def test_file_per_track_with_pregap_in_previous_file():
+    sheet = CueSheet().parse(b'FILE "01.wav" WAVE\n'
+                             b'  TRACK 01 AUDIO\n'
+                             b'    INDEX 01 00:00:00\n'
+                             b'  TRACK 02 AUDIO\n'
+                             b'    INDEX 00 03:10:00\n'
+                             b'FILE 02.wav WAVE\n'
+                             b'    INDEX 01 00:00:00\n')
+    first_file, second_file = sheet.files
+    assert second_file.name == '02.wav'
+    # the track belongs to the file its INDEX 01 is in, its pregap stays in the previous one
+    assert first_file.tracks == [sheet.tracks[0]]
+    assert second_file.tracks == [sheet.tracks[1]]
+    assert sheet.tracks[1].indexes[0] == (first_file, 190 * 75)
+    assert sheet.track_end(sheet.tracks[0]) is None
+
+
+@pytest.mark.parametrize('data, encoding', [
+    (codecs.BOM_UTF8 + 'TITLE "Café"\n'.encode('utf-8'), literals.utf_8),
+    (codecs.BOM_UTF16_LE + 'TITLE "Café"\n'.encode('utf-16-le'), 'utf-16'),
+    ('TITLE "Café"\n'.encode('utf-8'), literals.utf_8),
+    ('TITLE "Café"\n'.encode('cp1252'), literals.cp1252),
+])
+def test_encodings(data, encoding):
+    sheet = CueSheet().parse(data)
+    assert sheet.title == 'Café'
+    assert sheet.encoding == encoding
+
+
+def test_malformed_lines_are_skipped():
+    sheet = CueSheet().parse(b'\n   \n"orphan"\nINDEX 01 00:00:00\nFILE a.flac WAVE\nTRACK xx AUDIO\n  INDEX 01 1:2\n')
+    assert len(sheet.tracks) == 1
+    assert sheet.tracks[0].number == 1
+    assert sheet.tracks[0].file is sheet.files[0]
+    assert sheet.tracks[0].start() is None
+    assert sheet.track_end(sheet.tracks[0]) is None
+
+
+def test_track_before_any_file():
+    with pytest.raises(CuefileError):
+        CueSheet().parse(b'TITLE "Album"\nTRACK 01 AUDIO\n  INDEX 01 00:00:00\nFILE a.flac WAVE\n')
+
+
+def write_cuefile(album_dir, name='album.cue', text=image_sheet):
+    album_dir.mkdir(exist_ok=True)
+    (album_dir / name).write_text(text)
+    return str(album_dir / name)
+
+
+def test_select_the_only_cuefile(tmp_path):
+    path = write_cuefile(tmp_path / 'album')
+    config = make_config()
+    # set by the tagging step when every track comes from one file
+    config.single_lossless_file = True
+    cuefile = Cuefile(config)
+    cuefile.select_cuefile(str(tmp_path / 'album'))
+    assert (cuefile.mode, cuefile.cuefile) == (0, path)
+    assert cuefile.extract_single_lossless_file() == str(tmp_path / 'album' / 'Great Album.flac')
+    assert cuefile.extract_track_indexes() == { 1: 0, 2: 240 * 75 + 5, 3: 601 * 75 + 74 }
+
+
+def test_select_without_cuefile(tmp_path):
+    (tmp_path / 'album').mkdir()
+    cuefile = Cuefile(make_config())
+    cuefile.select_cuefile(str(tmp_path / 'album'))
+    assert (cuefile.mode, cuefile.cuefile) == (1, None)
+
+
+def test_select_among_several_cuefiles(tmp_path):
+    write_cuefile(tmp_path / 'album', 'one.cue')
+    write_cuefile(tmp_path / 'album', 'two.cue')
+    with pytest.raises(CuefileError):
+        Cuefile(make_config()).select_cuefile(str(tmp_path / 'album'))
+    # unless one of them is given
+    cuefile = Cuefile(make_config(cuefile=str(tmp_path / 'album' / 'two.cue')))
+    cuefile.select_cuefile(str(tmp_path / 'album'))
+    assert cuefile.cuefile.endswith('two.cue')
+    with pytest.raises(CuefileError):
+        Cuefile(make_config(cuefile=str(tmp_path / 'missing.cue'))).select_cuefile(str(tmp_path / 'album'))
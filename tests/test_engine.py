@@ -0,0 +1,84 @@
+import os
+import sys
+import time
+import asyncio
+
+from engine import Engine, Progress
+
+# writes its -progress blocks in pieces, as ffmpeg may, and its arguments to stdout
+fake_ffmpeg = '''#!{python}
+import sys, time
+args = sys.argv[1:]
+progress = open(int(args[args.index('-progress') + 1].split(':')[1]), 'w')
+sys.stdout.write(' '.join(args))
+sys.stdout.flush()
+for out_time, state in ((1000000, 'continue'), (2000000, 'continue'), (4000000, 'end')):
+    block = 'bitrate=128.0kbits/s\\nout_time_us={{}}\\nspeed=2.00x\\nprogress={{}}\\n'.format(out_time, state)
+    for part in (block[:17], block[17:]):
+        progress.write(part)
+        progress.flush()
+        time.sleep(0.02)
+'''
+
+
+def write_fake_ffmpeg(tmp_path):
+    path = tmp_path / 'ffmpeg'
+    path.write_text(fake_ffmpeg.format(python=sys.executable))
+    os.chmod(str(path), 0o755)
+    return str(path)
+
+
+def test_progress_of_a_block():
+    progress = Progress(duration=8.0)
+    assert progress.update('out_time_ms', '2000000') is False
+    assert progress.update('speed', ' 4.0x') is False
+    assert progress.update('progress', 'continue') is True
+    assert (progress.percent(), progress.eta(), progress.finished) == (25.0, 1.5, False)
+    assert str(progress) == '25% 4.0x eta 2s'
+    progress.update('speed', 'N/A')
+    progress.update('progress', 'end')
+    assert (progress.percent(), progress.eta(), str(progress)) == (100.0, None, '100%')
+    # without a duration only the time written is known
+    assert str(Progress()) == '0.0s'
+
+
+def test_engine_reports_the_ffmpeg_progress(tmp_path):
+    blocks = list()
+
+    def on_progress(progress):
+        blocks.append((progress.out_time, progress.speed, progress.finished, progress.percent()))
+
+    result = asyncio.run(Engine().run([write_fake_ffmpeg(tmp_path), '-i', 'in.flac', 'out.m4a'], 4.0, on_progress))
+    assert result.returncode == 0
+    # the progress goes to a pipe of its own, the stdout stays the encoder's
+    assert result.stdout.decode('utf-8').startswith('-progress pipe:')
+    assert result.stdout.decode('utf-8').endswith('-nostats -i in.flac out.m4a')
+    assert blocks == [(1.0, 2.0, False, 25.0), (2.0, 2.0, False, 50.0), (4.0, 2.0, True, 100.0)]
+    assert len(result.rusages) == 1
+
+
+def test_silent_job_is_killed_after_the_timeout():
+    start_time = time.monotonic()
+    result = asyncio.run(Engine(timeout=0.3).run([sys.executable, '-c', 'import time; time.sleep(30)']))
+    assert time.monotonic() - start_time < 10
+    assert result.timed_out
+    assert result.returncode != 0
+    assert b'killed after 0.3s without any activity' in result.stderr
+
+
+def test_output_counts_as_activity():
+    chunks = list()
+    script = 'import sys, time\nfor n in range(8):\n    print(n, flush=True)\n    time.sleep(0.1)\n'
+    result = asyncio.run(Engine(timeout=0.5).run([sys.executable, '-c', script], on_stdout=chunks.append))
+    assert not result.timed_out
+    assert result.returncode == 0
+    # handed over as it arrives, and not kept
+    assert b''.join(chunks).split() == [str(n).encode('ascii') for n in range(8)]
+    assert result.stdout == b''
+
+
+def test_pipeline_failure_is_the_downstream_one():
+    result = asyncio.run(Engine().run([[sys.executable, '-c', 'print("pcm")'],
+                                       [sys.executable, '-c', 'import sys; sys.stdin.read(); sys.exit(3)']]))
+    assert result.returncode == 3
+    assert len(result.rusages) == 2
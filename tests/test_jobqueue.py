@@ -0,0 +1,134 @@
+import time
+import threading
+import pytest
+
+import jobqueue
+
+from jobqueue import JobQueue
+
+
+class Clock:
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(jobqueue.time, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def job_queue(tmp_path):
+    job_queue = JobQueue(str(tmp_path / 'queue.sqlite'))
+    job_queue.run_id = 1
+    for track in (1, 2):
+        job_queue.put('/music/album', 1, track, { 'track': track })
+    job_queue.commit()
+    yield job_queue
+    job_queue.close()
+
+
+def state(job_queue, job_id):
+    return job_queue._connection.execute('SELECT state, worker, attempts FROM jobs WHERE id = ?', (job_id,)).fetchone()
+
+
+def test_leased_jobs_are_not_leased_twice(job_queue, clock):
+    jobs = job_queue.lease('a', 1)
+    assert [payload for job_id, run_id, payload in jobs] == [{ 'track': 1 }]
+    assert [job_id for job_id, run_id, payload in job_queue.lease('b', 5)] == [2]
+    assert job_queue.lease('c', 5) == list()
+    assert job_queue.counts()[jobqueue.leased] == 2
+
+
+def test_expired_lease_is_requeued(job_queue, clock):
+    job_id = job_queue.lease('a', 1)[0][0]
+    clock.now += jobqueue.lease_time + 1
+    assert job_id in [leased_id for leased_id, run_id, payload in job_queue.lease('b', 5)]
+    assert state(job_queue, job_id) == (jobqueue.leased, 'b', 2)
+    # the dead worker's late result is ignored
+    job_queue.finish(job_id, 'a')
+    assert state(job_queue, job_id)[0] == jobqueue.leased
+
+
+def test_heartbeat_renews_the_lease(job_queue, clock):
+    job_id = job_queue.lease('a', 1)[0][0]
+    clock.now += jobqueue.lease_time * 2 / 3
+    job_queue.heartbeat('a', [job_id], n_done=3)
+    clock.now += jobqueue.lease_time * 2 / 3
+    assert job_id not in [leased_id for leased_id, run_id, payload in job_queue.lease('b', 5)]
+    assert job_queue._connection.execute('SELECT n_done FROM workers WHERE id = ?', ('a',)).fetchone() == (3,)
+
+
+def test_failed_job_is_retried_then_failed(job_queue, clock):
+    for attempt in range(jobqueue.max_attempts):
+        job_id = job_queue.lease('a', 1)[0][0]
+        assert job_id == 1
+        job_queue.finish(job_id, 'a', 'encode failed')
+    assert state(job_queue, 1) == (jobqueue.failed, 'a', jobqueue.max_attempts)
+
+
+def test_lease_expiring_too_often_fails_the_job(job_queue, clock):
+    for attempt in range(jobqueue.max_attempts):
+        assert job_queue.lease('a', 1)[0][0] == 1
+        clock.now += jobqueue.lease_time + 1
+    job_queue.lease('b', 1)
+    assert state(job_queue, 1)[0] == jobqueue.failed
+
+
+def test_released_job_does_not_count_an_attempt(job_queue, clock):
+    job_id = job_queue.lease('a', 1)[0][0]
+    job_queue.release(job_id, 'a')
+    assert state(job_queue, job_id) == (jobqueue.pending, 'a', 0)
+
+
+class HeartbeatQueue:
+    # takes the heartbeats and the failed jobs of a worker
+    def __init__(self, worker):
+        self.worker = worker
+        self.beats = list()
+
+    def heartbeat(self, worker_id, job_ids, n_done=0, n_failed=0):
+        # the ids are read while the executor threads drop their jobs
+        self.beats.append((sorted(job_ids), n_failed))
+
+    def finish(self, job_id, worker_id, error=None):
+        pass
+
+
+def test_heartbeat_sends_a_snapshot_of_the_leased_jobs(monkeypatch):
+    monkeypatch.setattr(jobqueue, 'lease_time', 0.003)
+    worker = jobqueue.Worker(None, None)
+    worker.job_queue = HeartbeatQueue(worker)
+    worker.leased_ids.update(range(2000))
+    errors = list()
+
+    def beat():
+        try:
+            worker._heartbeat()
+        except Exception as error:
+            errors.append(error)
+
+    heartbeat = threading.Thread(target=beat)
+    heartbeat.start()
+
+    def drop(job_ids):
+        for job_id in job_ids:
+            worker._drop(job_id, 'cannot plan')
+
+    # the finishes of the tracks run in the threads of the executor
+    droppers = [threading.Thread(target=drop, args=(range(n, 2000, 4),)) for n in range(4)]
+    for dropper in droppers:
+        dropper.start()
+    for dropper in droppers:
+        dropper.join()
+    time.sleep(0.01)
+    worker._stopped.set()
+    heartbeat.join()
+    assert errors == list()
+    assert (worker.leased_ids, worker.n_failed) == (set(), 2000)
+    assert worker.job_queue.beats[-1] == ([], 2000)
@@ -0,0 +1,99 @@
+import os
+import json
+
+import benchmark
+import literals
+import lossless2lossy
+from api import make_config
+from journal import Journal, journal_filename
+from test_codec import make_codec, track_tags
+
+
+def test_torn_line_is_cut_before_the_next_record(tmp_path):
+    journal = Journal(str(tmp_path))
+    journal.record([str(tmp_path / 'one.m4a')])
+    journal.close()
+    # a crash in the middle of the second record
+    with open(str(tmp_path / journal_filename), 'a') as journal_fd:
+        journal_fd.write('{"outfiles": ["' + str(tmp_path / 'tw'))
+
+    journal = Journal(str(tmp_path), resume=True)
+    assert journal.finished_outfiles == { os.path.realpath(str(tmp_path / 'one.m4a')) }
+    journal.record([str(tmp_path / 'three.m4a')])
+    journal.close()
+    with open(str(tmp_path / journal_filename)) as journal_fd:
+        lines = journal_fd.read().splitlines()
+    assert [json.loads(line)['outfiles'] for line in lines] == [[os.path.realpath(str(tmp_path / name))]
+                                                                for name in ('one.m4a', 'three.m4a')]
+
+
+def test_finished_needs_the_output(tmp_path):
+    (tmp_path / 'one.m4a').write_bytes(b'audio')
+    journal = Journal(str(tmp_path))
+    journal.record([str(tmp_path / 'one.m4a'), str(tmp_path / 'two.m4a')])
+    journal.close()
+    journal = Journal(str(tmp_path), resume=True)
+    assert journal.finished(str(tmp_path / 'one.m4a'))
+    assert not journal.finished(str(tmp_path / 'two.m4a'))
+    journal.close()
+    # a new run starts a new journal
+    journal = Journal(str(tmp_path))
+    journal.close()
+    assert Journal(str(tmp_path), resume=True).finished_outfiles == set()
+
+
+def test_resume_skips_the_finished_tracks(tmp_path, stub_tools, monkeypatch, capsys):
+    album_dir = benchmark.AlbumGenerator(str(tmp_path / 'albums'), 3, 1, 'sine', True).generate('tagged', 'flac')
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    monkeypatch.chdir(album_dir)
+
+    def convert(**options):
+        config = make_config(stream='wav', scratch=str(tmp_path / 'scratch'), path=str(out_dir), no_progress=True,
+                             **options)
+        try:
+            assert lossless2lossy.convert(config) == 0
+        finally:
+            config.scratch.cleanup()
+
+    convert()
+    outfiles = sorted(os.path.join(dir_name, file_name) for dir_name, _, file_names in os.walk(str(out_dir))
+                      for file_name in file_names if file_name.endswith('.m4a'))
+    assert len(outfiles) == 3
+    mtimes = [os.stat(outfile).st_mtime_ns for outfile in outfiles]
+    # the output of the second track was lost with the crash
+    os.remove(outfiles[1])
+    capsys.readouterr()
+
+    convert(resume=True)
+    assert capsys.readouterr().out.count('is up to date') == 2
+    assert all(os.path.isfile(outfile) for outfile in outfiles)
+    assert os.stat(outfiles[0]).st_mtime_ns == mtimes[0]
+    assert os.stat(outfiles[2]).st_mtime_ns == mtimes[2]
+
+
+def test_outputs_only_get_their_name_once_complete(tmp_path):
+    codec = make_codec(tmp_path, targets='aac')
+    codec.journal = Journal(str(tmp_path))
+    target = codec.config.targets[0]
+    tags = track_tags()
+    outfile = codec._outfile(tags, str(tmp_path), target)
+    partial_file = codec._partial_file(outfile)
+    (tmp_path / os.path.basename(partial_file)).write_bytes(b'encoded')
+    codec._commit_func(tags, [target])()
+    codec.journal.close()
+    assert sorted(os.listdir(str(tmp_path))) == sorted(['01 song.m4a', journal_filename])
+    assert Journal(str(tmp_path), resume=True).finished(outfile)
+
+
+def test_failed_track_leaves_no_partial_output(tmp_path):
+    codec = make_codec(tmp_path, targets='aac')
+    tags = dict(track_tags(), **{ literals.losslessfile: str(tmp_path / 'song.flac'),
+                                  literals.infile: str(tmp_path / 'song.flac') })
+    codec.album_tags = { 1: { 1: tags } }
+    partial_file = codec._partial_file(codec._outfile(tags, str(tmp_path), codec.config.targets[0]))
+    with open(partial_file, 'wb') as partial_fd:
+        partial_fd.write(b'half encoded')
+    # the track has no finished jobs: it was interrupted
+    assert codec.collect_results() == 1
+    assert os.listdir(str(tmp_path)) == list()
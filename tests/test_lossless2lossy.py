@@ -0,0 +1,26 @@
+import os
+
+import benchmark
+import lossless2lossy
+from api import make_config
+
+
+def test_dry_run_writes_nothing(tmp_path, stub_tools, monkeypatch, capsys):
+    album_dir = benchmark.AlbumGenerator(str(tmp_path / 'albums'), 3, 1, 'sine', True).generate('tagged', 'flac')
+    with open(os.path.join(album_dir, 'cover.jpg'), 'wb') as cover_fd:
+        cover_fd.write(b'\xff\xd8\xff\xe0 picture')
+    scratch_dir = tmp_path / 'scratch'
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    monkeypatch.chdir(album_dir)
+    # decoded to wav files, a real run would make a scratch directory and cache the cover
+    config = make_config(dry_run=True, stream='wav', scratch=str(scratch_dir), path=str(out_dir), incremental=True)
+    try:
+        assert lossless2lossy.convert(config) == 0
+    finally:
+        config.scratch.cleanup()
+
+    assert 'album-001' in capsys.readouterr().out
+    assert not scratch_dir.exists()
+    assert not (tmp_path / 'cache' / 'lossless2lossy' / 'covers').exists()
+    assert os.listdir(str(out_dir)) == []
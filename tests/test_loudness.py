@@ -0,0 +1,156 @@
+import math
+import time
+import threading
+
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+
+import loudness
+from loudness import numpy
+
+needs_numpy = pytest.mark.skipif(not loudness.available(), reason='the loudness meter needs numpy')
+
+
+def sine(amplitude, frequency, sample_rate, seconds, channels=2):
+    samples = amplitude * numpy.sin(2 * numpy.pi * frequency * numpy.arange(int(sample_rate * seconds)) / sample_rate)
+    return numpy.repeat(samples[:, None], channels, axis=1).astype(numpy.float32)
+
+
+def measure(frames, sample_rate, chunk_bytes=None, executor=None):
+    meter = loudness.LoudnessMeter(sample_rate, frames.shape[1], executor)
+    data = frames.astype('<f4').tobytes()
+    chunk_bytes = chunk_bytes or len(data)
+    for start in range(0, len(data), chunk_bytes):
+        meter.feed(data[start:start + chunk_bytes])
+    meter.flush()
+    return meter.loudness
+
+
+def reference_loudness(frames, sample_rate):
+    # BS.1770 the slow way: the biquads sample by sample, then 400 ms blocks every 100 ms and both gates
+    weighted = frames.astype(numpy.float64)
+    for b, a in loudness.k_weighting(sample_rate):
+        output = numpy.empty_like(weighted)
+        x1 = x2 = y1 = y2 = numpy.zeros(weighted.shape[1])
+        for n, x in enumerate(weighted):
+            y = b[0] * x + b[1] * x1 + b[2] * x2 - a[1] * y1 - a[2] * y2
+            output[n] = y
+            x1, x2, y1, y2 = x, x1, y, y1
+        weighted = output
+    step = sample_rate // 10
+    energies = numpy.array([(weighted[start:start + 4 * step] ** 2).mean(axis=0).sum()
+                            for start in range(0, len(weighted) - 4 * step + 1, step)])
+    energies = energies[energies > 10 ** ((loudness.absolute_gate + 0.691) / 10)]
+    threshold = loudness.energy_to_loudness(energies.mean()) + loudness.relative_gate
+    return loudness.energy_to_loudness(energies[energies > 10 ** ((threshold + 0.691) / 10)].mean())
+
+
+@needs_numpy
+@pytest.mark.parametrize('sample_rate', [44100, 48000, 96000])
+@pytest.mark.parametrize('level', [-23.0, -33.0])
+def test_ebu_tech_3341_sine(sample_rate, level):
+    # cases 1 and 2 of EBU Tech 3341: a stereo 1 kHz sine at the given dBFS reads the same in LUFS
+    frames = sine(10 ** (level / 20), 1000.0, sample_rate, 20.0)
+    assert measure(frames, sample_rate).integrated() == pytest.approx(level, abs=0.1)
+
+
+@needs_numpy
+def test_bass_matches_sample_by_sample_filter():
+    # nearly all of the energy under 40 Hz, where the high pass of the K-weighting decides the loudness:
+    # steps that come and go every 250 ms, the filter rings across the 100 ms sub-blocks
+    sample_rate = 48000
+    random = numpy.random.default_rng(7)
+    steps = (numpy.arange(3 * sample_rate) % (sample_rate // 2) < sample_rate // 4) * 0.5
+    frames = numpy.repeat(steps[:, None], 2, axis=1) + random.normal(0.0, 0.01, (len(steps), 2))
+    frames = frames.astype(numpy.float32)
+    expected = reference_loudness(frames, sample_rate)
+    # chunks that never line up with the 100 ms sub-blocks nor with the batches, analysed in the background
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        measured = measure(frames, sample_rate, chunk_bytes=8 * 12345, executor=executor).integrated()
+    assert measured == pytest.approx(expected, abs=0.01)
+    assert measure(frames, sample_rate, chunk_bytes=8 * 12345).integrated() == pytest.approx(measured, abs=1e-9)
+
+
+@needs_numpy
+def test_silence_has_no_loudness():
+    frames = numpy.zeros((48000 * 2, 2), dtype=numpy.float32)
+    track = measure(frames, 48000)
+    assert track.integrated() is None
+    assert loudness.gain_tags('.opus', track) == dict()
+
+
+@needs_numpy
+def test_opus_gains_are_q78_towards_r128_reference():
+    frames = sine(10 ** (-33.0 / 20), 1000.0, 48000, 10.0)
+    track = measure(frames, 48000)
+    tags = loudness.gain_tags('.opus', track, track)
+    gain = int(tags['R128_TRACK_GAIN']) / 256.0
+    assert gain == pytest.approx(loudness.r128_reference - track.integrated(), abs=1 / 256.0)
+    assert tags['R128_ALBUM_GAIN'] == tags['R128_TRACK_GAIN']
+    assert not math.isnan(gain)
+
+
+def test_analysis_queue_runs_batches_in_order_off_the_caller():
+    analysed = list()
+    running = [0]
+
+    def analyse(data):
+        running[0] += 1
+        assert running[0] == 1
+        time.sleep(0.001)
+        analysed.append((data, threading.current_thread() is threading.main_thread()))
+        running[0] -= 1
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        queue = loudness.AnalysisQueue(analyse, executor)
+        for n_batch in range(50):
+            queue.put(n_batch)
+        queue.join()
+        assert analysed == [(n_batch, False) for n_batch in range(50)]
+        # a queue that ran dry starts again
+        queue.put(50)
+        queue.join()
+    assert analysed[-1] == (50, False)
+
+
+def test_analysis_queue_raises_the_error_on_join():
+    analysed = list()
+
+    def analyse(data):
+        if data == 3:
+            raise ValueError('bad batch')
+        analysed.append(data)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        queue = loudness.AnalysisQueue(analyse, executor)
+        for n_batch in range(10):
+            queue.put(n_batch)
+        with pytest.raises(ValueError):
+            queue.join()
+    assert analysed == [0, 1, 2]
+
+
+class Measured:
+    # what gain_tags reads of a Loudness, without numpy
+    def __init__(self, integrated, peak):
+        self.value = integrated
+        self.peak = peak
+
+    def integrated(self):
+        return self.value
+
+
+def test_gain_tags_of_each_container():
+    track = Measured(-13.0, 0.5)
+    album = Measured(-15.0, 0.9)
+    assert loudness.gain_tags('.opus', track, album) == { 'R128_TRACK_GAIN': str(-10 * 256),
+                                                          'R128_ALBUM_GAIN': str(-8 * 256) }
+    tags = loudness.gain_tags('.m4a', track)
+    assert tags['replaygain_track_gain'] == '-5.00 dB'
+    assert tags['replaygain_track_peak'] == '0.500000'
+    assert 'replaygain_album_gain' not in tags
+    # -5 dB: the adjustments are 1000 and 2500 times 10^0.5, the peak 0.5 of 32768
+    assert tags['iTunNORM'].split() == ['00000C5A', '00000C5A', '00001EE2', '00001EE2', '00024CA8', '00024CA8',
+                                        '00004000', '00004000', '00024CA8', '00024CA8']
+    assert loudness.gain_tags('.m4a', Measured(None, 0.0)) == dict()
@@ -0,0 +1,176 @@
+import struct
+
+import metadata
+from api import make_config
+from metadata import MetadataReader
+from tagging import Tagging
+
+
+def atom(atom_type, payload):
+    return struct.pack('>I4s', 8 + len(payload), atom_type) + payload
+
+
+def full_atom(atom_type, payload, version=0):
+    return atom(atom_type, bytes([version, 0, 0, 0]) + payload)
+
+
+def ilst_item(atom_type, value, data_type=1):
+    return atom(atom_type, atom(b'data', struct.pack('>II', data_type, 0) + value))
+
+
+def audio_track(timescale, duration, entry_format=b'mp4a', n_channels=2, sample_size=16, cookie=b'',
+                handler=b'soun', chunk_offsets=(0,), offsets_atom=b'stco'):
+    mdhd = full_atom(b'mdhd', struct.pack('>IIIIHH', 0, 0, timescale, duration, 0, 0))
+    hdlr = full_atom(b'hdlr', struct.pack('>I4s', 0, handler) + bytes(12) + b'\0')
+    # the 16.16 sample rate of the entry wraps above 65535 Hz, readers go by the timescale
+    entry = entry_format + bytes(6) + struct.pack('>HHHIHHHHI', 1, 0, 0, 0, n_channels, sample_size, 0, 0,
+                                                  (timescale & 0xffff) << 16) + cookie
+    stsd = full_atom(b'stsd', struct.pack('>I', 1) + struct.pack('>I', 4 + len(entry)) + entry)
+    offset_format = '>I' if offsets_atom == b'stco' else '>Q'
+    stco = full_atom(offsets_atom, struct.pack('>I', len(chunk_offsets)) +
+                     b''.join(struct.pack(offset_format, offset) for offset in chunk_offsets))
+    stbl = atom(b'stbl', stsd + stco)
+    return atom(b'trak', atom(b'mdia', mdhd + hdlr + atom(b'minf', stbl)))
+
+
+def alac_cookie(bit_depth, n_channels, rate):
+    return full_atom(b'alac', struct.pack('>IBBBBBBHIII', 4096, 0, bit_depth, 40, 10, 14, n_channels, 255, 0, 0,
+                                          rate))
+
+
+def m4a_bytes(tracks, items=(), mdat=b'audio'):
+    ilst = atom(b'ilst', b''.join(ilst_item(*item) for item in items))
+    meta = full_atom(b'meta', full_atom(b'hdlr', bytes(4) + b'mdirappl' + bytes(9)) + ilst)
+    moov = atom(b'moov', full_atom(b'mvhd', bytes(96)) + b''.join(tracks) + atom(b'udta', meta))
+    return atom(b'ftyp', b'M4A \0\0\0\0M4A mp42isom') + moov + atom(b'mdat', mdat)
+
+
+def vorbis_comment_block(comments):
+    vendor = b'test'
+    block = struct.pack('<I', len(vendor)) + vendor + struct.pack('<I', len(comments))
+    for comment in comments:
+        block += struct.pack('<I', len(comment)) + comment
+    return block
+
+
+def flac_bytes(comments, rate=96000, n_channels=2, bits_per_sample=24, n_samples=480000, picture=None):
+    packed = (rate << 44) | ((n_channels - 1) << 41) | ((bits_per_sample - 1) << 36) | n_samples
+    blocks = [(0, struct.pack('>HH', 4096, 4096) + bytes(6) + packed.to_bytes(8, 'big') + bytes(16)),
+              (1, bytes(10)), (4, vorbis_comment_block(comments))]
+    if picture is not None:
+        mime = b'image/png'
+        blocks.append((6, struct.pack('>II', metadata.flac_front_cover, len(mime)) + mime +
+                       struct.pack('>IIIIII', 0, 1, 1, 24, 0, len(picture)) + picture))
+    data = b'fLaC'
+    for n_block, (block_type, block) in enumerate(blocks):
+        last = 0x80 if n_block == len(blocks) - 1 else 0
+        data += bytes([block_type | last]) + len(block).to_bytes(3, 'big') + block
+    return data + b'\xff\xf8 frames'
+
+
+def ape_tag(items):
+    # items: (key, value, flags)
+    body = b''.join(struct.pack('<II', len(value), flags) + key + b'\0' + value for key, value, flags in items)
+    size = len(body) + 32
+
+    def block(flags):
+        return b'APETAGEX' + struct.pack('<IIII', 2000, size, len(items), flags) + bytes(8)
+
+    return block(0xa0000000) + body + block(0x80000000)
+
+
+def write(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_flac_tags_stream_info_and_picture(tmp_path):
+    path = write(tmp_path, 'a.flac', flac_bytes([b'TITLE=First', b'artist=Band', b'ALBUM ARTIST=Various',
+                                                 b'TRACKNUMBER=1/9', b'DISCNUMBER=2', b'TITLE=Second',
+                                                 b'R128_TRACK_GAIN=-512', b'no separator'],
+                                                picture=b'\x89PNG picture'))
+    reader = MetadataReader(path)
+    # the first value of a tag wins, keys are matched whatever their case
+    assert reader.read_tags() == { metadata.title: b'First', metadata.artist: b'Band',
+                                   metadata.album_artist: b'Various', metadata.track: b'1/9', metadata.disc: b'2' }
+    assert reader.read_stream_info() == { metadata.sample_rate: 96000, metadata.channels: 2, metadata.bits: 24,
+                                          metadata.total_samples: 480000 }
+    assert reader.read_picture() == b'\x89PNG picture'
+    assert reader.read_comments()['R128_TRACK_GAIN'] == b'-512'
+
+
+def test_flac_after_id3v2(tmp_path):
+    id3 = b'ID3\x04\x00\x00' + bytes([0, 0, 0, 20]) + bytes(20)
+    path = write(tmp_path, 'id3.flac', id3 + flac_bytes([b'ALBUM=Tagged'], rate=44100, bits_per_sample=16))
+    reader = MetadataReader(path)
+    assert reader.read_tags() == { metadata.album: b'Tagged' }
+    assert reader.read_stream_info()[metadata.sample_rate] == 44100
+    assert reader.read_stream_info()[metadata.bits] == 16
+
+
+def test_apev2_tags_and_cover(tmp_path):
+    items = [(b'Title', b'Song\0Other', 0), (b'Album Artist', b'Various', 0), (b'Track', b'3/10', 0),
+             (b'Year', b'2001', 0), (b'Unknown', b'dropped', 0), (b'Cover Art (Front)', b'front.jpg\0\xff\xd8jpeg', 2),
+             (b'Genre', b'\x00binary', 2)]
+    path = write(tmp_path, 'a.ape', b'MAC audio' + ape_tag(items))
+    reader = MetadataReader(path)
+    # only the first of the null separated values of an item is kept
+    assert reader.read_tags() == { metadata.title: b'Song', metadata.album_artist: b'Various',
+                                   metadata.track: b'3/10', metadata.date: b'2001' }
+    assert reader.read_picture() == b'\xff\xd8jpeg'
+
+
+def test_apev2_before_id3v1(tmp_path):
+    path = write(tmp_path, 'a.wv', b'wvpk audio' + ape_tag([(b'ALBUM', b'Album', 0)]) + b'TAG' + bytes(125))
+    assert MetadataReader(path).read_tags() == { metadata.album: b'Album' }
+
+
+def test_mp4_tags(tmp_path):
+    items = [(b'\xa9nam', b'Title'), (b'\xa9ART', b'Artist'), (b'aART', b'Album Artist'), (b'\xa9day', b'1999'),
+             (b'trkn', struct.pack('>HHHH', 0, 4, 12, 0), 0), (b'disk', struct.pack('>HHH', 0, 1, 2), 0),
+             (b'gnre', struct.pack('>H', 18), 0), (b'covr', b'\xff\xd8cover', 13)]
+    path = write(tmp_path, 'a.m4a', m4a_bytes([audio_track(44100, 441000)], items))
+    reader = MetadataReader(path)
+    assert reader.read_tags() == { metadata.title: b'Title', metadata.artist: b'Artist',
+                                   metadata.album_artist: b'Album Artist', metadata.date: b'1999',
+                                   metadata.track: b'4/12', metadata.disc: b'1', metadata.disctotal: b'2',
+                                   metadata.genre: b'Rock' }
+    assert reader.read_picture() == b'\xff\xd8cover'
+
+
+def test_mp4_stream_info_from_sample_entry(tmp_path):
+    path = write(tmp_path, 'mono.m4a', m4a_bytes([audio_track(22050, 22050 * 3, n_channels=1, sample_size=16)]))
+    assert MetadataReader(path).read_stream_info() == { metadata.sample_rate: 22050, metadata.channels: 1,
+                                                        metadata.bits: 16, metadata.total_samples: 22050 * 3 }
+
+
+def test_mp4_alac_stream_info_from_cookie(tmp_path):
+    # a 24 bit 6 channel alac track, after a text track the reader must not take for the audio
+    tracks = [audio_track(1000, 5000, entry_format=b'text', n_channels=0, sample_size=0, handler=b'text'),
+              audio_track(96000, 96000 * 5, entry_format=b'alac', sample_size=16,
+                          cookie=alac_cookie(24, 6, 96000))]
+    path = write(tmp_path, 'hires.m4a', m4a_bytes(tracks))
+    assert MetadataReader(path).read_stream_info() == { metadata.sample_rate: 96000, metadata.channels: 6,
+                                                        metadata.bits: 24, metadata.total_samples: 96000 * 5 }
+
+
+def test_unknown_format(tmp_path):
+    path = write(tmp_path, 'a.wav', b'RIFF\0\0\0\0WAVEfmt ')
+    reader = MetadataReader(path)
+    assert reader.read_stream_info() is None
+    assert reader.read_tags() == dict()
+    assert reader.read_comments() == dict()
+
+
+def test_damaged_tags_leave_the_track_untagged(tmp_path, capsys):
+    write(tmp_path, '01 first.flac', flac_bytes([b'TITLE=First', b'ALBUM=Album', b'TRACKNUMBER=1']))
+    data = flac_bytes([b'TITLE=Second', b'ALBUM=Album', b'TRACKNUMBER=2'])
+    # the number of comments runs past the end of the block
+    n_comments = data.index(b'test') + 4
+    write(tmp_path, '02 second.flac', data[:n_comments] + struct.pack('<I', 0x7fffffff) + data[n_comments + 4:])
+    tag_dict = Tagging(make_config(performer='band', album='album', genre='rock')).get_album_tags_from_dir(
+        str(tmp_path))
+    assert 'cannot read the tags of ' + str(tmp_path / '02 second.flac') in capsys.readouterr().out
+    # the damaged track is named after its file
+    assert [(track, tags['title']) for track, tags in tag_dict[1].items()] == [(1, 'First'), (2, 'Second')]
@@ -0,0 +1,189 @@
+import os
+import struct
+
+import pytest
+
+import metadata
+import mp4tags
+from metadata import MetadataReader
+from test_metadata import atom, audio_track, full_atom, ilst_item
+
+chunks = (b'first chunk', b'second chunk', b'third chunk')
+
+
+def write_m4a(path, layout, chunk_offsets=None):
+    # layout: the top level atoms in order, among 'ftyp', 'moov', 'free', 'mdat'; the chunk offsets point
+    # to the chunks in mdat unless given
+    ilst = atom(b'ilst', ilst_item(b'\xa9too', b'Lavf') + ilst_item(b'\xa9nam', b'Old title'))
+    meta = full_atom(b'meta', full_atom(b'hdlr', bytes(4) + b'mdirappl' + bytes(9)) + ilst)
+
+    def build(stco_offsets, co64_offsets):
+        tracks = audio_track(44100, 44100, chunk_offsets=stco_offsets) + \
+            audio_track(44100, 44100, chunk_offsets=co64_offsets, offsets_atom=b'co64')
+        top_level = { b'ftyp': atom(b'ftyp', b'M4A \0\0\0\0M4A mp42isom'),
+                      b'moov': atom(b'moov', full_atom(b'mvhd', bytes(96)) + tracks + atom(b'udta', meta)),
+                      b'free': atom(b'free', bytes(1024)),
+                      b'mdat': atom(b'mdat', b''.join(chunks)) }
+        return b''.join(top_level[kind] for kind in layout)
+
+    # the offsets do not change the size of moov, the file is built once to find where the chunks are
+    data = build((0,) * len(chunks), (0,) * len(chunks))
+    mdat = data.index(b'mdat') + 4
+    offsets = chunk_offsets or [mdat + sum(len(chunk) for chunk in chunks[:idx]) for idx in range(len(chunks))]
+    path.write_bytes(build(offsets, offsets))
+    return str(path)
+
+
+def top_level(path):
+    with open(path, 'rb') as mp4_file:
+        return [(kind, start, end - start) for kind, start, payload_start, end in mp4tags._top_level_atoms(mp4_file)]
+
+
+def chunk_offsets(path):
+    # the entries of every stco and co64 table, in the order of the tracks
+    with open(path, 'rb') as mp4_file:
+        atoms, moov_index, payload = mp4tags._read_moov(mp4_file, path)
+    tables = list()
+
+    def walk(data, depth):
+        for kind, start, payload_start, end in mp4tags._atoms(data):
+            if depth < len(mp4tags.sample_table_path) and kind == mp4tags.sample_table_path[depth]:
+                walk(data[payload_start:end], depth + 1)
+            elif kind in (b'stco', b'co64'):
+                value_format = '>I' if kind == b'stco' else '>Q'
+                n_entries = struct.unpack_from('>I', data, payload_start + 4)[0]
+                tables.append([struct.unpack_from(value_format, data, payload_start + 8 + idx *
+                                                  struct.calcsize(value_format))[0] for idx in range(n_entries)])
+
+    walk(payload, 0)
+    return tables
+
+
+def read_chunks(path, offsets):
+    with open(path, 'rb') as mp4_file:
+        data = mp4_file.read()
+    return tuple(data[offset:offset + len(chunk)] for offset, chunk in zip(offsets, chunks))
+
+
+def freeform_tags(path):
+    with open(path, 'rb') as mp4_file:
+        atoms, moov_index, payload = mp4tags._read_moov(mp4_file, path)
+    for parent, offset in ((b'udta', 0), (b'meta', 0), (b'ilst', 4)):
+        payload = [payload[payload_start:end] for kind, start, payload_start, end in mp4tags._atoms(payload, offset)
+                   if kind == parent][0]
+    tags = dict()
+    for kind, start, payload_start, end in mp4tags._atoms(payload):
+        if kind == b'----':
+            children = { child: payload[child_payload_start:child_end] for child, child_start, child_payload_start,
+                         child_end in mp4tags._atoms(payload, payload_start, end) }
+            tags[children[b'name'][4:].decode('utf-8')] = children[b'data'][8:].decode('utf-8')
+    return tags
+
+
+def write_track_tags(path, cover=None):
+    items = mp4tags.track_items({ 'title': 'New title', 'artist': 'Artist', 'album': '' }, (2, 9), (1, 2), cover)
+    mp4tags.write_tags(path, items, { 'iTunNORM': ' 00000400', 'replaygain_track_gain': '-3.20 dB' })
+
+
+def assert_tagged(path, cover=None):
+    tags = MetadataReader(path).read_tags()
+    assert tags[metadata.title] == b'New title'
+    assert tags[metadata.artist] == b'Artist'
+    assert metadata.album not in tags
+    assert (tags[metadata.track], tags[metadata.disc], tags[metadata.disctotal]) == (b'2/9', b'1', b'2')
+    assert MetadataReader(path).read_picture() == cover
+    assert freeform_tags(path) == { 'iTunNORM': ' 00000400', 'replaygain_track_gain': '-3.20 dB' }
+    # the items write_tags does not know of are kept
+    with open(path, 'rb') as mp4_file:
+        assert ilst_item(b'\xa9too', b'Lavf') in mp4_file.read()
+    tables = chunk_offsets(path)
+    assert len(tables) == 2
+    for offsets in tables:
+        assert read_chunks(path, offsets) == chunks
+
+
+def test_moov_last_is_replaced_by_a_copy(tmp_path, monkeypatch):
+    path = write_m4a(tmp_path / 'a.m4a', (b'ftyp', b'mdat', b'moov'))
+    with open(path, 'rb') as mp4_file:
+        data_before = mp4_file.read()
+
+    # a crash before the copy takes the place of the file leaves it as it was
+    def crash(source, destination):
+        raise KeyboardInterrupt()
+
+    monkeypatch.setattr(os, 'replace', crash)
+    with pytest.raises(KeyboardInterrupt):
+        write_track_tags(path)
+    monkeypatch.undo()
+    with open(path, 'rb') as mp4_file:
+        assert mp4_file.read() == data_before
+    assert os.listdir(str(tmp_path)) == ['a.m4a']
+
+    mdat_before = top_level(path)[1]
+    write_track_tags(path, cover=b'\xff\xd8' + bytes(5000))
+    assert_tagged(path, cover=b'\xff\xd8' + bytes(5000))
+    assert top_level(path)[1] == mdat_before
+    assert os.listdir(str(tmp_path)) == ['a.m4a']
+    # a smaller moov leaves nothing behind it
+    write_track_tags(path)
+    assert_tagged(path)
+    assert [kind for kind, start, size in top_level(path)] == [b'ftyp', b'mdat', b'moov']
+    assert sum(size for kind, start, size in top_level(path)) == os.path.getsize(path)
+
+
+def test_moov_grows_into_the_free_room(tmp_path):
+    path = write_m4a(tmp_path / 'a.m4a', (b'ftyp', b'moov', b'free', b'mdat'))
+    size_before = os.path.getsize(path)
+    mdat_before = top_level(path)[-1]
+    write_track_tags(path, cover=b'\x89PNG' + bytes(500))
+    assert_tagged(path, cover=b'\x89PNG' + bytes(500))
+    # the audio did not move, what is left of the room is still free
+    assert os.path.getsize(path) == size_before
+    assert top_level(path)[-1] == mdat_before
+    assert [kind for kind, start, size in top_level(path)] == [b'ftyp', b'moov', b'free', b'mdat']
+
+
+def test_moov_without_room_moves_the_audio(tmp_path):
+    path = write_m4a(tmp_path / 'a.m4a', (b'ftyp', b'moov', b'mdat'))
+    os.chmod(path, 0o640)
+    cover = b'\xff\xd8' + bytes(3000)
+    write_track_tags(path, cover=cover)
+    # the chunk offsets follow the audio, padding is left for the next tags
+    assert_tagged(path, cover=cover)
+    kinds = top_level(path)
+    assert [kind for kind, start, size in kinds] == [b'ftyp', b'moov', b'free', b'mdat']
+    assert kinds[2][2] == 8 + mp4tags.padding_size
+    assert os.stat(path).st_mode & 0o777 == 0o640
+    assert not os.path.exists(path + '.moov')
+
+    # the next tags fit in the padding
+    size_before = os.path.getsize(path)
+    write_track_tags(path, cover=cover + bytes(1000))
+    assert_tagged(path, cover=cover + bytes(1000))
+    assert os.path.getsize(path) == size_before
+
+
+def test_stco_overflow_leaves_the_file_alone(tmp_path):
+    # a chunk near the end of a 4 GiB file: once shifted, its offset no longer fits in 32 bits
+    path = write_m4a(tmp_path / 'a.m4a', (b'ftyp', b'moov', b'mdat'), chunk_offsets=[0xfffffff0] * len(chunks))
+    with open(path, 'rb') as mp4_file:
+        data_before = mp4_file.read()
+    with pytest.raises(ValueError):
+        write_track_tags(path, cover=b'\xff\xd8' + bytes(3000))
+    with open(path, 'rb') as mp4_file:
+        assert mp4_file.read() == data_before
+    assert os.listdir(str(tmp_path)) == ['a.m4a']
+
+
+def test_check(tmp_path):
+    path = write_m4a(tmp_path / 'a.m4a', (b'ftyp', b'moov', b'mdat'))
+    mp4tags.check(path)
+    with open(path, 'rb') as mp4_file:
+        data = mp4_file.read()
+    # cut in the middle of mdat, and no moov at all
+    (tmp_path / 'truncated.m4a').write_bytes(data[:-5])
+    with pytest.raises(ValueError):
+        mp4tags.check(str(tmp_path / 'truncated.m4a'))
+    (tmp_path / 'no-moov.m4a').write_bytes(atom(b'ftyp', b'M4A ') + atom(b'mdat', b'audio'))
+    with pytest.raises(ValueError):
+        mp4tags.check(str(tmp_path / 'no-moov.m4a'))
@@ -0,0 +1,97 @@
+import pools
+from pools import Pools, cpu_pool, io_pool
+
+
+class Host:
+    # the /proc/stat counters and load average adapt reads, advanced by each interval
+    def __init__(self, monkeypatch):
+        self.total = 0
+        self.idle = 0
+        self.iowait = 0
+        self.load = 0.0
+        monkeypatch.setattr(pools, 'read_cpu_times', lambda: (self.total, self.idle, self.iowait))
+        monkeypatch.setattr(pools, 'read_load_average', lambda: self.load)
+
+    def interval(self, idle, iowait, load):
+        # shares of the next 1000 jiffies
+        self.total += 1000
+        self.idle += int(idle * 1000)
+        self.iowait += int(iowait * 1000)
+        self.load = load
+
+
+class Job:
+    def __init__(self, stage):
+        self.stage = stage
+        self.cores = None
+
+
+def make_pools(monkeypatch, cpu_jobs=4, io_jobs=2):
+    host = Host(monkeypatch)
+    job_pools = Pools(cpu_jobs, io_jobs, adaptive=True)
+    job_pools.n_cpus = 8
+    return host, job_pools
+
+
+def test_cpu_pool_backs_off_under_foreign_load_and_grows_back(monkeypatch):
+    host, job_pools = make_pools(monkeypatch)
+    for _ in range(4):
+        job_pools.start(Job('encode'))
+    # saturated, with two cores busy with somebody else's work
+    host.interval(0.01, 0.0, 6.0)
+    assert job_pools.adapt() is True
+    assert job_pools.limits[cpu_pool] == 3
+    for _ in range(5):
+        host.interval(0.01, 0.0, 6.0)
+        job_pools.adapt()
+    assert job_pools.limits[cpu_pool] == 1
+    # idle again: one more encode at every interval, up to the maximum
+    for limit in (2, 3, 4, 4):
+        host.interval(0.5, 0.0, 1.0)
+        job_pools.adapt()
+        assert job_pools.limits[cpu_pool] == limit
+
+
+def test_saturated_by_our_own_encodes_keeps_the_limit(monkeypatch):
+    host, job_pools = make_pools(monkeypatch)
+    for _ in range(4):
+        job_pools.start(Job('encode'))
+    host.interval(0.01, 0.0, 4.0)
+    assert job_pools.adapt() is False
+    assert job_pools.limits == { cpu_pool: 4, io_pool: 2 }
+
+
+def test_foreign_load_caps_the_cpu_pool_at_the_free_cores(monkeypatch):
+    host, job_pools = make_pools(monkeypatch, cpu_jobs=8)
+    # six cores busy elsewhere, whatever idles
+    host.interval(0.5, 0.0, 6.0)
+    job_pools.adapt()
+    assert job_pools.limits[cpu_pool] == 2
+
+
+def test_io_pool_shrinks_while_the_disks_are_the_bottleneck(monkeypatch):
+    host, job_pools = make_pools(monkeypatch, io_jobs=3)
+    host.interval(0.0, 0.3, 0.0)
+    job_pools.adapt()
+    assert job_pools.limits[io_pool] == 2
+    host.interval(0.0, 0.3, 0.0)
+    job_pools.adapt()
+    host.interval(0.0, 0.3, 0.0)
+    job_pools.adapt()
+    assert job_pools.limits[io_pool] == 1
+    host.interval(0.3, 0.01, 0.0)
+    job_pools.adapt()
+    assert job_pools.limits[io_pool] == 2
+    # the stages share the limits of their pool
+    assert job_pools.admits(Job('decode'))
+    job_pools.start(Job('decode'))
+    job_pools.start(Job('tag'))
+    assert not job_pools.admits(Job('decode'))
+    assert job_pools.admits(Job('encode'))
+
+
+def test_without_procfs_nothing_changes(monkeypatch):
+    monkeypatch.setattr(pools, 'read_cpu_times', lambda: None)
+    job_pools = Pools(4, 2, adaptive=True)
+    assert job_pools.adapt() is None
+    assert job_pools.limits == { cpu_pool: 4, io_pool: 2 }
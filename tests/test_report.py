@@ -0,0 +1,71 @@
+import sys
+import json
+import time
+import pytest
+
+from report import RunReport, read_proc_io
+from scheduler import Scheduler
+
+
+def test_measure_records_an_in_process_stage(tmp_path):
+    report = RunReport(str(tmp_path / 'report.json'))
+    with report.measure('probe', album='/music/album', filename='01.flac'):
+        time.sleep(0.02)
+    record, = report.records
+    assert (record['stage'], record['album'], record['file'], record['in_process']) == ('probe', '/music/album',
+                                                                                         '01.flac', True)
+    assert record['wall'] >= 0.02
+    assert record['end'] - record['start'] == pytest.approx(record['wall'], abs=1e-5)
+    assert record['queue_wait'] == 0.0
+
+
+def test_report_without_a_path_records_nothing():
+    report = RunReport()
+    with report.measure('probe'):
+        pass
+    scheduler = Scheduler(1, show_progress=False, report=report)
+    scheduler.submit('tag', lambda: None, stage='tag')
+    scheduler.run()
+    report.write()
+    assert report.records == list()
+
+
+def test_stage_timings_and_critical_path(tmp_path):
+    path = tmp_path / 'report.json'
+    report = RunReport(str(path))
+    scheduler = Scheduler(2, show_progress=False, report=report)
+    album = str(tmp_path)
+    for track in (1, 2):
+        decode = scheduler.submit('decode {}'.format(track), [sys.executable, '-c', 'import time; time.sleep(0.05)'],
+                                  (album, 1, track), stage='decode')
+        encode = scheduler.submit('encode {}'.format(track), lambda seconds=0.1 * track: time.sleep(seconds),
+                                  (album, 1, track), [decode], stage='encode')
+        scheduler.submit('tag {}'.format(track), lambda: None, (album, 1, track), [encode], stage='tag')
+    assert scheduler.run() == list()
+    report.write()
+
+    with open(str(path)) as report_fd:
+        written = json.load(report_fd)
+    records = written['records']
+    assert sorted(record['name'] for record in records) == ['decode 1', 'decode 2', 'encode 1', 'encode 2',
+                                                            'tag 1', 'tag 2']
+    by_name = { record['name']: record for record in records }
+    # the commands get the cpu time and i/o of their process, the callables run in process
+    assert by_name['decode 1']['cpu'] is not None and not by_name['decode 1']['in_process']
+    assert by_name['encode 1']['in_process'] and by_name['encode 1']['cpu'] is None
+    assert by_name['encode 2']['after'] == [by_name['decode 2']['id']]
+    assert all(record['queue_wait'] >= 0 and record['track'] in (1, 2) for record in records)
+
+    stages = written['summary']['stages']
+    assert { stage: stages[stage]['count'] for stage in stages } == { 'decode': 2, 'encode': 2, 'tag': 2 }
+    assert stages['encode']['wall'] >= 0.3
+    # the longest chain is the one of the second track
+    critical_path = written['summary']['critical_path']
+    assert critical_path['jobs'] == [by_name[name]['id'] for name in ('decode 2', 'encode 2', 'tag 2')]
+    assert critical_path['wall'] >= 0.25
+
+
+def test_read_proc_io(tmp_path):
+    (tmp_path / 'io').write_text('rchar: 100\nwchar: 20\nsyscr: 3\n')
+    assert read_proc_io(str(tmp_path / 'io')) == { 'read_bytes': 100, 'write_bytes': 20 }
+    assert read_proc_io(str(tmp_path / 'missing')) is None
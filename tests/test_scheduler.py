@@ -0,0 +1,172 @@
+import time
+import threading
+
+from scheduler import Scheduler
+
+
+class Tracker:
+    # the jobs as they start and end, and the most of them running at once
+    def __init__(self):
+        self.started = list()
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    def job(self, name, seconds=0.02):
+        def run():
+            with self._lock:
+                self.started.append(name)
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+            time.sleep(seconds)
+            with self._lock:
+                self.running -= 1
+        return run
+
+
+def test_jobs_submitted_by_on_finish_run_in_the_same_run():
+    scheduler = Scheduler(2, show_progress=False)
+    ran = list()
+
+    def submit_next(job):
+        if len(ran) < 3:
+            scheduler.submit('job {}'.format(len(ran)), lambda: ran.append(len(ran)), on_finish=submit_next)
+
+    scheduler.submit('first', lambda: ran.append(0), on_finish=submit_next)
+    assert scheduler.run() == list()
+    assert ran == [0, 1, 2]
+
+
+def test_wait_for_runs_after_a_failed_job():
+    scheduler = Scheduler(2, keep_going=True, show_progress=False)
+    ran = list()
+
+    def fail():
+        raise OSError('failed')
+
+    failed_job = scheduler.submit('failing', fail)
+    dependent = scheduler.submit('dependent', lambda: ran.append('dependent'), after=[failed_job])
+    scheduler.submit('finish', lambda: ran.append('finish'), wait_for=[failed_job, dependent])
+    failed_jobs = scheduler.run()
+    assert ran == ['finish']
+    assert failed_job in failed_jobs and dependent in failed_jobs
+
+
+def test_at_most_n_jobs_run_at_once():
+    scheduler = Scheduler(3, show_progress=False)
+    tracker = Tracker()
+    for n_job in range(10):
+        scheduler.submit('job {}'.format(n_job), tracker.job(n_job))
+    assert scheduler.run() == list()
+    assert len(tracker.started) == 10
+    assert tracker.max_running == 3
+
+
+def test_highest_priority_starts_first():
+    scheduler = Scheduler(1, show_progress=False)
+    tracker = Tracker()
+    for name, priority in (('short', 1.0), ('longest', 30.0), ('unknown', 0.0), ('long', 20.0)):
+        scheduler.submit(name, tracker.job(name, 0), priority=priority)
+    scheduler.run()
+    assert tracker.started == ['longest', 'long', 'short', 'unknown']
+
+
+def test_space_budget_admits_the_reservations_that_fit():
+    scheduler = Scheduler(4, show_progress=False)
+    scheduler.space_budget = 100
+    tracker = Tracker()
+    reserved = list()
+
+    def job(name):
+        run = tracker.job(name)
+
+        def reserve_and_run():
+            reserved.append(scheduler.reserved_bytes)
+            run()
+        return reserve_and_run
+
+    # two decodes of 40 fit at once, a third waits for the space the first ones give back
+    jobs = [scheduler.submit('decode {}'.format(n_job), job(n_job), reserve=40, release=40, priority=6 - n_job)
+            for n_job in range(6)]
+    assert scheduler.run() == list()
+    assert sorted(jobs, key=lambda job: job.start_time) == jobs
+    assert tracker.max_running == 2
+    assert max(reserved) <= 100
+    assert scheduler.reserved_bytes == 0
+
+
+def test_reservation_over_the_budget_runs_alone():
+    scheduler = Scheduler(4, show_progress=False)
+    scheduler.space_budget = 100
+    tracker = Tracker()
+    reserved = list()
+    scheduler.submit('huge', tracker.job('huge'), reserve=500, release=500, priority=2.0)
+    scheduler.submit('small', lambda: reserved.append(scheduler.reserved_bytes), reserve=10, release=10,
+                     priority=1.0)
+    scheduler.submit('no space', tracker.job('no space'), priority=0.0)
+    assert scheduler.run() == list()
+    # waiting for room would never end: started with nothing running, the other reservations wait for it
+    assert sorted(tracker.started) == ['huge', 'no space']
+    assert reserved == [10]
+
+
+def test_a_track_moves_on_as_soon_as_its_previous_step_is_done():
+    scheduler = Scheduler(1, show_progress=False)
+    tracker = Tracker()
+    for track in ('a', 'b'):
+        job = None
+        for step in ('decode', 'encode', 'cleanup', 'tag'):
+            job = scheduler.submit(step + ' ' + track, tracker.job(step + ' ' + track, 0), after=[job])
+    assert scheduler.run() == list()
+    # the steps of a started track go before the tracks that never started
+    assert tracker.started == ['decode a', 'encode a', 'cleanup a', 'tag a', 'decode b', 'encode b', 'cleanup b',
+                               'tag b']
+
+
+def test_failed_step_skips_the_rest_of_its_chain_only():
+    scheduler = Scheduler(2, keep_going=True, show_progress=False)
+    tracker = Tracker()
+
+    def fail():
+        raise OSError('encoder crashed')
+
+    decode_a = scheduler.submit('decode a', tracker.job('decode a', 0))
+    encode_a = scheduler.submit('encode a', fail, after=[decode_a])
+    tag_a = scheduler.submit('tag a', tracker.job('tag a', 0), after=[encode_a])
+    decode_b = scheduler.submit('decode b', tracker.job('decode b', 0))
+    encode_b = scheduler.submit('encode b', tracker.job('encode b', 0), after=[decode_b])
+    # the album gain waits for every encode, whether it succeeded or not
+    gains = scheduler.submit('gains', tracker.job('gains', 0), after=[encode_b], wait_for=[encode_a, encode_b])
+    failed_jobs = scheduler.run()
+    assert set(failed_jobs) == { encode_a, tag_a }
+    assert tag_a.skipped and tag_a.returncode is None
+    assert 'tag a' not in tracker.started
+    assert tracker.started[-1] == 'gains'
+    assert gains.start_time >= max(encode_a.end_time, encode_b.end_time)
+
+
+def test_first_failure_stops_the_run_without_keep_going():
+    scheduler = Scheduler(1, show_progress=False)
+    tracker = Tracker()
+
+    def fail():
+        raise OSError('decoder crashed')
+
+    scheduler.submit('decode a', fail, priority=2.0)
+    scheduler.submit('decode b', tracker.job('decode b', 0), priority=1.0)
+    failed_jobs = scheduler.run()
+    assert tracker.started == list()
+    assert [job.name for job in failed_jobs] == ['decode a', 'decode b']
+
+
+def test_after_a_job_that_already_failed():
+    scheduler = Scheduler(1, keep_going=True, show_progress=False)
+    failed_job = scheduler.submit('failing', lambda: 1 / 0)
+    scheduler.run()
+    # submitted after the failure, the dependent is skipped right away, a waiter still runs
+    ran = list()
+    dependent = scheduler.submit('dependent', lambda: ran.append('dependent'), after=[failed_job])
+    scheduler.submit('waiter', lambda: ran.append('waiter'), wait_for=[failed_job])
+    assert dependent.skipped
+    assert scheduler.run() == [dependent]
+    assert ran == ['waiter']
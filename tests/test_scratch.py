@@ -0,0 +1,77 @@
+import os
+import socket
+import subprocess
+
+import scratch
+from scratch import Scratch
+
+
+def dead_pid():
+    process = subprocess.Popen(['true'])
+    process.wait()
+    return process.pid
+
+
+class DiskUsage:
+    def __init__(self, free):
+        self.free = free
+
+
+def test_albums_share_the_run_directory_until_cleanup(tmp_path, monkeypatch):
+    monkeypatch.setattr(scratch.shutil, 'disk_usage', lambda path: DiskUsage(10 ** 9))
+    run_scratch = Scratch(str(tmp_path / 'scratch'), n_jobs=2)
+    first = run_scratch.album_dir([1000, 2000])
+    second = run_scratch.album_dir([1000])
+    run_dir = run_scratch.run_dir
+    assert (first, second) == (os.path.join(run_dir, 'album-001'), os.path.join(run_dir, 'album-002'))
+    assert os.path.dirname(run_dir) == str(tmp_path / 'scratch')
+    assert os.path.basename(run_dir).startswith('{}{}-{}-'.format(scratch.run_dir_prefix, socket.gethostname(),
+                                                                  os.getpid()))
+    # what the scheduler may reserve at once: most of the free space of a disk
+    assert run_scratch.budget == 9 * 10 ** 8
+
+    with open(os.path.join(first, 'track01.wav'), 'wb') as wav_fd:
+        wav_fd.write(bytes(1000))
+    run_scratch.cleanup()
+    assert not os.path.exists(run_dir)
+    assert os.listdir(str(tmp_path / 'scratch')) == list()
+    # cleaning up twice does nothing
+    run_scratch.cleanup()
+
+
+def test_dry_run_creates_nothing(tmp_path):
+    run_scratch = Scratch(str(tmp_path / 'scratch'))
+    path = run_scratch.album_dir([1000], create=False)
+    assert path.endswith('album-001')
+    assert not (tmp_path / 'scratch').exists()
+    assert run_scratch.run_dir is None
+
+
+def test_runs_killed_on_this_host_are_swept(tmp_path):
+    root = tmp_path / 'scratch'
+    prefix = '{}{}-'.format(scratch.run_dir_prefix, socket.gethostname())
+    killed = root / '{}{}-abcd'.format(prefix, dead_pid())
+    running = root / '{}{}-abcd'.format(prefix, os.getppid())
+    other_host = root / '{}other-host-{}-abcd'.format(scratch.run_dir_prefix, dead_pid())
+    for run_dir in (killed, running, other_host):
+        (run_dir / 'album-001').mkdir(parents=True)
+    run_scratch = Scratch(str(root))
+    run_scratch.album_dir([1000])
+    assert not killed.exists()
+    assert running.exists() and other_host.exists()
+    run_scratch.cleanup()
+
+
+def test_shm_only_when_the_largest_tracks_fit(tmp_path, monkeypatch):
+    shm_dir = tmp_path / 'shm'
+    shm_dir.mkdir()
+    monkeypatch.setattr(scratch, 'shm_dir', str(shm_dir))
+    monkeypatch.setattr(scratch.shutil, 'disk_usage', lambda path: DiskUsage(10 ** 9))
+    run_scratch = Scratch(n_jobs=2)
+    usable = run_scratch._usable_bytes(str(shm_dir))
+    # RAM is shared: only half of what is free counts
+    assert usable == 5 * 10 ** 8
+    assert run_scratch._choose_root([usable // 2, usable // 2, usable]) != str(shm_dir)
+    assert run_scratch._choose_root([usable // 4, usable // 4, 1]) == str(shm_dir)
+    # a track of unknown size is not worth the risk
+    assert run_scratch._choose_root([1000, 0]) != str(shm_dir)
@@ -0,0 +1,177 @@
+import os
+import concurrent.futures
+
+import pytest
+
+import watch
+from api import make_config
+from watch import Watcher, in_close_write, in_create, in_isdir, in_modify, size_check_interval
+
+
+class Clock:
+    # stands for the time module of watch: only its monotonic clock is used
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class FakeInotify:
+    """
+    Plays a script of (seconds, change) steps: the clock moves on by seconds, change() makes the
+    changes on disk and returns their events. A step of None seconds lets the whole timeout expire
+    without any event. The watch stops once the script is over.
+    """
+    def __init__(self, clock, steps):
+        self.clock = clock
+        self.steps = list(steps)
+        self.paths = list()
+        self.closed = False
+
+    def add_watch(self, path):
+        self.paths.append(path)
+
+    def read_events(self, timeout=None):
+        if len(self.steps) == 0:
+            raise KeyboardInterrupt
+        seconds, change = self.steps.pop(0)
+        if seconds is None:
+            assert timeout is not None
+            self.clock.now += timeout
+            return list()
+        assert timeout is None or seconds <= timeout
+        self.clock.now += seconds
+        return change()
+
+    def close(self):
+        self.closed = True
+
+
+class Result:
+    n_tracks = 2
+    elapsed = 0.5
+
+
+class FakeConverter:
+    def __init__(self, clock):
+        self.clock = clock
+        self.converted = list()
+        self.cancelled = None
+
+    def convert_album(self, album_dir):
+        self.converted.append((album_dir, self.clock.now))
+        conversion = concurrent.futures.Future()
+        conversion.set_result(Result())
+        return conversion
+
+    def close(self, cancel=False):
+        self.cancelled = cancel
+
+
+@pytest.fixture
+def landing(tmp_path):
+    landing = tmp_path / 'landing'
+    landing.mkdir()
+    return landing
+
+
+def watch_landing(tmp_path, landing, monkeypatch, steps):
+    clock = Clock()
+    monkeypatch.setattr(watch, 'time', clock)
+    watcher = Watcher(make_config(path=str(tmp_path / 'out')), str(landing), quiet_period=5.0)
+    watcher.inotify.close()
+    watcher.inotify = FakeInotify(clock, steps)
+    watcher.converter = FakeConverter(clock)
+    return clock, watcher
+
+
+def write(path, size):
+    path.write_bytes(bytes(size))
+
+
+def test_album_is_converted_once_it_has_settled(tmp_path, landing, stub_tools, monkeypatch, capsys):
+    album = landing / 'album'
+
+    def copy_album():
+        album.mkdir()
+        write(album / '01.flac', 100)
+        return [(str(landing), 'album', in_create | in_isdir)]
+
+    def more_data():
+        write(album / '01.flac', (album / '01.flac').stat().st_size + 100)
+        return [(str(album), '01.flac', in_modify)]
+
+    def second_track():
+        write(album / '02.flac', 100)
+        return [(str(album), '02.flac', in_close_write)]
+
+    def split_track():
+        # written next to the sources by a conversion, it does not count
+        write(album / 'track01.wav', 100)
+        return [(str(album), 'track01.wav', in_close_write)]
+
+    def grows_silently():
+        write(album / '02.flac', 200)
+        return list()
+
+    steps = [(1.0, copy_album), (4.0, more_data), (4.0, more_data), (2.0, second_track), (2.0, split_track),
+             (None, None), (0.5, grows_silently), (None, None), (None, None)]
+    clock, watcher = watch_landing(tmp_path, landing, monkeypatch, steps)
+    start_time = clock.now
+    assert watcher.run() == 0
+
+    # every change starts the quiet period again, the size check finds the silent one
+    last_change = start_time + 11.0
+    assert watcher.converter.converted == [(str(album), last_change + 5.0 + 2 * size_check_interval)]
+    assert watcher.inotify.paths == [str(landing), str(album)]
+    assert watcher.pending == dict()
+    assert watcher.conversions == dict()
+    assert watcher.inotify.closed and watcher.converter.cancelled
+    output = capsys.readouterr().out
+    assert 'converted album {}: 2 track(s) in 0.50s'.format(album) in output
+    assert output.endswith('watch stopped\n')
+
+
+def test_album_waits_for_the_files_of_its_cuefile(tmp_path, landing, stub_tools, monkeypatch, capsys):
+    album = landing / 'album'
+    album.mkdir()
+    (album / 'album.cue').write_text('FILE "album.flac" WAVE\n  TRACK 01 AUDIO\n    INDEX 01 00:00:00\n')
+    write(album / 'album.flac', 0)
+
+    def image_written():
+        write(album / 'album.flac', 1000)
+        return [(str(album), 'album.flac', in_close_write)]
+
+    steps = [(None, None), (None, None), (None, None), (2.0, image_written), (None, None), (None, None)]
+    clock, watcher = watch_landing(tmp_path, landing, monkeypatch, steps)
+    start_time = clock.now
+    watcher.run()
+
+    # the album already there is pending from the start, its image only counts once it has content
+    image_time = start_time + 5.0 + size_check_interval + 5.0 + 2.0
+    assert watcher.converter.converted == [(str(album), image_time + 5.0 + size_check_interval)]
+    output = capsys.readouterr().out
+    assert output.count('waiting for album.flac in {}'.format(album)) == 1
+
+
+def test_outputs_under_the_landing_directory_are_not_albums(tmp_path, landing, stub_tools, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(watch, 'time', clock)
+    target_root = str(landing / 'converted')
+    watcher = Watcher(make_config(path=target_root), str(landing))
+    watcher.inotify.close()
+    assert watcher.target_roots == [target_root]
+
+    def converted():
+        os.makedirs(os.path.join(target_root, 'album'))
+        write(landing / 'converted' / 'album' / '01.flac', 100)
+        return [(str(landing), os.path.basename(target_root), in_create | in_isdir),
+                (os.path.join(target_root, 'album'), '01.flac', in_close_write)]
+
+    watcher.inotify = FakeInotify(clock, [(1.0, converted)])
+    watcher.converter = FakeConverter(clock)
+    watcher.run()
+    assert watcher.pending == dict()
+    assert watcher.inotify.paths == [str(landing)]
+    assert watcher._timeout() is None
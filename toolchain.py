@@ -0,0 +1,157 @@
+import os
+import re
+import json
+import shutil
+import literals
+
+from utility import subprocess_popen, search_path
+
+# aac backends of ffmpeg, preferred first
+aac_encoders = ('libfdk_aac', 'aac_at', 'aac')
+opus_encoders = ('libopus',)
+lossless_decoders = ('flac', 'ape', 'wavpack', 'alac')
+
+encoder_line_pattern = re.compile(r'^ *[AVS][A-Z.]{5} +(\S+) ')
+version_pattern = re.compile(r'^ffmpeg version (\S+)')
+
+
+def cache_path():
+    cache_home = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'lossless2lossy', 'toolchain.json')
+
+
+class Toolchain:
+    """
+    Finds the tools in process and probes what the ffmpeg build can actually do (encoders,
+    decoders, version). Probe results are cached on disk, keyed by the binary path and its
+    mtime/size, so only a new or updated ffmpeg is ever probed again.
+    """
+    def __init__(self):
+        self.paths = dict()
+        self.cache = dict()
+        self.cache_dirty = False
+        self._load_cache()
+
+    def _load_cache(self):
+        try:
+            with open(cache_path()) as cache_fd:
+                self.cache = json.load(cache_fd)
+        except (OSError, ValueError):
+            self.cache = dict()
+
+    def save_cache(self):
+        if not self.cache_dirty:
+            return
+        path = cache_path()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'w') as cache_fd:
+                json.dump(self.cache, cache_fd)
+            os.replace(path + '.tmp', path)
+            self.cache_dirty = False
+        except OSError as os_error:
+            print('warning: cannot write the toolchain cache: {}'.format(os_error))
+
+    def which(self, tool):
+        if tool not in self.paths:
+            self.paths[tool] = shutil.which(tool, path=search_path())
+        return self.paths[tool]
+
+    def _cache_key(self, path):
+        stat = os.stat(path)
+        return '{}:{}:{}'.format(os.path.realpath(path), stat.st_mtime_ns, stat.st_size)
+
+    def probe_ffmpeg(self, tool=literals.ffmpeg):
+        path = self.which(tool)
+        if path is None:
+            return None
+        key = self._cache_key(path)
+        # entries written before the resampler was probed are probed again
+        if key in self.cache and 'soxr' in self.cache[key]:
+            return self.cache[key]
+
+        capabilities = { 'version': None, 'encoders': list(), 'decoders': list(), 'soxr': False }
+        for option, field in (('-encoders', 'encoders'), ('-decoders', 'decoders')):
+            process = subprocess_popen([path, '-hide_banner', option])
+            stdout_data, stderr_data = process.communicate()
+            for line in stdout_data.decode('utf-8', errors='replace').splitlines():
+                line_match = encoder_line_pattern.match(line)
+                if line_match is not None and line_match.group(1) != '=':
+                    capabilities[field].append(line_match.group(1))
+        process = subprocess_popen([path, '-version'])
+        stdout_data, stderr_data = process.communicate()
+        version_match = version_pattern.match(stdout_data.decode('utf-8', errors='replace'))
+        if version_match is not None:
+            capabilities['version'] = version_match.group(1)
+        capabilities['soxr'] = b'--enable-libsoxr' in stdout_data
+
+        # entries of replaced binaries are dropped along the way
+        self.cache = { cached_key: value for cached_key, value in self.cache.items()
+                       if not cached_key.startswith(os.path.realpath(path) + ':') }
+        self.cache[key] = capabilities
+        self.cache_dirty = True
+        return capabilities
+
+    def select_encoder(self, candidates, tool=literals.ffmpeg):
+        capabilities = self.probe_ffmpeg(tool)
+        if capabilities is None:
+            return None
+        for candidate in candidates:
+            if candidate in capabilities['encoders']:
+                return candidate
+        return None
+
+
+def check_tools(config):
+    toolchain = Toolchain()
+    config.toolchain = toolchain
+
+    # check other tools
+    for tool in config.other_tools.values():
+        if toolchain.which(tool[0]) is None:
+            print('{} is missing and is required'.format(tool[0]))
+            return False
+
+    # check decode tools
+    if not any(toolchain.which(tool[0]) is not None for tool in config.decode_tools.values()):
+        error_msg = 'neither of '
+        for tool in config.decode_tools.values():
+            error_msg += tool[0] + ' '
+        error_msg += 'is installed'
+        print(error_msg)
+        return False
+
+    # check encode tools
+    if not any(toolchain.which(tool[0]) is not None for tool in config.encode_tools.values()):
+        error_msg = 'neither of '
+        for tool in config.encode_tools.values():
+            error_msg += tool[0] + ' '
+        error_msg += 'are installed'
+        print(error_msg)
+        return False
+
+    # check what the ffmpeg build supports
+    encoders = set(target.encoder for target in config.targets)
+    if literals.ffmpeg in encoders:
+        config.aac_encoder = toolchain.select_encoder(aac_encoders)
+        if config.aac_encoder is None:
+            print('{} has no aac encoder'.format(literals.ffmpeg))
+            return False
+    if literals.afconvert in encoders and toolchain.which(literals.afconvert) is None:
+        print('{} is missing and is required'.format(literals.afconvert))
+        return False
+    if literals.opus in encoders:
+        if toolchain.select_encoder(opus_encoders) is None:
+            print('{} has no opus encoder'.format(literals.ffmpeg))
+            return False
+    capabilities = toolchain.probe_ffmpeg()
+    if capabilities is not None:
+        config.ffmpeg_version = capabilities['version']
+        if capabilities['soxr']:
+            config.resampler = 'soxr'
+        for decoder in lossless_decoders:
+            if decoder not in capabilities['decoders']:
+                print('warning: {} cannot decode {} files'.format(literals.ffmpeg, decoder))
+
+    toolchain.save_cache()
+    return True
@@ -3,17 +3,30 @@ import re
 import subprocess
 import unicodedata
 
+from errors import ToolchainError
 
-def subprocess_popen(cmd):
+
+def search_path():
+    # /usr/local/bin is added in front when missing, a PATH that already holds it keeps its own order
+    path = os.environ.get('PATH', '')
+    if '/usr/local/bin' in path.split(os.pathsep):
+        return path
+    return '/usr/local/bin:' + path
+
+
+def subprocess_env():
+    env_path = dict()
+    env_path['PATH'] = search_path()
+    return env_path
+
+
+def subprocess_popen(cmd, stdin=None):
     try:
-        env_path = dict()
-        env_path['PATH'] = os.environ['PATH']
-        env_path['PATH'] = '/usr/local/bin:' + env_path['PATH']
-        return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env_path, shell=False)
-    except FileNotFoundError as file_not_found_error:
-        print('something went wrong when trying to run {}'.format(cmd))
-        print(file_not_found_error)
-        exit(-1)
+        return subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                env=subprocess_env(), shell=False)
+    except OSError as os_error:
+        # a library user gets the error, the command line prints it and exits
+        raise ToolchainError('cannot run {}: {}'.format(' '.join(cmd), os_error))
 
 
 def slugify(value, allow_unicode=False):
@@ -31,43 +44,3 @@ def slugify(value, allow_unicode=False):
         value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore').decode('ascii')
     value = re.sub(r'[^\w\s-]', '', value.lower())
     return re.sub(r'[-\s]+', '-', value).strip('-_')
-
-
-def check_tools(config):
-    # check other tools
-    for tool in config.other_tools.values():
-        proc = subprocess_popen(['which',tool[0]])
-        proc.wait()
-        if len(proc.stdout.readlines()) == 0:
-            print('{} is missing and is required'.format(tool[0]))
-            return False
-
-    # check decode tools
-    is_any_tool_installed = False
-    for tool in config.decode_tools.values():
-        proc = subprocess_popen(['which',tool[0]])
-        proc.wait()
-        is_any_tool_installed |= (len(proc.stdout.readlines()) > 0)
-    if not is_any_tool_installed:
-        error_msg = 'neither of '
-        for tool in config.decode_tools.values():
-            error_msg += tool[0] + ' '
-        error_msg += 'is installed'
-        print(error_msg)
-        return False
-
-    # check encode tools
-    is_any_tool_installed = False
-    for tool in config.encode_tools.values():
-        proc = subprocess_popen(['which',tool[0]])
-        proc.wait()
-        is_any_tool_installed |= (len(proc.stdout.readlines()) > 0)
-    if not is_any_tool_installed:
-        error_msg = 'neither of '
-        for tool in config.encode_tools.values():
-            error_msg += tool[0] + ' '
-        error_msg += 'are installed'
-        print(error_msg)
-        return False
-
-    return True
@@ -0,0 +1,265 @@
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from api import Converter
+from cuefile import CueSheet
+from errors import ConversionError
+
+# inotify(7) event masks
+in_modify = 0x00000002
+in_attrib = 0x00000004
+in_close_write = 0x00000008
+in_moved_from = 0x00000040
+in_moved_to = 0x00000080
+in_create = 0x00000100
+in_delete = 0x00000200
+in_delete_self = 0x00000400
+in_move_self = 0x00000800
+in_q_overflow = 0x00004000
+in_ignored = 0x00008000
+in_isdir = 0x40000000
+in_nonblock = os.O_NONBLOCK
+in_cloexec = os.O_CLOEXEC
+watch_mask = in_modify | in_attrib | in_close_write | in_moved_from | in_moved_to | in_create | in_delete | \
+    in_delete_self | in_move_self
+# struct inotify_event: wd, mask, cookie and len, then len bytes of nul padded name
+event_header = struct.Struct('iIII')
+
+album_extensions = ('.cue', '.flac', '.ape', '.wv')
+# the files whose changes count, the ones a conversion may write next to the sources (split wav files) do not
+watched_extensions = album_extensions + ('.jpg', '.jpeg', '.png')
+# after a quiet period the sizes are taken, and taken again this many seconds later
+size_check_interval = 1.0
+# an album whose cuefile still references missing files after this long is converted anyway, and fails
+reference_timeout = 300.0
+
+
+class Inotify:
+    """
+    The inotify(7) calls through ctypes: directories are watched one by one (inotify is not
+    recursive) and read_events returns (directory, name, mask) tuples.
+    """
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self._libc.inotify_init1(in_nonblock | in_cloexec)
+        if self.fd < 0:
+            self._raise_errno('inotify_init1')
+        # watch descriptor -> watched directory
+        self.paths = dict()
+
+    def _raise_errno(self, call, path=None):
+        error = ctypes.get_errno()
+        raise OSError(error, '{}: {}'.format(call, os.strerror(error)), path)
+
+    def add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), watch_mask)
+        if wd < 0:
+            self._raise_errno('inotify_add_watch', path)
+        self.paths[wd] = path
+
+    def read_events(self, timeout=None):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if len(readable) == 0:
+            return list()
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return list()
+        events = list()
+        offset = 0
+        while offset + event_header.size <= len(data):
+            wd, mask, cookie, length = event_header.unpack_from(data, offset)
+            offset += event_header.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & in_q_overflow:
+                events.append((None, '', mask))
+                continue
+            path = self.paths.get(wd)
+            if mask & in_ignored:
+                self.paths.pop(wd, None)
+            if path is not None:
+                events.append((path, name, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PendingAlbum:
+    def __init__(self, now):
+        self.first_seen = now
+        self.last_change = now
+        # name -> (size, mtime) of the files of the album, when the quiet period last ended
+        self.snapshot = None
+        self.waiting_reported = False
+
+
+class Watcher:
+    """
+    Watches a landing directory and converts the albums dropped in it, in the same process: no
+    cron, no process per album. Every directory of the tree is watched with inotify; a directory
+    where files change becomes a pending album, and is converted once it has been quiet for
+    quiet_period seconds, its file sizes did not move during size_check_interval more seconds and
+    the files its cuefiles reference are all there. Albums already in the tree when the watch starts
+    go through the same checks. An album that changes again later is converted again once quiet,
+    with --incremental only what changed is redone. Up to n_albums albums are converted at once.
+    """
+    def __init__(self, config, landing_dir, quiet_period=5.0, n_albums=1):
+        self.config = config
+        self.landing_dir = os.path.realpath(os.path.expanduser(landing_dir))
+        self.quiet_period = quiet_period
+        self.converter = Converter(config, n_albums)
+        # with the outputs under the landing directory, the converted files must not look like albums
+        out_root = os.path.expanduser(config.args.path) if config.args.path is not None else os.getcwd()
+        self.target_roots = [os.path.realpath(target.root(out_root)) for target in config.targets]
+        self.inotify = Inotify()
+        # album directory -> PendingAlbum
+        self.pending = dict()
+        # album directory -> future of its conversion
+        self.conversions = dict()
+
+    def _ignored(self, dir_path):
+        return any(dir_path == root or dir_path.startswith(root + os.sep) for root in self.target_roots)
+
+    def _watch_tree(self, top):
+        # the files of a directory that appears with content (moved in, or copied before its watch was
+        # added) make no event: they are looked for here
+        now = time.monotonic()
+        for dir_path, dir_names, file_names in os.walk(top):
+            dir_names[:] = [dir_name for dir_name in dir_names if not self._ignored(os.path.join(dir_path, dir_name))]
+            try:
+                self.inotify.add_watch(dir_path)
+            except OSError as os_error:
+                # removed in the meantime, or the watch limit is reached
+                if os_error.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    print('warning: cannot watch {}: {}'.format(dir_path, os_error))
+                continue
+            if any(file_name.lower().endswith(album_extensions) for file_name in file_names):
+                self._changed(dir_path, now)
+
+    def _changed(self, dir_path, now):
+        if dir_path in self.pending:
+            self.pending[dir_path].last_change = now
+        else:
+            self.pending[dir_path] = PendingAlbum(now)
+
+    def _snapshot(self, album_dir):
+        snapshot = dict()
+        for entry in os.scandir(album_dir):
+            if entry.is_file():
+                stat = entry.stat()
+                snapshot[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def _missing_references(self, album_dir, snapshot):
+        missing = list()
+        for file_name in snapshot:
+            if file_name.lower().endswith('.cue'):
+                try:
+                    sheet = CueSheet().read(os.path.join(album_dir, file_name))
+                except (OSError, ValueError, IndexError):
+                    # still being written
+                    missing.append(file_name)
+                    continue
+                missing.extend(entry.name for entry in sheet.files
+                               if snapshot.get(entry.name, (0,))[0] == 0)
+        return missing
+
+    def _ready(self, album_dir, album, now):
+        # True once the album can be converted, False while it has to wait
+        snapshot = self._snapshot(album_dir)
+        if snapshot != album.snapshot:
+            album.snapshot = snapshot
+            album.last_change = now - self.quiet_period + size_check_interval
+            return False
+        missing = self._missing_references(album_dir, snapshot)
+        if len(missing) > 0 and now - album.first_seen < reference_timeout:
+            if not album.waiting_reported:
+                print('waiting for {} in {}'.format(', '.join(missing), album_dir))
+                album.waiting_reported = True
+            album.last_change = now
+            return False
+        return True
+
+    def _check_pending(self):
+        now = time.monotonic()
+        for album_dir, album in list(self.pending.items()):
+            if now < album.last_change + self.quiet_period:
+                continue
+            # an album changed during its conversion waits for it before being converted again
+            conversion = self.conversions.get(album_dir)
+            if conversion is not None and not conversion.done():
+                continue
+            try:
+                if not any(file_name.lower().endswith(album_extensions) for file_name in os.listdir(album_dir)):
+                    del self.pending[album_dir]
+                    continue
+                if not self._ready(album_dir, album, now):
+                    continue
+            except FileNotFoundError:
+                del self.pending[album_dir]
+                continue
+            del self.pending[album_dir]
+            self._convert(album_dir)
+
+    def _convert(self, album_dir):
+        print('converting album {}'.format(album_dir))
+        conversion = self.converter.convert_album(album_dir)
+        conversion.add_done_callback(lambda future: self._report(album_dir, future))
+        self.conversions[album_dir] = conversion
+
+    def _report(self, album_dir, future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is None:
+            result = future.result()
+            print('converted album {}: {} track(s) in {:.2f}s'.format(album_dir, result.n_tracks, result.elapsed))
+        elif isinstance(error, ConversionError):
+            print('album {} failed: {}'.format(album_dir, error))
+        else:
+            print('album {} failed: {}'.format(album_dir, repr(error)))
+
+    def _timeout(self):
+        # until the end of the first quiet period, or until a conversion ends for the albums waiting on one
+        if len(self.pending) == 0:
+            return None
+        if any(album_dir in self.conversions and not self.conversions[album_dir].done()
+               for album_dir in self.pending):
+            return size_check_interval
+        return max(0.0, min(album.last_change for album in self.pending.values()) + self.quiet_period -
+                   time.monotonic())
+
+    def run(self):
+        self._watch_tree(self.landing_dir)
+        print('watching {} for new albums'.format(self.landing_dir))
+        try:
+            while True:
+                for dir_path, name, mask in self.inotify.read_events(self._timeout()):
+                    if dir_path is None:
+                        # events were lost: everything is looked at again
+                        print('warning: inotify queue overflow, rescanning {}'.format(self.landing_dir))
+                        self._watch_tree(self.landing_dir)
+                    elif mask & in_isdir:
+                        if mask & (in_create | in_moved_to) and not self._ignored(os.path.join(dir_path, name)):
+                            self._watch_tree(os.path.join(dir_path, name))
+                    elif name.lower().endswith(watched_extensions) and not self._ignored(dir_path):
+                        self._changed(dir_path, time.monotonic())
+                self._check_pending()
+                # finished conversions are forgotten, their albums only come back if they change
+                for album_dir in [album_dir for album_dir, future in self.conversions.items() if future.done()]:
+                    if album_dir not in self.pending:
+                        del self.conversions[album_dir]
+        except KeyboardInterrupt:
+            print('watch stopped')
+        finally:
+            self.inotify.close()
+            # the running albums are stopped, they are converted again at the next start
+            self.converter.close(cancel=True)
+        return 0